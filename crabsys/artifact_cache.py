@@ -0,0 +1,227 @@
+import os
+import sys
+import json
+import shutil
+import tarfile
+import hashlib
+import platform
+import tempfile
+
+from os.path import join as pjoin
+from config import crabsys_config
+from utils import *
+from cache_backends import createCacheBackend
+
+
+
+##############################################################################
+# Artifact cache
+#
+# Built outputs of archive and repository dependencies are stored in a
+# content addressed folder (by default ~/.crabsys/cache), keyed on everything
+# that goes into building them, so every checkout depending on the same
+# library restores a copy of it instead of building it again. Restored files
+# are never hardlinks into the cache: builds may rewrite their outputs in
+# place, which would change the cached entry as well.
+#
+# Each entry is a folder holding a manifest and a copy of the target files
+# and include directories, laid out relative to the dependency's folder.
+#
+# Optionally, entries are also shared through a remote backend (another
+# folder, or an http server such as 'crab cache-server'): local misses are
+# looked up there and new local entries are uploaded to it.
+##############################################################################
+manifest_file_name = 'manifest.json'
+
+
+def artifact_cache_directory():
+    directory = crabsys_config.get("artifact_cache_directory")
+    if not directory:
+        return None
+    return os.path.abspath(os.path.expanduser(directory))
+
+
+def artifact_key(description):
+    description = dict(description)
+    description["platform"] = [sys.platform, platform.machine()]
+    description["crabsys_version"] = crabsys_version
+
+    return hashlib.sha256(json.dumps(description, sort_keys=True)).hexdigest()
+
+
+def artifact_entry_path(key):
+    return pjoin(artifact_cache_directory(), key[:2], key)
+
+
+def restore_file(source, destination):
+    mkdir_p(os.path.dirname(destination))
+
+    # Replaced at once, whatever was there (even a hardlink restored by an
+    # older version) is left untouched
+    temporary_path = "%s.tmp-%d" % (destination, os.getpid())
+    shutil.copy2(source, temporary_path)
+    os.rename(temporary_path, destination)
+
+
+def list_files(directory):
+    for (dir_path, dir_names, file_names) in os.walk(directory):
+        for file_name in file_names:
+            yield pjoin(dir_path, file_name)
+##############################################################################
+
+
+
+##############################################################################
+def storeArtifacts(key, base_dir, target_files, include_dirs):
+    """Copies target_files and the contents of include_dirs (all relative to
+    base_dir) to the cache entry for key."""
+    if artifact_cache_directory() is None:
+        return False
+
+    entry_path = artifact_entry_path(key)
+    if os.path.isdir(entry_path):
+        return True
+
+    mkdir_p(os.path.dirname(entry_path))
+
+    temporary_path = "%s.tmp-%d" % (entry_path, os.getpid())
+    if os.path.exists(temporary_path):
+        shutil.rmtree(temporary_path)
+
+    try:
+        mkdir_p(temporary_path)
+
+        for target_file in target_files:
+            mkdir_p(os.path.dirname(pjoin(temporary_path, target_file)))
+            shutil.copy2(pjoin(base_dir, target_file), pjoin(temporary_path, target_file))
+
+        for include_dir in include_dirs:
+            for file_path in list_files(pjoin(base_dir, include_dir)):
+                relative_path = os.path.relpath(file_path, base_dir)
+                mkdir_p(os.path.dirname(pjoin(temporary_path, relative_path)))
+                shutil.copy2(file_path, pjoin(temporary_path, relative_path))
+
+        with open(pjoin(temporary_path, manifest_file_name), 'w') as manifest:
+            json.dump({ "target_files": target_files,
+                        "includes": include_dirs }, manifest)
+
+        os.rename(temporary_path, entry_path)
+    except (IOError, OSError) as e:
+        # Someone else may have stored the same entry in the meantime
+        if not os.path.isdir(entry_path):
+            print "Warning: unable to store artifacts in cache: %s" % (e)
+        return False
+    finally:
+        if os.path.exists(temporary_path):
+            shutil.rmtree(temporary_path)
+
+    pushRemoteArtifacts(key)
+
+    return True
+
+
+def restoreArtifacts(key, base_dir):
+    """Restores the cache entry for key into base_dir, returning whether there
+    was one."""
+    if artifact_cache_directory() is None:
+        return False
+
+    entry_path = artifact_entry_path(key)
+    manifest_path = pjoin(entry_path, manifest_file_name)
+
+    if not os.path.isfile(manifest_path) and not fetchRemoteArtifacts(key):
+        return False
+
+    manifest = json.loads(get_file_content(manifest_path))
+
+    for target_file in manifest["target_files"]:
+        restore_file(pjoin(entry_path, target_file), pjoin(base_dir, target_file))
+
+    # Headers already in the source tree are left alone, only the ones
+    # generated by the build are brought back
+    for include_dir in manifest["includes"]:
+        for file_path in list_files(pjoin(entry_path, include_dir)):
+            destination = pjoin(base_dir, os.path.relpath(file_path, entry_path))
+            if not os.path.exists(destination):
+                restore_file(file_path, destination)
+
+    return True
+##############################################################################
+
+
+
+##############################################################################
+def remote_backend():
+    return createCacheBackend(crabsys_config.get("artifact_cache_remote"))
+
+
+def pushRemoteArtifacts(key):
+    backend = remote_backend()
+    if backend is None:
+        return False
+
+    entry_path = artifact_entry_path(key)
+
+    # Compressed to disk first: the upload needs to know its size and hash
+    with tempfile.NamedTemporaryFile(suffix='.tar.gz', dir=artifact_cache_directory()) as blob:
+        archive = tarfile.open(fileobj=blob, mode='w:gz')
+        archive.add(entry_path, arcname='.')
+        archive.close()
+
+        blob.flush()
+        length = blob.tell()
+        digest = file_sha256(blob.name)
+
+        blob.seek(0)
+        try:
+            backend.store(key, blob, digest, length)
+        except Exception as e:
+            print "Warning: unable to upload artifacts to remote cache: %s" % (e)
+            return False
+
+    return True
+
+
+def fetchRemoteArtifacts(key):
+    backend = remote_backend()
+    if backend is None:
+        return False
+
+    entry_path = artifact_entry_path(key)
+    temporary_path = "%s.tmp-%d" % (entry_path, os.getpid())
+
+    mkdir_p(os.path.dirname(entry_path))
+
+    with tempfile.NamedTemporaryFile(suffix='.tar.gz', dir=artifact_cache_directory()) as blob:
+        try:
+            digest = backend.fetch(key, blob)
+        except Exception as e:
+            print "Warning: unable to download artifacts from remote cache: %s" % (e)
+            return False
+
+        if digest is None:
+            return False
+
+        blob.flush()
+        if file_sha256(blob.name) != digest:
+            print "Warning: discarding corrupted remote cache entry: %s" % (key)
+            return False
+
+        try:
+            blob.seek(0)
+            archive = tarfile.open(fileobj=blob, mode='r:gz')
+            archive.extractall(path=temporary_path,
+                               members=safemembers(archive, temporary_path))
+            archive.close()
+
+            os.rename(temporary_path, entry_path)
+        except (IOError, OSError, tarfile.TarError) as e:
+            if not os.path.isdir(entry_path):
+                print "Warning: unable to unpack remote cache entry: %s" % (e)
+                return False
+        finally:
+            if os.path.exists(temporary_path):
+                shutil.rmtree(temporary_path)
+
+    return os.path.isfile(pjoin(entry_path, manifest_file_name))
+##############################################################################
@@ -0,0 +1,108 @@
+import os
+import json
+import time
+import threading
+
+from os.path import join as pjoin
+from utils import get_file_content, file_sha256, mkdir_p, build_folder_relative_path
+
+
+
+##############################################################################
+# Build state
+#
+# Remembers, for every target built from a project, the fingerprint of the
+# inputs it was last built with, so a target is only built again when one of
+# its own inputs changed. Also caches file hashes by size and modification
+# time, so unchanged files are never hashed twice.
+#
+# Kept as build/.build/state.json under the root project.
+##############################################################################
+state_file_name = 'state.json'
+
+# Hashes of files modified this close to the check aren't kept: another
+# change within the mtime resolution would go unnoticed
+racy_interval = 2.0
+
+
+class BuildState:
+    def __init__(self, root_dir):
+        self.path = pjoin(root_dir, build_folder_relative_path, state_file_name)
+        self.lock = threading.Lock()
+
+        self.fingerprints = {}
+        self.file_hashes = {}
+
+        if os.path.isfile(self.path):
+            try:
+                state = json.loads(get_file_content(self.path))
+                self.fingerprints = state.get("fingerprints", {})
+                self.file_hashes = state.get("file_hashes", {})
+            except ValueError:
+                pass
+
+        self.changed = False
+
+    def fingerprint(self, key):
+        with self.lock:
+            return self.fingerprints.get(key)
+
+    def record(self, key, fingerprint):
+        with self.lock:
+            if self.fingerprints.get(key) != fingerprint:
+                self.fingerprints[key] = fingerprint
+                self.changed = True
+
+    def fileHash(self, path):
+        """The sha256 of the file at path, or None when there's none."""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        signature = [stat.st_size, stat.st_mtime]
+
+        with self.lock:
+            cached = self.file_hashes.get(path)
+        if cached and cached["signature"] == signature:
+            return cached["sha256"]
+
+        digest = file_sha256(path)
+
+        if time.time() - stat.st_mtime > racy_interval:
+            with self.lock:
+                self.file_hashes[path] = { "signature": signature, "sha256": digest }
+                self.changed = True
+
+        return digest
+
+    def save(self):
+        with self.lock:
+            if not self.changed:
+                return
+
+            mkdir_p(os.path.dirname(self.path))
+
+            temporary_path = "%s.tmp-%d" % (self.path, os.getpid())
+            with open(temporary_path, 'w') as state_file:
+                json.dump({ "fingerprints": self.fingerprints,
+                            "file_hashes": self.file_hashes }, state_file)
+            os.rename(temporary_path, self.path)
+
+            self.changed = False
+##############################################################################
+
+
+
+##############################################################################
+build_state = None
+
+def loadBuildState(root_dir):
+    global build_state
+
+    build_state = BuildState(root_dir)
+    return build_state
+
+def currentBuildState():
+    return build_state
+##############################################################################
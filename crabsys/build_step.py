@@ -1,6 +1,9 @@
 
 from os.path import join as pjoin
-from utils import system_command
+from utils import system_command, log
+from jobserver import jobSlot, jobserverEnvironment, jobserverRunning, jobserverJobs
+from tracing import traceSpan
+from compiler_cache import compilerLauncherEnvironment
 
 class BuildStep:
     def __init__(self, build_step_info, context):
@@ -14,10 +17,43 @@ class BuildStep:
 
         self.command = build_step_info.get("command")
 
+        # Whether the compilers the command uses should go through the
+        # compiler launcher (as CC/CXX)
+        self.compiler_launcher = build_step_info.get("compiler_launcher", False)
+
+        # For generated build systems (make or ninja), whether they may run
+        # jobs in parallel
+        self.parallel = build_step_info.get("parallel")
+
+    def jobParams(self):
+        if self.parallel is None:
+            return []
+        if not self.parallel:
+            return ['-j1']
+
+        # With the jobserver running, make gets its parallelism through
+        # MAKEFLAGS and an explicit -j would opt it out of the shared limit.
+        # Ninja doesn't take the jobserver pipe (only a fifo one, as of 1.13),
+        # so it's capped explicitly, at the limit of the whole build instead
+        # of its own default of cores + 2
+        if self.command == "ninja" or not jobserverRunning():
+            return ['-j' + str(jobserverJobs())]
+        return []
+
     def run(self):
-        (retcode, stdout, stderr) = system_command([self.command]+self.params, pjoin(self.context.current_dir, self.directory))
+        env = jobserverEnvironment()
+        if self.compiler_launcher:
+            env = compilerLauncherEnvironment(env)
+
+        params = self.jobParams() + self.params
+
+        with traceSpan(self.command, "step", { "params": params }):
+            with jobSlot():
+                (retcode, stdout, stderr) = system_command([self.command]+params,
+                                                           pjoin(self.context.current_dir, self.directory),
+                                                           env)
         if retcode != 0:
-            print stderr
+            log(stderr)
             raise Exception("Command returned non-zero code: %s" % (self.command))
 
 
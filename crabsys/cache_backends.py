@@ -0,0 +1,193 @@
+import os
+import re
+import hashlib
+import httplib
+import threading
+from urlparse import urlparse
+
+from os.path import join as pjoin
+from utils import mkdir_p, get_file_content
+
+
+
+##############################################################################
+# Remote artifact cache backends
+#
+# A backend stores opaque blobs (compressed artifact cache entries) by key,
+# along with the sha256 of each blob so downloads can be verified. Blobs are
+# always streamed, never held in memory.
+##############################################################################
+chunk_size = 64*1024
+
+key_pattern = re.compile(r'^[0-9a-f]{64}$')
+
+digest_header = 'X-Crabsys-SHA256'
+
+
+def copy_stream(source, destination, length=None):
+    """Copies source to destination in chunks (at most length bytes),
+    returning the sha256 of the data copied."""
+    digest = hashlib.sha256()
+
+    while length is None or length > 0:
+        size = chunk_size
+        if length is not None:
+            size = min(size, length)
+
+        chunk = source.read(size)
+        if not chunk:
+            break
+
+        digest.update(chunk)
+        destination.write(chunk)
+
+        if length is not None:
+            length -= len(chunk)
+
+    return digest.hexdigest()
+
+
+def validate_key(key):
+    if not key_pattern.match(key):
+        raise Exception("Invalid artifact cache key: %s" % (key))
+##############################################################################
+
+
+
+##############################################################################
+class CacheBackend(object):
+    def fetch(self, key, destination):
+        """Writes the blob stored for key to the destination file object and
+        returns the sha256 it was stored with, or None if there is none."""
+        raise NotImplementedError()
+
+    def store(self, key, source, digest, length):
+        """Stores length bytes read from the source file object as the blob
+        for key."""
+        raise NotImplementedError()
+##############################################################################
+
+
+
+##############################################################################
+class FilesystemBackend(CacheBackend):
+    def __init__(self, directory):
+        self.directory = os.path.abspath(os.path.expanduser(directory))
+
+    def blobPath(self, key):
+        validate_key(key)
+        return pjoin(self.directory, key[:2], key + '.tar.gz')
+
+    def digest(self, key):
+        digest_path = self.blobPath(key) + '.sha256'
+        if not os.path.isfile(digest_path):
+            return None
+        return get_file_content(digest_path).strip()
+
+    def fetch(self, key, destination):
+        digest = self.digest(key)
+        if digest is None:
+            return None
+
+        with open(self.blobPath(key), 'rb') as blob:
+            copy_stream(blob, destination)
+
+        return digest
+
+    def store(self, key, source, digest, length):
+        blob_path = self.blobPath(key)
+        temporary_path = "%s.tmp-%d-%d" % (blob_path, os.getpid(),
+                                           threading.current_thread().ident)
+
+        mkdir_p(os.path.dirname(blob_path))
+
+        try:
+            with open(temporary_path, 'wb') as blob:
+                received_digest = copy_stream(source, blob, length)
+
+            if received_digest != digest:
+                raise Exception("Artifact blob doesn't match its hash: %s" % (key))
+
+            # The digest is written last: a blob only counts once it's there
+            os.rename(temporary_path, blob_path)
+            with open(blob_path + '.sha256', 'w') as digest_file:
+                digest_file.write(digest)
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+##############################################################################
+
+
+
+##############################################################################
+class HttpBackend(CacheBackend):
+    def __init__(self, url):
+        self.url = urlparse(url)
+
+        if self.url.scheme not in ['http', 'https']:
+            raise Exception("Unsupported artifact cache url: %s" % (url))
+
+    def connection(self):
+        if self.url.scheme == 'https':
+            return httplib.HTTPSConnection(self.url.netloc)
+        return httplib.HTTPConnection(self.url.netloc)
+
+    def blobPath(self, key):
+        validate_key(key)
+        return self.url.path.rstrip('/') + '/' + key + '.tar.gz'
+
+    def fetch(self, key, destination):
+        connection = self.connection()
+        try:
+            connection.request('GET', self.blobPath(key))
+            response = connection.getresponse()
+
+            if response.status == 404:
+                return None
+            if response.status != 200:
+                raise Exception("Artifact cache server error: %d %s" %
+                                (response.status, response.reason))
+
+            copy_stream(response, destination)
+
+            return response.getheader(digest_header)
+        finally:
+            connection.close()
+
+    def store(self, key, source, digest, length):
+        connection = self.connection()
+        try:
+            # httplib streams file object bodies in blocks
+            connection.request('PUT', self.blobPath(key), source, {
+                'Content-Type': 'application/gzip',
+                'Content-Length': str(length),
+                digest_header: digest
+            })
+            response = connection.getresponse()
+            response.read()
+
+            if response.status not in [200, 201, 204]:
+                raise Exception("Artifact cache server error: %d %s" %
+                                (response.status, response.reason))
+        finally:
+            connection.close()
+##############################################################################
+
+
+
+##############################################################################
+def createCacheBackend(location):
+    """Creates the backend for location: an http(s) url or a folder path
+    (optionally as a file:// url)."""
+    if not location:
+        return None
+
+    scheme = urlparse(location).scheme
+
+    if scheme in ['http', 'https']:
+        return HttpBackend(location)
+    if scheme == 'file':
+        return FilesystemBackend(urlparse(location).path)
+
+    return FilesystemBackend(location)
+##############################################################################
@@ -0,0 +1,95 @@
+import os
+import SocketServer
+import BaseHTTPServer
+
+from cache_backends import FilesystemBackend, digest_header, key_pattern
+
+
+
+##############################################################################
+# Stand-in artifact cache server
+#
+# Serves a FilesystemBackend folder over plain HTTP: GET/HEAD /<key>.tar.gz
+# to download a blob (its sha256 comes in the X-Crabsys-SHA256 header) and
+# PUT /<key>.tar.gz to upload one. Good enough to share a cache on a local
+# network, or to test the HTTP backend without outside services.
+#
+# Blobs are served under any path prefix (all prefixes share the folder), so
+# backend urls like http://host:port/crabsys/ work as they would behind a
+# reverse proxy.
+##############################################################################
+class CacheRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def requestedKey(self):
+        name = self.path.split('?', 1)[0].rsplit('/', 1)[-1]
+
+        if not name.endswith('.tar.gz') or not key_pattern.match(name[:-len('.tar.gz')]):
+            self.send_error(404)
+            return None
+
+        return name[:-len('.tar.gz')]
+
+    def sendBlobHeaders(self, key):
+        digest = self.server.backend.digest(key)
+        if digest is None:
+            self.send_error(404)
+            return False
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/gzip')
+        self.send_header('Content-Length', str(os.path.getsize(self.server.backend.blobPath(key))))
+        self.send_header(digest_header, digest)
+        self.end_headers()
+        return True
+
+    def do_HEAD(self):
+        key = self.requestedKey()
+        if key:
+            self.sendBlobHeaders(key)
+
+    def do_GET(self):
+        key = self.requestedKey()
+        if key and self.sendBlobHeaders(key):
+            self.server.backend.fetch(key, self.wfile)
+
+    def do_PUT(self):
+        key = self.requestedKey()
+        if not key:
+            return
+
+        digest = self.headers.getheader(digest_header)
+        length = self.headers.getheader('Content-Length')
+        if not digest or not length:
+            self.send_error(400, "Missing %s or Content-Length" % (digest_header))
+            return
+
+        try:
+            self.server.backend.store(key, self.rfile, digest, int(length))
+        except Exception as e:
+            self.send_error(400, str(e))
+            return
+
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+class CacheServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, directory):
+        BaseHTTPServer.HTTPServer.__init__(self, address, CacheRequestHandler)
+        self.backend = FilesystemBackend(directory)
+
+
+def runCacheServer(directory, port, bind_address='127.0.0.1'):
+    server = CacheServer((bind_address, port), directory)
+
+    print "Serving artifact cache %s at http://%s:%d/" % (server.backend.directory,
+                                                         bind_address, port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+##############################################################################
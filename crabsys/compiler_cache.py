@@ -0,0 +1,110 @@
+import os
+import json
+import subprocess
+from distutils.spawn import find_executable
+
+from config import crabsys_config
+
+
+
+##############################################################################
+# Compiler cache
+#
+# The "compiler_launcher" setting names a compiler cache (ccache, sccache, or
+# the path to either) every compiler invocation goes through: "auto" uses
+# ccache when it's on the PATH, an empty value disables it. CMake projects
+# get it as CMAKE_<LANG>_COMPILER_LAUNCHER, build steps asking for it (like
+# autoconf's configure and make) as CC/CXX wrappers.
+##############################################################################
+compiler_launcher_languages = [ "C", "CXX" ]
+
+resolved_launcher = []
+
+def compilerLauncher():
+    """The compiler launcher to use, or None."""
+    if not resolved_launcher:
+        launcher = crabsys_config.get("compiler_launcher", "auto")
+
+        if launcher == "auto":
+            launcher = find_executable("ccache")
+        elif launcher and not os.path.isabs(launcher):
+            if find_executable(launcher) is None:
+                raise Exception("Compiler launcher not found: %s" % (launcher))
+            launcher = find_executable(launcher)
+
+        resolved_launcher.append(launcher or None)
+
+    return resolved_launcher[0]
+
+
+def compilerLauncherCMakeArguments():
+    launcher = compilerLauncher()
+
+    # A launcher set by an earlier configure stays in the cache otherwise
+    if launcher is None:
+        return [ "-UCMAKE_%s_COMPILER_LAUNCHER" % (language)
+                 for language in compiler_launcher_languages ]
+
+    return [ "-DCMAKE_%s_COMPILER_LAUNCHER=%s" % (language, launcher)
+             for language in compiler_launcher_languages ]
+
+
+def compilerLauncherEnvironment(env):
+    """Wraps the compilers set in env (or the default ones) with the compiler
+    launcher."""
+    launcher = compilerLauncher()
+    if launcher is None:
+        return env
+
+    env = dict(env)
+    for (variable, default) in [ ("CC", "cc"), ("CXX", "c++") ]:
+        compiler = env.get(variable, default)
+        if not compiler.startswith(launcher):
+            env[variable] = "%s %s" % (launcher, compiler)
+
+    return env
+##############################################################################
+
+
+
+##############################################################################
+def compilerCacheStatistics():
+    """Returns the launcher's (hits, misses) counters so far, or None when
+    they can't be read."""
+    launcher = compilerLauncher()
+    if launcher is None:
+        return None
+
+    try:
+        if os.path.basename(launcher).startswith("sccache"):
+            stats = json.loads(subprocess.check_output([launcher, "--show-stats", "--stats-format=json"]))
+            return ( sum(stats["stats"]["cache_hits"]["counts"].values()),
+                     sum(stats["stats"]["cache_misses"]["counts"].values()) )
+
+        # ccache 4 and later
+        counters = {}
+        for line in subprocess.check_output([launcher, "--print-stats"]).split('\n'):
+            fields = line.split('\t')
+            if len(fields) == 2 and fields[1].isdigit():
+                counters[fields[0]] = int(fields[1])
+
+        return ( counters.get("direct_cache_hit", 0) + counters.get("preprocessed_cache_hit", 0),
+                 counters.get("cache_miss", 0) )
+    except (OSError, ValueError, KeyError, subprocess.CalledProcessError):
+        return None
+
+
+def compilerCacheSummary(before, after):
+    """Hits and misses between two compilerCacheStatistics() readings."""
+    if before is None or after is None:
+        return None
+
+    hits = after[0] - before[0]
+    misses = after[1] - before[1]
+
+    hit_rate = 0.0
+    if hits + misses > 0:
+        hit_rate = 100.0 * hits / (hits + misses)
+
+    return { "launcher": compilerLauncher(), "hits": hits, "misses": misses, "hit_rate": hit_rate }
+##############################################################################
@@ -2,6 +2,7 @@
 from __future__ import unicode_literals
 
 import json
+import copy
 import errno
 import os
 
@@ -16,6 +17,17 @@ config_files_locations = [
 
 crabsys_config = {
     "update_dependencies": False,
+    "locked": False,
+    "jobs": 0,
+    "load_average": 0.0,
+    "artifact_cache_directory": "~/.crabsys/cache",
+    "artifact_cache_remote": "",
+    "git_mirrors_directory": "",
+    "superbuild": False,
+    "generator": "auto",
+    "compiler_launcher": "auto",
+    "unity_build": {},
+    "watch": {},
     "compile_flags": ["-Wall"],
     "link_flags": [],
     "includes": [
@@ -38,6 +50,9 @@ crabsys_config = {
 }
 
 
+default_crabsys_config = copy.deepcopy(crabsys_config)
+
+
 def mergeDictionary(target, source):
     for key in source:
         if key in target:
@@ -79,3 +94,16 @@ def loadConfiguration(config_file_path=None, config=None):
         mergeConfig(config)
 
     #print crabsys_config
+
+
+def resetConfiguration():
+    """Back to the defaults, for configurations loaded again in the same
+    process."""
+    crabsys_config.clear()
+    crabsys_config.update(copy.deepcopy(default_crabsys_config))
+
+
+def configurationFiles(config_file_path=None):
+    """The configuration files loadConfiguration() reads that exist."""
+    return [ path for path in config_files_locations+[config_file_path]
+             if path and os.path.isfile(path) ]
@@ -0,0 +1,42 @@
+import os
+from os.path import join as pjoin
+
+
+
+##############################################################################
+# Useful variables/constants
+#
+# Kept apart from utils, so they can be used without importing it
+##############################################################################
+crabsys_version = '0.1.0'
+
+build_folder_relative_path = pjoin('build', '.build')
+targets_relative_path = 'build'
+libraries_folder_relative_path = 'libs'
+
+resources_dir = pjoin(os.path.dirname(os.path.realpath(__file__)), 'resources')
+templates_dir = pjoin(resources_dir, 'templates')
+
+build_types = {
+    "crab": "crabsys"
+}
+
+cmake_build_cmake_lists_template = "CMakeBuild_CMakeLists.txt"
+crabsys_build_cmake_lists_template = "CrabsysBuild_CMakeLists.txt"
+superbuild_cmake_lists_template = "Superbuild_CMakeLists.txt"
+
+# Environment variables that change how targets are built
+fingerprint_environment_variables = [ "CC", "CXX", "CPP", "CFLAGS", "CXXFLAGS", "CPPFLAGS",
+                                      "LDFLAGS", "LIBS", "PKG_CONFIG_PATH" ]
+
+# Those, and the ones changing which tools builds run and how, which build
+# daemon clients must share with the daemon
+build_environment_variables = fingerprint_environment_variables + [ "PATH", "LD_LIBRARY_PATH",
+                                                                    "MAKEFLAGS", "MFLAGS" ]
+build_environment_prefixes = ( "CCACHE_", "SCCACHE_" )
+
+platform_names = {
+    "linux": "linux2",
+    "linux2": "linux2",
+}
+##############################################################################
@@ -7,6 +7,10 @@ from os.path import join as pjoin
 from config import crabsys_config
 from utils import *
 from target import createTarget
+from fetch import fetchArchiveDependency, fetchRepositoryDependency, repositoryPin
+from lockfile import currentLockfile
+from file_index import FileIndex
+from tracing import traceSpan
 
 
 ##############################################################################
@@ -14,12 +18,77 @@ class GlobalContext:
     def __init__(self):
         self.projects = {}
 
+        # Contexts by dependency key, and the key and requester of each
+        # dependency source
+        self.dependencies = {}
+        self.dependency_sources = {}
+
     def add_project(self, project_name, context):
         if project_name in self.projects:
             return self.projects[project_name].current_dir == context.current_dir
         else:
             self.projects[project_name] = context
             return False
+
+    def addDependency(self, key, source, parent_context, context):
+        if source in self.dependency_sources:
+            (other_key, other_parent_dir) = self.dependency_sources[source]
+            if other_key != key:
+                raise Exception("Dependency conflict: %s is required differently by %s (%s) and %s (%s)" %
+                                (source, other_parent_dir, other_key, parent_context.current_dir, key))
+        else:
+            self.dependency_sources[source] = (key, parent_context.current_dir)
+
+        self.dependencies[key] = context
+##############################################################################
+
+
+
+##############################################################################
+# Dependency identity
+#
+# A dependency is identified by where its sources come from and how it's
+# built, so that wherever in the graph it's required from, it resolves to a
+# single context: fetched, processed and built once. The same sources
+# required with other settings (like a cmake package with another search
+# path, or a repository at another branch) are reported as a conflict,
+# rather than silently getting whichever came first.
+##############################################################################
+# Keys of dependency infos telling where the sources are, or which of their
+# targets is used, rather than how they're built (the name of cmake packages
+# names their only target, so it counts)
+dependency_location_keys = [ "name", "path", "repository", "branch", "commit", "cmake",
+                             "archive", "archive_file_name", "archive_path" ]
+
+def dependencySource(parent_context, info):
+    if 'repository' in info:
+        url = info['repository'].rstrip('/')
+        if url.endswith('.git'):
+            url = url[:-4]
+        return "repository " + url
+    elif 'path' in info:
+        return "path " + os.path.realpath(pjoin(parent_context.current_dir, info['path']))
+    elif 'cmake' in info:
+        return "cmake package " + info['cmake']
+    elif 'archive' in info:
+        return "archive %s (%s)" % (info['archive'], info.get('archive_path', ''))
+
+    return "path " + os.path.realpath(parent_context.current_dir)
+
+def dependencyKey(parent_context, info):
+    settings = dict((key, value) for (key, value) in info.iteritems()
+                    if key not in dependency_location_keys)
+
+    if 'cmake' in info:
+        settings['name'] = info.get('name', info['cmake'])
+
+    if 'search_path' in settings:
+        settings['search_path'] = os.path.normpath(pjoin(parent_context.current_dir, settings['search_path']))
+
+    if 'repository' in info:
+        settings['revision'] = info.get('commit') or info.get('branch')
+
+    return "%s %s" % (dependencySource(parent_context, info), json.dumps(settings, sort_keys=True))
 ##############################################################################
 
 
@@ -29,17 +98,25 @@ context_cache = {}
 
 def getContext(parent_context, info):
     directory = None
+    source = None
+
+    key = None
+    if info and parent_context:
+        key = dependencyKey(parent_context, info)
+        if key in parent_context.global_context.dependencies:
+            return parent_context.global_context.dependencies[key]
 
     if info:
         if 'repository' in info:
             if not parent_context:
                 raise Exception("Crab origin can't be a repository type build")
-            directory = clone_repo(info['repository'],
-                                   info.get('branch'),
-                                   info.get('commit'),
-                                   os.path.abspath(pjoin(parent_context.current_dir,
-                                                         libraries_folder_relative_path)),
-                                   crabsys_config["update_dependencies"])
+            directory = fetchRepositoryDependency(parent_context, info)
+            source = { "repository": info['repository'], "directory": directory }
+
+            # Locked builds don't even ask git which commit is checked out
+            if crabsys_config["locked"]:
+                source["commit"] = currentLockfile().entry(directory, info['repository'],
+                                                           repositoryPin(info))["commit"]
         elif 'path' in info:
             if parent_context:
                 directory = pjoin(parent_context.current_dir, info["path"])
@@ -55,10 +132,11 @@ def getContext(parent_context, info):
         elif 'archive' in info:
             if not parent_context:
                 raise Exception("Crab origin can't be a archive type build")
-            directory = retrieve_archive(info.get('archive'),
-                                         info.get('archive_file_name'),
-                                         parent_context.libs_dir)
+            directory = fetchArchiveDependency(parent_context, info)
             directory = pjoin(directory, info.get('archive_path', ''))
+            source = { "archive": get_archive_file_path(info.get('archive'),
+                                                        info.get('archive_file_name'),
+                                                        parent_context.libs_dir) }
 
     if not directory:
         directory = "."
@@ -66,9 +144,21 @@ def getContext(parent_context, info):
     context_dir = os.path.abspath(directory)
 
     if context_dir in context_cache:
-        return context_cache[context_dir]
+        context = context_cache[context_dir]
+
+        if key and context.dependency_key and context.dependency_key != key:
+            raise Exception("Dependency conflict: %s is required as %s and as %s" %
+                            (context_dir, context.dependency_key, key))
     else:
-        return Context(parent_context=parent_context, info=info, directory=context_dir)
+        with traceSpan(context_dir, "context"):
+            context = Context(parent_context=parent_context, info=info, directory=context_dir,
+                              source=source, dependency_key=key)
+
+    if key:
+        parent_context.global_context.addDependency(key, dependencySource(parent_context, info),
+                                                    parent_context, context)
+
+    return context
 ##############################################################################
 ##############################################################################
 
@@ -76,9 +166,13 @@ def getContext(parent_context, info):
 
 ##############################################################################
 class Context:
-    def __init__(self, parent_context=None, info=None, directory=None):
+    def __init__(self, parent_context=None, info=None, directory=None, source=None, dependency_key=None):
         self.parent_context = parent_context
         self.current_dir = os.path.abspath(directory)
+        self.dependency_key = dependency_key
+
+        self.source = source
+        self.source_identity = None
 
         self.getContext = getContext
 
@@ -132,6 +226,8 @@ class Context:
         if self.parent_context:
             self.parent_context.addChildContext(self)
 
+        self.file_index = FileIndex(pjoin(self.build_folder, 'file_index.json'))
+
         self.sources_lists_names = {}
         self.sources_lists = []
         if 'sources_lists' in self.build_info:
@@ -141,12 +237,16 @@ class Context:
                 if 'name' in sources_list:
                     self.sources_lists_names[sources_list['name']] = index
                 if 'sources' in sources_list:
-                    sources_list["sources"] = processListOfFiles(sources_list["sources"], self.current_dir)
+                    sources_list["sources"] = processListOfFiles(sources_list["sources"],
+                                                                  self.current_dir,
+                                                                  self.file_index)
 
         self.targets = [
             createTarget(info, self)
             for info in self.build_info.get("targets", [self.build_info]) ]
 
+        self.file_index.save()
+
     def getTarget(self, target_name):
         for t in self.targets:
             if t.name == target_name:
@@ -160,13 +260,28 @@ class Context:
         if self.crab_file_path:
             if os.path.isfile(self.crab_file_path):
                 # Read crab file and parse as json
-                self.build_info = json.loads(get_file_content(self.crab_file_path))
+                with traceSpan(self.crab_file_path, "parse"):
+                    self.build_info = json.loads(get_file_content(self.crab_file_path))
             else:
                 print "crab.json file not found - setting to default build"
                 self.build_info = copy.deepcopy(crabsys_config["default_build"])
         else:
             self.build_info = build_info
 
+    def getSourceIdentity(self):
+        """Identifies the exact sources of an archive or repository context
+        (None for any other kind), so their builds can be shared."""
+        if self.source_identity is None and self.source:
+            if "archive" in self.source:
+                self.source_identity = "archive:" + file_sha256(self.source["archive"])
+            elif "repository" in self.source:
+                commit = self.source.get("commit")
+                if commit is None:
+                    commit = git_head_commit(self.source["directory"])
+                self.source_identity = "git:%s@%s" % (self.source["repository"], commit)
+
+        return self.source_identity
+
     def addChildContext(self, context):
         self.children.append(context)
 
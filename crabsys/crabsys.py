@@ -1,25 +1,47 @@
 #!/usr/bin/env python
 
-import argparse
+import sys
 import os.path
 
-from context import Context
-from config import loadConfiguration
+# Everything else is imported by the actions needing it: crab runs often,
+# many times just to ask the build daemon (or for its version)
+from constants import crabsys_version
 
 
 #############################################################################
 def parseArguments():
+    import argparse
+
     parser = argparse.ArgumentParser(description='C/C++ Recursive Automated Build System')
     parser.add_argument('--update-dependencies', action='store_true', dest='update_dependencies', default=None,
                         help='Update all repository dependencies before building')
     parser.add_argument('--dont-update-dependencies', action='store_false', dest='update_dependencies', default=None,
                         help='DO NOT update any repository dependencies before building')
+    parser.add_argument('--locked', action='store_true', dest='locked', default=False,
+                        help='Trust crab.lock and existing dependency checkouts, without any git or network operation')
     parser.add_argument('--config', metavar='CONFIG', action='store', dest='config_file_path',
                         help='Configuration file path')
+    parser.add_argument('-j', '--jobs', metavar='N', type=int, action='store', dest='jobs', default=None,
+                        help='Number of targets processed/built concurrently (defaults to the number of CPUs)')
+    parser.add_argument('-l', '--load-average', metavar='LOAD', type=float, action='store', dest='load_average', default=None,
+                        help="Don't start new commands while the system load average is above LOAD")
+    parser.add_argument('--trace', metavar='FILE', action='store', dest='trace_file_path', default=None,
+                        help='Write a timing trace of the build (Chrome trace event format) to FILE')
+    parser.add_argument('--report', action='store_true', dest='report', default=False,
+                        help='Print the critical path, per target and slowest commands timings after building (also saved as build/.build/build_report.json)')
+    parser.add_argument('--no-daemon', action='store_false', dest='use_daemon', default=True,
+                        help="Build in this process even when a build daemon is running for the workspace")
     parser.add_argument('--path', metavar='PATH', action='store', dest='path', default='.',
                         help='Path of where the processing should start')
+    parser.add_argument('--cache-dir', metavar='DIR', action='store', dest='cache_dir', default='~/.crabsys/served-cache',
+                        help='Folder served by the cache-server action')
+    parser.add_argument('--bind', metavar='ADDRESS', action='store', dest='bind', default='127.0.0.1',
+                        help='Address the cache-server action listens on')
+    parser.add_argument('--port', metavar='PORT', type=int, action='store', dest='port', default=8642,
+                        help='Port the cache-server action listens on')
+    parser.add_argument('--version', action='version', version='crabsys ' + crabsys_version)
     parser.add_argument('action', default='build', nargs='?',
-                        help='Crabsys action (only build is supported for now)')
+                        help='Crabsys action: build, watch (build again on every change), update (refresh dependencies and crab.lock), daemon (start a build daemon for the workspace), daemon-stop, status or cache-server')
 
     args = parser.parse_args()
 
@@ -27,21 +49,147 @@ def parseArguments():
 
     return args
 
+def build(path, locked, report=False, context=None):
+    """Builds the project at path, returning its root context. Reuses the
+    graph of context when given one (still up to date)."""
+    from lockfile import loadLockfile
+    from build_state import loadBuildState
+    from graph_cache import loadRootContext, saveGraphCache
+    from scheduler import buildTargets
+    from tracing import traceSpan, traceEvents
+    from report import BuildReport
+    from compiler_cache import compilerCacheStatistics, compilerCacheSummary
+
+    lockfile = loadLockfile(path)
+    build_state = loadBuildState(path)
+
+    build_report = None
+    if report:
+        build_report = BuildReport(path)
+
+    reused = context is not None
+    if not reused:
+        context = loadRootContext(path)
+
+    compiler_cache_statistics = compilerCacheStatistics()
+
+    try:
+        buildTargets(context.targets, report=build_report)
+    finally:
+        # Keeps what was built before a failure up to date
+        build_state.save()
+
+    compiler_cache = compilerCacheSummary(compiler_cache_statistics, compilerCacheStatistics())
+    if compiler_cache:
+        print "Compiler cache (%s): %d hits, %d misses - %.1f%% hit rate" % (
+            compiler_cache["launcher"], compiler_cache["hits"],
+            compiler_cache["misses"], compiler_cache["hit_rate"])
+
+    if not locked:
+        lockfile.save()
+
+    if not reused:
+        with traceSpan("save graph cache", "graph"):
+            saveGraphCache(context)
+
+    if build_report:
+        summary = build_report.summary(traceEvents())
+        summary["compiler_cache"] = compiler_cache
+        build_report.printSummary(summary)
+        print "Report saved to %s" % (build_report.save(summary))
+
+    return context
+
 def main():
+    # Not even worth parsing arguments
+    if sys.argv[1:] == ['--version']:
+        print "crabsys " + crabsys_version
+        return
+
     args = parseArguments()
 
     args_config = {}
     if args.update_dependencies:
         args_config["update_dependencies"] = args.update_dependencies
+    if args.jobs:
+        args_config["jobs"] = args.jobs
+    if args.load_average:
+        args_config["load_average"] = args.load_average
+    if args.locked:
+        args_config["locked"] = True
+    if args.action == 'update':
+        args_config["update_dependencies"] = True
+
+    if args.locked and args_config.get("update_dependencies"):
+        print "--locked can't be used while updating dependencies"
+        exit(1)
+
+    path = os.path.abspath(args.path)
+
+    if args.action in ['build', 'status'] and args.use_daemon:
+        from daemon import requestDaemon, buildEnvironment
+
+        trace_file_path = None
+        if args.trace_file_path:
+            trace_file_path = os.path.abspath(args.trace_file_path)
+
+        exit_code = requestDaemon(path, {
+            "action": args.action,
+            "cwd": os.getcwd(),
+            "environment": buildEnvironment(),
+            "config_file_path": args.config_file_path,
+            "config": args_config,
+            "locked": args.locked,
+            "report": args.report,
+            "trace": trace_file_path
+        })
+        if exit_code is not None:
+            exit(exit_code)
 
-    loadConfiguration(args.config_file_path, args_config)
+        if args.action == 'status':
+            print "No build daemon running for %s" % (path)
+            return
+
+    from config import loadConfiguration
+    from tracing import startTrace, traceSpan, saveTrace
+
+    tracing = args.action == 'build' and (args.trace_file_path or args.report)
+    if tracing:
+        startTrace()
+
+    with traceSpan("load configuration", "config"):
+        loadConfiguration(args.config_file_path, args_config)
 
     if args.action == 'build':
-        context = Context(directory=os.path.abspath(args.path))
+        try:
+            build(path, args.locked, args.report)
+        finally:
+            if args.trace_file_path:
+                saveTrace(args.trace_file_path)
+    elif args.action == 'update':
+        from lockfile import loadLockfile
+        from context import Context
+        from scheduler import collectTargets
+
+        lockfile = loadLockfile(path)
+        lockfile.clear()
+
+        context = Context(directory=path)
+        collectTargets(context.targets)
 
-        for target in context.targets:
-            target.process()
-            target.build()
+        lockfile.save()
+    elif args.action == 'watch':
+        from watch import watch
+        watch(path, args.locked)
+    elif args.action == 'daemon':
+        from daemon import startDaemon
+        startDaemon(path, args.config_file_path, build)
+    elif args.action == 'daemon-stop':
+        from daemon import stopDaemon
+        stopDaemon(path)
+    elif args.action == 'cache-server':
+        from cache_server import runCacheServer
+        runCacheServer(args.cache_dir, args.port, args.bind)
     else:
         print "Action not supported: %s" % (args.action)
 #############################################################################
@@ -0,0 +1,388 @@
+import os
+import sys
+import copy
+import json
+import time
+import errno
+import socket
+import hashlib
+import threading
+import traceback
+
+from os.path import join as pjoin
+from constants import build_folder_relative_path, build_environment_variables, build_environment_prefixes
+
+
+
+##############################################################################
+# Build daemon
+#
+# 'crab daemon' starts a background process for a workspace, which keeps the
+# configuration and the processed build graph (contexts, targets, their file
+# indexes) in memory between builds. 'crab build' and 'crab status' find it
+# through its Unix socket and just forward the request, streaming the output
+# back, instead of loading everything again. Only what the client needs is
+# imported up front.
+#
+# The graph is reused as long as none of the build graph cache inputs (crab
+# files, globbed folders, configuration) changed, and loaded again
+# otherwise. Configuration files are read again when they change. Clients
+# in another folder, or with another build environment (compilers, flags,
+# PATH, compiler cache settings), build in their own process instead.
+#
+# The daemon exits after being idle for a while, or on 'crab daemon-stop'.
+##############################################################################
+daemon_socket_file_name = 'daemon.sock'
+daemon_log_file_name = 'daemon.log'
+
+# Seconds
+idle_timeout = 3*60*60
+
+# Unix socket paths longer than this don't fit in sockaddr_un
+socket_path_max_length = 100
+
+
+def daemonSocketPath(path):
+    socket_path = pjoin(path, build_folder_relative_path, daemon_socket_file_name)
+    if len(socket_path) > socket_path_max_length:
+        import tempfile
+        socket_path = pjoin(tempfile.gettempdir(), "crabsys-%s.sock" % (hashlib.sha1(path).hexdigest()[:16]))
+
+    return socket_path
+
+
+def buildEnvironment():
+    """The part of the environment builds depend on."""
+    return dict((name, value) for (name, value) in os.environ.items()
+                if name in build_environment_variables or name.startswith(build_environment_prefixes))
+
+
+def connectDaemon(path):
+    """A connection to the daemon of the workspace at path, or None when
+    there's none running."""
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(daemonSocketPath(path))
+    except socket.error as e:
+        connection.close()
+        if e.errno in (errno.ENOENT, errno.ECONNREFUSED):
+            return None
+        raise
+
+    return connection
+##############################################################################
+
+
+
+##############################################################################
+# Client
+def sendMessage(connection, message):
+    connection.sendall(json.dumps(message) + "\n")
+
+
+def requestDaemon(path, request):
+    """Forwards request to the daemon of the workspace at path, printing its
+    output. Returns the exit code, or None when no daemon took it."""
+    connection = connectDaemon(path)
+    if connection is None:
+        return None
+
+    try:
+        sendMessage(connection, request)
+
+        for line in connection.makefile('r'):
+            message = json.loads(line)
+
+            if "output" in message:
+                sys.stdout.write(message["output"].encode('utf-8'))
+                sys.stdout.flush()
+            elif "exit" in message:
+                return message["exit"]
+            elif "fallback" in message:
+                print "Warning: %s, not using the build daemon" % (message["fallback"])
+                return None
+    finally:
+        connection.close()
+
+    print "Lost connection to the build daemon"
+    return 1
+##############################################################################
+
+
+
+##############################################################################
+# Daemon
+class ClientOutput:
+    """File-like object streaming whatever is written to it to a client."""
+    def __init__(self, connection):
+        self.connection = connection
+        self.lock = threading.Lock()
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.decode('utf-8', 'replace')
+
+        with self.lock:
+            try:
+                sendMessage(self.connection, { "output": data })
+            except socket.error:
+                # Gone, the build goes on anyway
+                pass
+
+    def flush(self):
+        pass
+
+
+class Daemon:
+    def __init__(self, path, config_file_path, build_function):
+        self.path = path
+        self.config_file_path = config_file_path
+        self.build_function = build_function
+
+        self.cwd = os.getcwd()
+        self.environment = buildEnvironment()
+        self.socket_path = daemonSocketPath(path)
+
+        self.build_lock = threading.Lock()
+        self.building = False
+        self.stopping = False
+
+        self.start_time = time.time()
+        self.last_request_time = self.start_time
+        self.builds = 0
+        self.last_build = None
+
+        self.config_files = None
+        self.base_config = None
+        self.root_context = None
+        self.graph_inputs = None
+
+    def loadConfiguration(self):
+        """Reads the configuration files again when any of them changed."""
+        from config import crabsys_config, loadConfiguration, resetConfiguration, configurationFiles
+        from utils import resolved_generator
+        from compiler_cache import resolved_launcher
+
+        config_files = dict((path, os.stat(path).st_mtime)
+                            for path in configurationFiles(self.config_file_path))
+        if config_files == self.config_files:
+            return
+
+        resetConfiguration()
+        loadConfiguration(self.config_file_path)
+
+        # Resolved from the configuration
+        del resolved_generator[:]
+        del resolved_launcher[:]
+
+        self.config_files = config_files
+        self.base_config = copy.deepcopy(crabsys_config)
+        self.root_context = None
+
+    def build(self, request):
+        from config import crabsys_config, mergeConfig
+        from tracing import startTrace, stopTrace, saveTrace
+        from graph_cache import graphInputs, graphChanged, reuseGraph
+        from fetch import resetFetched
+        import context as context_module
+
+        self.loadConfiguration()
+
+        # Options given to this request only
+        crabsys_config.clear()
+        crabsys_config.update(copy.deepcopy(self.base_config))
+        mergeConfig(request.get("config", {}))
+
+        if request.get("trace") or request.get("report"):
+            startTrace()
+
+        start_time = time.time()
+        try:
+            if self.root_context is not None and graphChanged(self.graph_inputs):
+                self.root_context = None
+
+            resetFetched()
+            if self.root_context is None:
+                context_module.context_cache.clear()
+            else:
+                reuseGraph(self.root_context)
+
+            root_context = self.root_context
+            self.root_context = None
+
+            self.root_context = self.build_function(self.path, request.get("locked", False),
+                                                    request.get("report", False), root_context)
+            # Crab files are hashed as they were when built
+            self.graph_inputs = graphInputs(self.root_context)
+            self.last_build = { "succeeded": True, "time": time.time() - start_time }
+        except:
+            self.last_build = { "succeeded": False, "time": time.time() - start_time }
+            raise
+        finally:
+            if request.get("trace"):
+                saveTrace(request["trace"])
+            stopTrace()
+
+            self.builds += 1
+
+    def status(self):
+        lines = [ "Build daemon for %s (pid %d), up for %d seconds, %d builds served" %
+                  (self.path, os.getpid(), time.time() - self.start_time, self.builds) ]
+
+        if self.building:
+            lines.append("Building now")
+
+        if self.root_context is not None:
+            from graph_cache import allContexts
+            contexts = allContexts(self.root_context)
+            lines.append("Build graph loaded: %d projects, %d targets" %
+                         (len(contexts), sum(len(context.targets) for context in contexts)))
+        else:
+            lines.append("Build graph not loaded")
+
+        if self.last_build:
+            lines.append("Last build %s in %f seconds" %
+                         ("succeeded" if self.last_build["succeeded"] else "failed", self.last_build["time"]))
+
+        return '\n'.join(lines) + '\n'
+
+    def handle(self, connection):
+        try:
+            request = json.loads(connection.makefile('r').readline())
+            self.last_request_time = time.time()
+
+            if request["action"] == "status":
+                sendMessage(connection, { "output": self.status() })
+                sendMessage(connection, { "exit": 0 })
+            elif request["action"] == "stop":
+                with self.build_lock:
+                    sendMessage(connection, { "output": "Build daemon stopped\n" })
+                    sendMessage(connection, { "exit": 0 })
+                    self.stop()
+            elif request["action"] == "build":
+                # Relative configuration files are found from the current
+                # folder
+                if request.get("cwd") != self.cwd or request.get("config_file_path") != self.config_file_path:
+                    sendMessage(connection, { "fallback": "build daemon started from another folder or configuration" })
+                    return
+
+                # The daemon builds with its own environment
+                if request.get("environment") != self.environment:
+                    sendMessage(connection, { "fallback": "build daemon started with another environment" })
+                    return
+
+                with self.build_lock:
+                    exit_code = self.serveBuild(connection, request)
+                sendMessage(connection, { "exit": exit_code })
+            else:
+                sendMessage(connection, { "fallback": "action not supported by the build daemon" })
+        except socket.error:
+            pass
+        finally:
+            self.last_request_time = time.time()
+            connection.close()
+
+    def serveBuild(self, connection, request):
+        output = ClientOutput(connection)
+        (stdout, stderr) = (sys.stdout, sys.stderr)
+        (sys.stdout, sys.stderr) = (output, output)
+
+        self.building = True
+        try:
+            self.build(request)
+            return 0
+        except Exception:
+            traceback.print_exc(file=output)
+            return 1
+        finally:
+            self.building = False
+            (sys.stdout, sys.stderr) = (stdout, stderr)
+
+    def stop(self):
+        self.stopping = True
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+    def serve(self, listening_socket):
+        listening_socket.settimeout(1.0)
+
+        while not self.stopping:
+            try:
+                (connection, address) = listening_socket.accept()
+            except socket.timeout:
+                if time.time() - self.last_request_time > idle_timeout and not self.building:
+                    with self.build_lock:
+                        self.stop()
+                continue
+
+            connection.settimeout(None)
+
+            thread = threading.Thread(target=self.handle, args=(connection,))
+            thread.daemon = True
+            thread.start()
+
+        listening_socket.close()
+
+
+def listen(socket_path):
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    listening_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listening_socket.bind(socket_path)
+    listening_socket.listen(16)
+
+    return listening_socket
+
+
+def startDaemon(path, config_file_path, build_function):
+    """Starts the daemon of the workspace at path in the background, unless
+    one is already running."""
+    from utils import mkdir_p
+
+    connection = connectDaemon(path)
+    if connection is not None:
+        connection.close()
+        print "A build daemon is already running for %s" % (path)
+        return
+
+    daemon = Daemon(path, config_file_path, build_function)
+    mkdir_p(os.path.dirname(daemon.socket_path))
+
+    # Listening before forking, so requests made right after are served
+    listening_socket = listen(daemon.socket_path)
+
+    pid = os.fork()
+    if pid != 0:
+        listening_socket.close()
+        os.waitpid(pid, 0)
+        print "Build daemon started for %s (output in %s)" % (path, pjoin(path, build_folder_relative_path, daemon_log_file_name))
+        return
+
+    # Detached from the terminal and the caller's session
+    os.setsid()
+    if os.fork() != 0:
+        os._exit(0)
+
+    log_file_path = pjoin(path, build_folder_relative_path, daemon_log_file_name)
+    log_file = os.open(log_file_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0644)
+    null_file = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(null_file, 0)
+    os.dup2(log_file, 1)
+    os.dup2(log_file, 2)
+
+    try:
+        daemon.loadConfiguration()
+        daemon.serve(listening_socket)
+    except Exception:
+        traceback.print_exc()
+    finally:
+        daemon.stop()
+        os._exit(0)
+
+
+def stopDaemon(path):
+    exit_code = requestDaemon(path, { "action": "stop" })
+    if exit_code is None:
+        print "No build daemon running for %s" % (path)
+##############################################################################
@@ -0,0 +1,284 @@
+import os
+import glob
+import shutil
+import tarfile
+import hashlib
+import urllib2
+import threading
+
+from os.path import join as pjoin
+from config import crabsys_config
+from utils import *
+from lockfile import currentLockfile, lock_file_name
+from tracing import traceSpan
+
+
+
+##############################################################################
+# Dependency sources fetching
+#
+# Archives and repositories are fetched at most once per run, whether by the
+# concurrent prefetch of a whole level of the dependency graph or by the
+# context creation that needs them. Both go through fetchOnce.
+##############################################################################
+fetched = {}
+fetch_locks = {}
+fetch_locks_lock = threading.Lock()
+
+def fetchOnce(key, function):
+    with fetch_locks_lock:
+        if key not in fetch_locks:
+            fetch_locks[key] = threading.Lock()
+        key_lock = fetch_locks[key]
+
+    with key_lock:
+        if key not in fetched:
+            fetched[key] = function()
+        return fetched[key]
+
+
+def resetFetched():
+    """Forgets what was fetched, for another run in the same process (e.g.
+    the build daemon), which may have to update it."""
+    with fetch_locks_lock:
+        fetched.clear()
+        fetch_locks.clear()
+
+
+def fetchArchiveDependency(parent_context, info):
+    archive_file_path = get_archive_file_path(info.get('archive'),
+                                              info.get('archive_file_name'),
+                                              parent_context.libs_dir)
+
+    return fetchOnce(("archive", archive_file_path),
+        lambda: resolveArchive(info, parent_context.libs_dir, archive_file_path))
+
+
+def resolveArchive(info, libs_dir, archive_file_path):
+    with traceSpan(info['archive'], "fetch"):
+        return resolveArchiveSource(info, libs_dir, archive_file_path)
+
+def resolveArchiveSource(info, libs_dir, archive_file_path):
+    url = info['archive']
+    extracted_dir = archive_file_path + "_extracted"
+
+    lockfile = currentLockfile()
+    entry = lockfile and lockfile.entry(extracted_dir, url)
+
+    if crabsys_config["locked"]:
+        if entry is None:
+            raise Exception("Archive %s is not in %s, run 'crab update'" % (url, lock_file_name))
+        if not os.path.isdir(extracted_dir):
+            raise Exception("Archive %s isn't extracted in %s, build once without --locked" %
+                            (url, extracted_dir))
+        return extracted_dir
+
+    expected_sha256 = info.get('sha256')
+    if expected_sha256 is None and entry:
+        expected_sha256 = entry["sha256"]
+
+    extracted_dir = retrieve_archive(url, info.get('archive_file_name'), libs_dir, expected_sha256)
+
+    if lockfile and not crabsys_config["locked"]:
+        if entry is None or crabsys_config["update_dependencies"]:
+            if os.path.isfile(archive_file_path):
+                entry = { "url": url, "sha256": file_sha256(archive_file_path) }
+
+        if entry:
+            lockfile.record(extracted_dir, entry)
+
+    return extracted_dir
+
+
+def fetchRepositoryDependency(parent_context, info):
+    destination_path = parent_context.libs_dir
+    repository_path = pjoin(destination_path,
+                            extract_repository_name_from_url(info['repository']))
+
+    return fetchOnce(("repository", repository_path),
+        lambda: resolveRepository(info, destination_path, repository_path))
+
+
+def repositoryPin(info):
+    """The branch or commit crab.json asks for, as recorded in crab.lock."""
+    return dict((key, info[key]) for key in ['branch', 'commit'] if info.get(key))
+
+
+def resolveRepository(info, destination_path, repository_path):
+    with traceSpan(info['repository'], "fetch"):
+        return resolveRepositorySource(info, destination_path, repository_path)
+
+def resolveRepositorySource(info, destination_path, repository_path):
+    url = info['repository']
+    branch = info.get('branch')
+    commit = info.get('commit')
+    pin = repositoryPin(info)
+
+    lockfile = currentLockfile()
+    entry = lockfile and lockfile.entry(repository_path, url, pin)
+
+    # The entry was written for another url, branch or commit
+    stale = entry is None and lockfile is not None and lockfile.hasEntry(repository_path)
+
+    if crabsys_config["locked"] and entry is None:
+        if stale:
+            raise Exception("Repository %s changed in crab.json since %s was written, run 'crab update'" %
+                            (url, lock_file_name))
+        raise Exception("Repository %s is not in %s, run 'crab update'" % (url, lock_file_name))
+
+    # Locked builds trust the checkout to be at the locked commit
+    if crabsys_config["locked"]:
+        if not os.path.isdir(repository_path):
+            raise Exception("Repository %s isn't checked out in %s, build once without --locked" %
+                            (url, repository_path))
+        return repository_path
+
+    # Checkouts follow the lock, unless it's being updated
+    if entry and not crabsys_config["update_dependencies"]:
+        branch = None
+        commit = entry["commit"]
+
+    mirrors_directory = crabsys_config.get("git_mirrors_directory")
+    if mirrors_directory:
+        mirrors_directory = os.path.expanduser(mirrors_directory)
+
+    # An existing checkout of a stale entry is still at the commit locked for
+    # the previous pin
+    repository_path = clone_repo(url, branch, commit, destination_path,
+                                 crabsys_config["update_dependencies"] or stale,
+                                 mirrors_directory)
+
+    if lockfile and not crabsys_config["locked"]:
+        if entry is None or crabsys_config["update_dependencies"]:
+            entry = { "url": url, "commit": git_head_commit(repository_path) }
+            if pin:
+                entry["pin"] = pin
+
+        lockfile.record(repository_path, entry)
+
+    return repository_path
+##############################################################################
+
+
+
+##############################################################################
+# Archives
+##############################################################################
+class TeeReader:
+    """Reads from source, copying everything read to destination and
+    hashing it along the way."""
+    def __init__(self, source, destination):
+        self.source = source
+        self.destination = destination
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.source.read(size)
+        self.destination.write(data)
+        self.digest.update(data)
+        return data
+
+    def drain(self):
+        while self.read(64*1024):
+            pass
+
+
+def extract_archive(fileobj, mode, destination):
+    archive = tarfile.open(fileobj=fileobj, mode=mode)
+    archive.extractall(path=destination, members=safemembers(archive, destination))
+    archive.close()
+
+
+class ChecksumMismatch(Exception):
+    pass
+
+def verify_sha256(archive_url, digest, expected_sha256):
+    if expected_sha256 and digest != expected_sha256.lower():
+        raise ChecksumMismatch("Archive %s doesn't match its sha256: expected %s, got %s" %
+                               (archive_url, expected_sha256, digest))
+
+
+def download_archive(archive_url, archive_file_path, extracted_dir, expected_sha256=None):
+    """Downloads archive_url to archive_file_path, extracting it while the
+    download is in flight. A partial download left by an earlier run is
+    resumed instead, and extracted once complete."""
+    partial_file_path = archive_file_path + '.part'
+    temporary_dir = "%s.tmp-%d" % (extracted_dir, os.getpid())
+
+    request = urllib2.Request(archive_url)
+
+    resume_offset = 0
+    if os.path.isfile(partial_file_path):
+        resume_offset = os.path.getsize(partial_file_path)
+        if resume_offset > 0:
+            request.add_header('Range', 'bytes=%d-' % (resume_offset))
+
+    try:
+        response = urllib2.urlopen(request)
+    except urllib2.HTTPError as e:
+        if e.code != 416:
+            raise
+
+        # The partial download doesn't fit the archive anymore
+        os.remove(partial_file_path)
+        return download_archive(archive_url, archive_file_path, extracted_dir, expected_sha256)
+
+    try:
+        if resume_offset > 0 and response.getcode() == 206:
+            with open(partial_file_path, 'ab') as partial_file:
+                TeeReader(response, partial_file).drain()
+
+            verify_sha256(archive_url, file_sha256(partial_file_path), expected_sha256)
+
+            with open(partial_file_path, 'rb') as archive_file:
+                extract_archive(archive_file, 'r:*', temporary_dir)
+        else:
+            with open(partial_file_path, 'wb') as partial_file:
+                stream = TeeReader(response, partial_file)
+                extract_archive(stream, 'r|*', temporary_dir)
+
+                # Whatever comes after the end of the tar stream
+                stream.drain()
+
+            verify_sha256(archive_url, stream.digest.hexdigest(), expected_sha256)
+    except ChecksumMismatch:
+        os.remove(partial_file_path)
+        shutil.rmtree(temporary_dir, ignore_errors=True)
+        raise
+    except:
+        shutil.rmtree(temporary_dir, ignore_errors=True)
+        raise
+    finally:
+        response.close()
+
+    os.rename(partial_file_path, archive_file_path)
+    os.rename(temporary_dir, extracted_dir)
+
+
+def retrieve_archive(archive_url, file_name, directory, expected_sha256=None):
+    archive_file_path = get_archive_file_path(archive_url, file_name, directory)
+    extracted_dir = pjoin(directory, archive_file_path+"_extracted")
+
+    # Extraction always happens in a temporary folder renamed when complete,
+    # so extracted_dir is either missing or whole
+    if os.path.isdir(extracted_dir):
+        return extracted_dir
+
+    mkdir_p(directory)
+
+    for leftover in glob.glob(extracted_dir + '.tmp-*'):
+        shutil.rmtree(leftover)
+
+    if os.path.isfile(archive_file_path):
+        verify_sha256(archive_url, file_sha256(archive_file_path), expected_sha256)
+
+        temporary_dir = "%s.tmp-%d" % (extracted_dir, os.getpid())
+        with open(archive_file_path, 'rb') as archive_file:
+            extract_archive(archive_file, 'r:*', temporary_dir)
+        os.rename(temporary_dir, extracted_dir)
+    else:
+        log("Downloading %s" % (archive_url))
+        download_archive(archive_url, archive_file_path, extracted_dir, expected_sha256)
+
+    return extracted_dir
+##############################################################################
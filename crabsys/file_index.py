@@ -0,0 +1,221 @@
+import os
+import re
+import json
+import time
+import fnmatch
+
+from os.path import join as pjoin
+from utils import get_file_content, mkdir_p
+
+
+
+##############################################################################
+# File index
+#
+# Caches the listing of every directory a glob had to look into, keyed on the
+# directory's modification time, so unchanged directories are never listed
+# again. Adding, removing or renaming an entry always updates the mtime of
+# the directory holding it.
+#
+# Globs support '**' (any number of directories) and exclude patterns.
+##############################################################################
+magic_check = re.compile('[*?[]')
+
+def has_magic(pattern):
+    return magic_check.search(pattern) is not None
+
+
+def translate_glob(pattern):
+    """Translates a glob pattern (with '**' support) into a regular expression
+    matching paths relative to the same folder."""
+    regex = ''
+    index = 0
+
+    while index < len(pattern):
+        if pattern.startswith('**/', index):
+            regex += '(?:.*/)?'
+            index += 3
+        elif pattern.startswith('**', index):
+            regex += '.*'
+            index += 2
+        elif pattern[index] == '*':
+            regex += '[^/]*'
+            index += 1
+        elif pattern[index] == '?':
+            regex += '[^/]'
+            index += 1
+        elif pattern[index] == '[' and pattern.find(']', index+2) != -1:
+            end = pattern.find(']', index+2)
+            characters = pattern[index+1:end].replace('\\', '\\\\')
+            if characters.startswith('!'):
+                characters = '^' + characters[1:]
+            regex += '[' + characters + ']'
+            index = end + 1
+        else:
+            regex += re.escape(pattern[index])
+            index += 1
+
+    return re.compile(regex + r'\Z')
+
+
+def encode_strings(dictionary):
+    # Paths are kept as plain strings, like the ones os.listdir returns
+    def encode(value):
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        if isinstance(value, list):
+            return [encode(item) for item in value]
+        return value
+
+    return dict((encode(key), encode(value)) for (key, value) in dictionary.iteritems())
+
+
+def matches_any(relative_path, patterns):
+    """Whether relative_path, or its file name, matches any of the patterns
+    compiled by translate_glob."""
+    for pattern in patterns:
+        if pattern.match(relative_path) or pattern.match(os.path.basename(relative_path)):
+            return True
+    return False
+
+
+class FileIndex:
+    # Listings of directories modified this close to the scan are not trusted:
+    # another change within the mtime resolution would go unnoticed
+    racy_interval = 2.0
+
+    def __init__(self, path=None):
+        self.path = path
+        self.listings = {}
+        self.dirty = False
+
+        # Directories looked into by this index, with their mtimes
+        self.visited = {}
+
+        # Directories listed by this run, whose listings are current
+        self.listed = set()
+
+        if path and os.path.isfile(path):
+            try:
+                self.listings = json.loads(get_file_content(path), object_hook=encode_strings)
+            except ValueError:
+                self.listings = {}
+
+    def __getstate__(self):
+        # Listings are only needed while globbing, and have their own file
+        return { "path": self.path, "visited": self.visited }
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.path = state["path"]
+        self.visited = state["visited"]
+
+    def listDirectory(self, directory):
+        """Returns (files, subdirectories) of directory."""
+        try:
+            mtime = os.stat(directory).st_mtime
+        except OSError:
+            self.visited[directory] = None
+            return ([], [])
+
+        self.visited[directory] = mtime
+
+        listing = self.listings.get(directory)
+        if listing and listing["mtime"] == mtime and (listing["trusted"] or directory in self.listed):
+            return (listing["files"], listing["directories"])
+
+        files = []
+        directories = []
+        for name in sorted(os.listdir(directory)):
+            if os.path.isdir(pjoin(directory, name)):
+                directories.append(name)
+            else:
+                files.append(name)
+
+        self.listings[directory] = {
+            "mtime": mtime,
+            "trusted": time.time() - mtime > self.racy_interval,
+            "files": files,
+            "directories": directories
+        }
+        self.listed.add(directory)
+        self.dirty = True
+
+        return (files, directories)
+
+    def glob(self, pattern, excludes=None):
+        """Returns the sorted paths matching pattern (which must be
+        absolute), minus those matching any of the exclude patterns (relative
+        to the pattern's non-magic prefix)."""
+        components = pattern.split('/')
+
+        prefix_length = 0
+        while prefix_length < len(components)-1 and not has_magic(components[prefix_length]):
+            prefix_length += 1
+        root = '/'.join(components[:prefix_length]) or '/'
+
+        results = []
+        self.match(root, components[prefix_length:], results)
+
+        if excludes:
+            excludes = [translate_glob(exclude) for exclude in excludes]
+            results = [ path for path in results
+                        if not self.excluded(os.path.relpath(path, root), excludes) ]
+
+        return sorted(set(results))
+
+    def excluded(self, relative_path, excludes):
+        return matches_any(relative_path, excludes)
+
+    def match(self, directory, components, results):
+        component = components[0]
+        remaining = components[1:]
+
+        if component in ['', '.'] and remaining:
+            self.match(directory, remaining, results)
+            return
+
+        if component == '**':
+            if remaining:
+                self.match(directory, remaining, results)
+
+            (files, directories) = self.listDirectory(directory)
+            for name in directories:
+                if not name.startswith('.'):
+                    self.match(pjoin(directory, name), components, results)
+
+            if not remaining:
+                results += [pjoin(directory, name) for name in files if not name.startswith('.')]
+            return
+
+        (files, directories) = self.listDirectory(directory)
+
+        if has_magic(component):
+            # Like glob, hidden entries only match explicitly hidden patterns
+            def matching(names):
+                return [ name for name in names
+                         if fnmatch.fnmatch(name, component) and
+                            (component.startswith('.') or not name.startswith('.')) ]
+        else:
+            def matching(names):
+                return [ name for name in names if name == component ]
+
+        if remaining:
+            for name in matching(directories):
+                self.match(pjoin(directory, name), remaining, results)
+        else:
+            results += [pjoin(directory, name) for name in matching(files + directories)]
+
+    def save(self):
+        if not self.path or not self.dirty:
+            return
+
+        mkdir_p(os.path.dirname(self.path))
+
+        temporary_path = "%s.tmp-%d" % (self.path, os.getpid())
+        with open(temporary_path, 'w') as index_file:
+            json.dump(self.listings, index_file)
+        os.rename(temporary_path, self.path)
+
+        self.dirty = False
+##############################################################################
@@ -0,0 +1,221 @@
+import os
+import sys
+import json
+import hashlib
+import cPickle as pickle
+
+from os.path import join as pjoin
+from config import crabsys_config
+from utils import *
+from target import CrabsysTarget, CMakeTarget
+from compiler_cache import compilerLauncher
+from tracing import traceSpan
+from lockfile import lock_file_name
+import context as context_module
+
+
+
+##############################################################################
+# Build graph cache
+#
+# After a successful build, the whole processed graph (contexts, targets and
+# their build steps) is pickled under the root build folder, preceded by a
+# description of every input it was derived from. When none of them changed,
+# the next run loads the graph and goes straight to the build phase, without
+# parsing crab files, globbing or running cmake.
+##############################################################################
+graph_cache_file_name = 'graph.cache'
+
+# Changed along with the attributes of the pickled classes, which caches
+# written before don't have
+graph_cache_format = 6
+
+# Options that change how a build runs, but not the graph itself
+runtime_config_keys = [ "jobs", "load_average", "update_dependencies", "locked", "watch" ]
+
+
+def file_hash(path):
+    if not os.path.isfile(path):
+        return None
+    return hashlib.sha1(get_file_content(path)).hexdigest()
+
+def directory_mtime(path):
+    if not os.path.isdir(path):
+        return None
+    return os.stat(path).st_mtime
+
+def config_hash():
+    config = dict((key, value) for (key, value) in crabsys_config.iteritems()
+                  if key not in runtime_config_keys)
+    return hashlib.sha1(json.dumps(config, sort_keys=True)).hexdigest()
+
+
+def allContexts(root_context):
+    contexts = []
+    visited = set()
+    pending = [root_context]
+
+    while pending:
+        context = pending.pop()
+        if context.current_dir in visited:
+            continue
+
+        visited.add(context.current_dir)
+        contexts.append(context)
+
+        pending += context.children
+        for target in context.targets:
+            pending += [dep.context for dep in target.dependencies + target.build_dependencies]
+
+    return contexts
+
+
+def graphInputs(root_context):
+    contexts = allContexts(root_context)
+
+    # Dependencies follow the lock, which may be edited to move them
+    lock_file_path = pjoin(root_context.current_dir, lock_file_name)
+    crab_files = { lock_file_path: file_hash(lock_file_path) }
+    directories = {}
+    required_paths = []
+    for context in contexts:
+        required_paths.append(context.current_dir)
+        directories.update(context.file_index.visited)
+
+        if context.build_type == "crabsys":
+            crab_files[context.crab_file_path] = file_hash(context.crab_file_path)
+
+        for target in context.targets:
+            if target.processed and isinstance(target, (CrabsysTarget, CMakeTarget)):
+                cmake_lists_file_path = pjoin(target.build_folder, 'CMakeLists.txt')
+                if os.path.isfile(cmake_lists_file_path):
+                    required_paths.append(cmake_lists_file_path)
+
+    return {
+        "version": crabsys_version,
+        "format": graph_cache_format,
+        "config": config_hash(),
+        "generator": cmake_generator(),
+        "compiler_launcher": compilerLauncher(),
+        "crab_files": crab_files,
+        "directories": directories,
+        "required_paths": required_paths
+    }
+
+
+def inputsChanged(inputs):
+    if inputs.get("version") != crabsys_version or inputs.get("format") != graph_cache_format:
+        return True
+
+    if inputs.get("config") != config_hash():
+        return True
+
+    # "auto" resolves differently once ninja (or ccache) is installed or
+    # removed
+    if inputs.get("generator") != cmake_generator():
+        return True
+    if inputs.get("compiler_launcher") != compilerLauncher():
+        return True
+
+    for (path, digest) in inputs.get("crab_files", {}).iteritems():
+        if file_hash(path) != digest:
+            return True
+
+    for (path, mtime) in inputs.get("directories", {}).iteritems():
+        if directory_mtime(path) != mtime:
+            return True
+
+    for path in inputs.get("required_paths", []):
+        if not os.path.exists(path):
+            return True
+
+    return False
+##############################################################################
+
+
+
+##############################################################################
+def graphCachePath(directory):
+    return pjoin(directory, build_folder_relative_path, graph_cache_file_name)
+
+
+def loadGraphCache(directory):
+    """Returns the cached root context for directory, or None when there is
+    no usable cache."""
+    cache_path = graphCachePath(directory)
+
+    if crabsys_config["update_dependencies"] or not os.path.isfile(cache_path):
+        return None
+
+    try:
+        with open(cache_path, 'rb') as cache_file:
+            inputs = pickle.load(cache_file)
+
+            if inputsChanged(inputs):
+                return None
+
+            root_context = pickle.load(cache_file)
+    except Exception as e:
+        print "Warning: ignoring unreadable build graph cache (%s)" % (e)
+        return None
+
+    reuseGraph(root_context)
+    return root_context
+
+
+def reuseGraph(root_context):
+    """Readies a graph built before (loaded from the cache or kept in
+    memory) for another build."""
+    # Its contexts take the place of the ones a fresh run would create
+    for context in allContexts(root_context):
+        context_module.context_cache[context.current_dir] = context
+
+        # Repositories may have been checked out at another revision since
+        context.source_identity = None
+
+        for target in context.targets:
+            target.built = False
+
+
+def graphChanged(inputs):
+    """Whether a graph built before, from inputs (as given by graphInputs
+    once built), is out of date."""
+    return crabsys_config["update_dependencies"] or inputsChanged(inputs)
+
+
+def loadRootContext(directory):
+    """The root context for directory, from the build graph cache when it's
+    usable."""
+    with traceSpan("load graph cache", "graph"):
+        root_context = loadGraphCache(directory)
+
+    if root_context is None:
+        with traceSpan("root context", "graph"):
+            root_context = context_module.Context(directory=directory)
+
+    return root_context
+
+
+def saveGraphCache(root_context):
+    cache_path = graphCachePath(root_context.current_dir)
+    temporary_path = cache_path + '.tmp'
+
+    mkdir_p(os.path.dirname(cache_path))
+
+    # Deep dependency chains make for deeply nested pickles
+    recursion_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(recursion_limit, 20000))
+
+    try:
+        with open(temporary_path, 'wb') as cache_file:
+            pickle.dump(graphInputs(root_context), cache_file, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(root_context, cache_file, pickle.HIGHEST_PROTOCOL)
+
+        os.rename(temporary_path, cache_path)
+    except Exception as e:
+        print "Warning: unable to save build graph cache (%s)" % (e)
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+    finally:
+        sys.setrecursionlimit(recursion_limit)
+##############################################################################
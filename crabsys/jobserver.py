@@ -0,0 +1,158 @@
+import os
+import re
+import time
+import errno
+import threading
+import subprocess
+from contextlib import contextmanager
+
+from tracing import traceSpan
+
+
+
+##############################################################################
+# GNU make compatible jobserver
+#
+# The pipe holds one token per job allowed to run at once. Crabsys takes a
+# token before spawning any command (that is the child's implicit job slot)
+# and every make started by that command shares the remaining tokens through
+# MAKEFLAGS, so the whole build never runs more than 'jobs' compilers.
+##############################################################################
+class Jobserver:
+    def __init__(self, jobs, load_average=None):
+        self.jobs = jobs
+        self.load_average = load_average
+
+        self.active = 0
+        self.lock = threading.Lock()
+
+        (self.read_fd, self.write_fd) = os.pipe()
+        os.write(self.write_fd, '+' * jobs)
+
+    def acquire(self):
+        self.waitForLoadAverage()
+
+        while True:
+            try:
+                token = os.read(self.read_fd, 1)
+                break
+            except OSError as e:
+                if e.errno != errno.EINTR:
+                    raise
+
+        with self.lock:
+            self.active += 1
+
+        return token
+
+    def release(self, token):
+        with self.lock:
+            self.active -= 1
+
+        os.write(self.write_fd, token)
+
+    def waitForLoadAverage(self):
+        if not self.load_average:
+            return
+
+        # Like make's -l, never stall when nothing of ours is running
+        while self.active > 0 and os.getloadavg()[0] > self.load_average:
+            time.sleep(0.5)
+
+    def makeflags(self):
+        flags = "-j%d %s=%d,%d" % (self.jobs, make_jobserver_option(),
+                                   self.read_fd, self.write_fd)
+
+        if self.load_average:
+            flags += " -l%s" % (self.load_average)
+
+        return flags
+
+    def close(self):
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+##############################################################################
+
+
+
+##############################################################################
+make_jobserver_option_cache = []
+
+def make_jobserver_option():
+    # GNU make < 4.2 (e.g. the 3.81 shipped with OS X) only knows the older
+    # --jobserver-fds spelling
+    if not make_jobserver_option_cache:
+        option = "--jobserver-auth"
+
+        try:
+            process = subprocess.Popen(['make', '--version'],
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE)
+            stdout = process.communicate()[0]
+            match = re.search(r'GNU Make (\d+)\.(\d+)', stdout)
+            if match and (int(match.group(1)), int(match.group(2))) < (4, 2):
+                option = "--jobserver-fds"
+        except OSError:
+            pass
+
+        make_jobserver_option_cache.append(option)
+
+    return make_jobserver_option_cache[0]
+##############################################################################
+
+
+
+##############################################################################
+jobserver = None
+
+def startJobserver(jobs, load_average=None):
+    global jobserver
+
+    stopJobserver()
+    jobserver = Jobserver(jobs, load_average)
+
+    return jobserver
+
+def stopJobserver():
+    global jobserver
+
+    if jobserver:
+        jobserver.close()
+        jobserver = None
+
+def jobserverRunning():
+    return jobserver is not None
+
+def jobserverJobs():
+    """The number of jobs the whole build may run at once."""
+    if jobserver:
+        return jobserver.jobs
+
+    import multiprocessing
+    return multiprocessing.cpu_count()
+
+@contextmanager
+def jobSlot():
+    server = jobserver
+    if server is None:
+        yield
+        return
+
+    with traceSpan("job slot", "wait"):
+        token = server.acquire()
+    try:
+        yield
+    finally:
+        server.release(token)
+
+def jobserverEnvironment(env=None):
+    """Returns a copy of env (or of os.environ) with MAKEFLAGS pointing at the
+    running jobserver."""
+    env = dict(os.environ if env is None else env)
+
+    if jobserver:
+        makeflags = env.get("MAKEFLAGS", "")
+        env["MAKEFLAGS"] = (makeflags + " " + jobserver.makeflags()).strip()
+
+    return env
+##############################################################################
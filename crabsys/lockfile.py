@@ -0,0 +1,91 @@
+import os
+import json
+import threading
+
+from os.path import join as pjoin
+from utils import get_file_content
+
+
+
+##############################################################################
+# crab.lock
+#
+# Records, for every repository and archive dependency in the graph, the
+# exact revision it resolved to: the commit of a repository, the sha256 of an
+# archive. Entries are keyed by the dependency's folder, relative to the
+# project root. Repository entries also keep the branch or commit crab.json
+# asked for when they were written (their "pin"): once crab.json asks for
+# another one, the entry is stale and the dependency is resolved again.
+#
+# Checkouts and downloads follow the lock: an existing checkout at another
+# commit is moved to the locked one (fetching it only when it's missing
+# locally). In locked mode, existing checkouts and extracted archives are
+# trusted as they are, without any git or network operation, and missing
+# ones are an error.
+##############################################################################
+lock_file_name = 'crab.lock'
+
+
+class Lockfile:
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        self.path = pjoin(root_dir, lock_file_name)
+        self.lock = threading.Lock()
+
+        self.entries = {}
+        if os.path.isfile(self.path):
+            self.entries = json.loads(get_file_content(self.path)).get("dependencies", {})
+
+        self.original_entries = dict(self.entries)
+
+    def key(self, directory):
+        return os.path.relpath(directory, self.root_dir)
+
+    def entry(self, directory, url, pin={}):
+        """Returns the entry for the dependency checked out at directory, as
+        long as it still refers to the same url and pin."""
+        with self.lock:
+            entry = self.entries.get(self.key(directory))
+
+        if entry and entry.get("url") == url and entry.get("pin", {}) == pin:
+            return entry
+        return None
+
+    def hasEntry(self, directory):
+        with self.lock:
+            return self.key(directory) in self.entries
+
+    def record(self, directory, entry):
+        with self.lock:
+            self.entries[self.key(directory)] = entry
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+
+    def save(self):
+        if self.entries == self.original_entries:
+            return
+
+        with open(self.path, 'w') as lock_file:
+            json.dump({ "dependencies": self.entries }, lock_file,
+                      indent=4, sort_keys=True, separators=(',', ': '))
+            lock_file.write('\n')
+
+        self.original_entries = dict(self.entries)
+##############################################################################
+
+
+
+##############################################################################
+lockfile = None
+
+def loadLockfile(root_dir):
+    global lockfile
+
+    lockfile = Lockfile(root_dir)
+    return lockfile
+
+def currentLockfile():
+    return lockfile
+##############################################################################
@@ -0,0 +1,163 @@
+import os
+import json
+
+from os.path import join as pjoin
+from utils import mkdir_p, build_folder_relative_path
+
+
+
+##############################################################################
+# Build report
+#
+# Aggregates the schedule of a build (when each target's tasks were ready,
+# started and finished) and its trace (every command spawned) into:
+#  - the critical path: the chain of dependent tasks (processing or building
+#    a target) with the most busy time, which bounds the build time however
+#    many cores there are
+#  - per target busy time (processing and building) versus time spent waiting
+#    for dependencies, or for a free worker once they were done
+#  - the slowest commands
+#  - the total time spent spawning commands
+##############################################################################
+build_report_file_name = 'build_report.json'
+
+slowest_commands_count = 10
+
+
+class BuildReport:
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        self.targets = []
+        self.tasks = []
+        self.start_time = None
+        self.end_time = None
+
+    def targetId(self, target):
+        return "%s (%s)" % (target.name, os.path.relpath(target.context.current_dir, self.root_dir))
+
+    def recordSchedule(self, scheduler, targets, process_tasks, build_tasks):
+        self.start_time = scheduler.start_time
+        self.end_time = scheduler.end_time
+
+        task_ids = {}
+        for target in targets:
+            task_ids[process_tasks[target]] = "process " + self.targetId(target)
+            task_ids[build_tasks[target]] = "build " + self.targetId(target)
+
+        # Tasks other than the targets' ones (like the superbuild's) go by
+        # their own names
+        self.tasks = [
+            { "id": task_ids.get(task, task.name),
+              "time": task.end_time - task.start_time,
+              "dependencies": [task_ids.get(dependency, dependency.name) for dependency in task.dependencies] }
+            for task in scheduler.tasks ]
+
+        self.targets = []
+        for target in targets:
+            process_task = process_tasks[target]
+            build_task = build_tasks[target]
+
+            self.targets.append({
+                "id": self.targetId(target),
+                "busy_time": (process_task.end_time - process_task.start_time) +
+                             (build_task.end_time - build_task.start_time),
+                "dependencies_wait_time": (process_task.ready_time - self.start_time) +
+                                          (build_task.ready_time - process_task.end_time),
+                "worker_wait_time": (process_task.start_time - process_task.ready_time) +
+                                    (build_task.start_time - build_task.ready_time),
+                "finished": build_task.end_time - self.start_time
+            })
+
+    def criticalPath(self):
+        """Returns the chain of tasks (dependencies first) with the highest
+        total time."""
+        tasks = dict((task["id"], task) for task in self.tasks)
+        chains = {}
+
+        def chain(task_id):
+            if task_id not in chains:
+                longest = []
+                for dependency in tasks[task_id]["dependencies"]:
+                    if chainTime(chain(dependency)) > chainTime(longest):
+                        longest = chain(dependency)
+
+                chains[task_id] = longest + [tasks[task_id]]
+
+            return chains[task_id]
+
+        def chainTime(chain):
+            return sum(task["time"] for task in chain)
+
+        critical_path = []
+        for task_id in tasks:
+            if chainTime(chain(task_id)) > chainTime(critical_path):
+                critical_path = chain(task_id)
+
+        return critical_path
+
+    def summary(self, trace_events):
+        commands = [ event for event in trace_events
+                     if event.get("ph") == "X" and event.get("cat") == "command" ]
+
+        slowest_commands = sorted(commands, key=lambda event: event["dur"], reverse=True)
+
+        critical_path = self.criticalPath()
+
+        return {
+            "total_time": self.end_time - self.start_time,
+            "critical_path": {
+                "time": sum(task["time"] for task in critical_path),
+                "tasks": [ { "task": task["id"], "time": task["time"] }
+                           for task in critical_path ]
+            },
+            "targets": self.targets,
+            "slowest_commands": [
+                { "command": ' '.join(event["args"].get("argv", [event["name"]])),
+                  "directory": event["args"].get("cwd"),
+                  "time": event["dur"] / 1000000.0,
+                  "cpu_time": event["args"].get("cpu_time") }
+                for event in slowest_commands[:slowest_commands_count] ],
+            "commands": {
+                "count": len(commands),
+                "time": sum(event["dur"] for event in commands) / 1000000.0,
+                "spawn_time": sum(event["args"].get("spawn_time", 0.0) for event in commands)
+            }
+        }
+
+    def printSummary(self, summary):
+        print ""
+        print "Build report - %f seconds" % (summary["total_time"])
+
+        print ""
+        print "Critical path - %f seconds:" % (summary["critical_path"]["time"])
+        for task in summary["critical_path"]["tasks"]:
+            print "    %10.3f  %s" % (task["time"], task["task"])
+
+        print ""
+        print "%-50s %10s %10s %10s" % ("Target", "Busy", "Deps wait", "Slot wait")
+        for entry in sorted(summary["targets"], key=lambda e: e["busy_time"], reverse=True):
+            print "%-50s %10.3f %10.3f %10.3f" % (entry["id"], entry["busy_time"],
+                                                   entry["dependencies_wait_time"],
+                                                   entry["worker_wait_time"])
+
+        print ""
+        print "Slowest commands:"
+        for command in summary["slowest_commands"]:
+            print "    %10.3f  %s (in %s)" % (command["time"], command["command"], command["directory"])
+
+        print ""
+        print "%d commands, %f seconds, %f seconds spawning them" % (summary["commands"]["count"],
+                                                                     summary["commands"]["time"],
+                                                                     summary["commands"]["spawn_time"])
+
+    def save(self, summary):
+        report_dir = pjoin(self.root_dir, build_folder_relative_path)
+        mkdir_p(report_dir)
+
+        report_file_path = pjoin(report_dir, build_report_file_name)
+        with open(report_file_path, 'w') as report_file:
+            json.dump(summary, report_file, indent=4, sort_keys=True, separators=(',', ': '))
+            report_file.write('\n')
+
+        return report_file_path
+##############################################################################
@@ -0,0 +1,309 @@
+import sys
+import time
+import threading
+import multiprocessing
+
+from config import crabsys_config
+from utils import cancel_running_commands, reset_cancelled_commands
+from jobserver import startJobserver, stopJobserver
+from fetch import fetchArchiveDependency, fetchRepositoryDependency
+from tracing import traceSpan
+from superbuild import Superbuild
+from context import dependencyKey
+
+
+
+##############################################################################
+def collectTargets(root_targets, jobs=None):
+    """Resolves the dependency graph reachable from root_targets and returns
+    every target in it exactly once, in topological order (dependencies
+    first)."""
+    # The graph is resolved breadth first, so the sources of all dependencies
+    # found at one level can be fetched concurrently before going deeper
+    frontier = list(root_targets)
+    discovered = set(frontier)
+
+    with traceSpan("resolve dependencies", "graph"):
+        while frontier:
+            prefetchDependencies([ (target.context, info)
+                                   for target in frontier if not target.resolved
+                                   for info in target.dependencies_infos + target.build_dependencies_infos ],
+                                 jobs)
+
+            next_frontier = []
+            for target in frontier:
+                target.resolveDependencies()
+
+                for dependency in target.dependencies + target.build_dependencies:
+                    if dependency not in discovered:
+                        discovered.add(dependency)
+                        next_frontier.append(dependency)
+
+            frontier = next_frontier
+
+    ordered = []
+    visited = set()
+    visiting = set()
+
+    def visit(target):
+        if target in visited:
+            return
+        if target in visiting:
+            raise Exception("Dependency cycle detected at target: %s" % (target.name))
+
+        visiting.add(target)
+
+        for dependency in target.dependencies + target.build_dependencies:
+            visit(dependency)
+
+        visiting.remove(target)
+        visited.add(target)
+        ordered.append(target)
+
+    for target in root_targets:
+        visit(target)
+
+    return ordered
+
+
+def prefetchDependencies(dependencies, jobs=None):
+    """Fetches the sources of every (parent_context, info) pair in
+    dependencies concurrently."""
+    scheduler = Scheduler(jobs)
+
+    # Dependencies required more than once (or already resolved) resolve to
+    # the sources fetched for the first requirement
+    keys = set()
+
+    for (parent_context, info) in dependencies:
+        key = dependencyKey(parent_context, info)
+        if key in keys or key in parent_context.global_context.dependencies:
+            continue
+        keys.add(key)
+
+        if 'repository' in info:
+            scheduler.addTask("fetch " + info['repository'],
+                (lambda p, i: lambda: fetchRepositoryDependency(p, i))(parent_context, info))
+        elif 'archive' in info:
+            scheduler.addTask("fetch " + info['archive'],
+                (lambda p, i: lambda: fetchArchiveDependency(p, i))(parent_context, info))
+
+    if scheduler.tasks:
+        scheduler.run()
+##############################################################################
+
+
+
+##############################################################################
+class Task:
+    def __init__(self, name, function):
+        self.name = name
+        self.function = function
+
+        self.dependencies = []
+        self.dependents = []
+        self.pending = 0
+
+        # When the task's dependencies were all done, when a worker picked it
+        # and when it finished
+        self.ready_time = None
+        self.start_time = None
+        self.end_time = None
+
+
+class Scheduler:
+    def __init__(self, jobs=None):
+        if not jobs:
+            jobs = multiprocessing.cpu_count()
+        self.jobs = jobs
+
+        self.tasks = []
+
+        self.condition = threading.Condition()
+        self.ready = []
+        self.running = 0
+        self.finished = 0
+        self.error = None
+
+    def addTask(self, name, function, dependencies=None):
+        task = Task(name, function)
+
+        for dependency in dependencies or []:
+            task.dependencies.append(dependency)
+            dependency.dependents.append(task)
+
+        self.tasks.append(task)
+        return task
+
+    def run(self):
+        self.start_time = time.time()
+
+        for task in self.tasks:
+            task.pending = len(task.dependencies)
+            if task.pending == 0:
+                task.ready_time = self.start_time
+                self.ready.append(task)
+
+        reset_cancelled_commands()
+
+        workers = [ threading.Thread(target=self.worker)
+                    for i in range(min(self.jobs, max(len(self.tasks), 1))) ]
+
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        try:
+            with self.condition:
+                while not self.done():
+                    # Waiting with a timeout keeps the main thread responsive
+                    # to KeyboardInterrupt
+                    self.condition.wait(0.1)
+        except KeyboardInterrupt:
+            self.cancel(sys.exc_info())
+            raise
+
+        for worker in workers:
+            worker.join()
+
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+
+        if self.finished != len(self.tasks):
+            raise Exception("Unable to schedule all tasks (dependency cycle?)")
+
+        self.end_time = time.time()
+
+    def done(self):
+        if self.error:
+            return self.running == 0
+        return self.running == 0 and len(self.ready) == 0
+
+    def cancel(self, error):
+        with self.condition:
+            if self.error is None:
+                self.error = error
+            self.ready = []
+            self.condition.notify_all()
+
+        # Stop commands already running on other workers
+        cancel_running_commands()
+
+    def worker(self):
+        while True:
+            with self.condition:
+                while len(self.ready) == 0 and not self.done():
+                    self.condition.wait(0.1)
+
+                if len(self.ready) == 0:
+                    return
+
+                task = self.ready.pop(0)
+                task.start_time = time.time()
+                self.running += 1
+
+            try:
+                task.function()
+            except BaseException:
+                with self.condition:
+                    self.running -= 1
+                self.cancel(sys.exc_info())
+                return
+
+            with self.condition:
+                task.end_time = time.time()
+                self.running -= 1
+                self.finished += 1
+
+                if self.error is None:
+                    for dependent in task.dependents:
+                        dependent.pending -= 1
+                        if dependent.pending == 0:
+                            dependent.ready_time = task.end_time
+                            self.ready.append(dependent)
+
+                self.condition.notify_all()
+##############################################################################
+
+
+
+##############################################################################
+def buildTargets(root_targets, jobs=None, report=None, only=None):
+    """Processes and builds root_targets and all their dependencies, running
+    independent targets concurrently on at most 'jobs' workers. The same
+    limit is shared by every command spawned, through the jobserver.
+
+    When given, report gets the schedule once all targets are built, and
+    only the targets in 'only' are processed and built (the others being
+    taken as up to date)."""
+    if jobs is None:
+        jobs = crabsys_config.get("jobs")
+    if not jobs:
+        jobs = multiprocessing.cpu_count()
+
+    targets = collectTargets(root_targets, jobs)
+
+    scheduler = Scheduler(jobs)
+
+    process_tasks = {}
+    build_tasks = {}
+
+    # Targets are in topological order, so dependencies' tasks always exist
+    # by the time their dependents are added
+    for target in targets:
+        (process, build) = (target.process, target.build)
+        if only is not None and target not in only:
+            (process, build) = (upToDate, upToDate)
+
+        process_tasks[target] = scheduler.addTask(
+            "process " + target.name,
+            process,
+            [process_tasks[dep] for dep in target.dependencies] +
+            [build_tasks[dep] for dep in target.build_dependencies])
+
+        build_tasks[target] = scheduler.addTask(
+            "build " + target.name,
+            build,
+            [process_tasks[target]] +
+            [build_tasks[dep] for dep in target.dependencies])
+
+    if crabsys_config["superbuild"]:
+        addSuperbuildTasks(scheduler, Superbuild(root_targets[0].context, targets),
+                           process_tasks, build_tasks)
+
+    startJobserver(jobs, crabsys_config.get("load_average"))
+    try:
+        scheduler.run()
+    finally:
+        stopJobserver()
+
+    if report:
+        report.recordSchedule(scheduler, targets, process_tasks, build_tasks)
+
+    return targets
+
+
+def upToDate():
+    pass
+##############################################################################
+
+
+def addSuperbuildTasks(scheduler, superbuild, process_tasks, build_tasks):
+    """Configures the superbuild once all its targets are processed (and
+    whatever else they depend on is built), and builds it before any of its
+    targets' build tasks."""
+    configure_task = scheduler.addTask(
+        "configure superbuild",
+        superbuild.configure,
+        [process_tasks[target] for target in superbuild.targets] +
+        [build_tasks[dep] for dep in superbuild.externalDependencies()])
+
+    build_task = scheduler.addTask(
+        "build superbuild",
+        superbuild.build,
+        [configure_task])
+
+    for target in superbuild.targets:
+        build_tasks[target].dependencies.append(build_task)
+        build_task.dependents.append(build_tasks[target])
+##############################################################################
@@ -0,0 +1,132 @@
+import os
+import re
+
+from os.path import join as pjoin
+from utils import *
+from build_step import BuildStep
+from target import CrabsysTarget
+from tracing import traceSpan
+
+
+
+##############################################################################
+# Superbuild
+#
+# Opt-in ("superbuild": true) alternative to one cmake and one make per
+# target: every crabsys target's CMakeLists.txt becomes a subdirectory of a
+# single generated CMake project (under the root build folder), linked to
+# its crabsys dependencies as CMake targets. The whole tree is then
+# configured once and built by a single make (or ninja) run, which can
+# parallelize across targets.
+#
+# Targets of any other kind keep being built on their own, before the
+# superbuild when crabsys targets depend on them.
+##############################################################################
+superbuild_folder_name = 'superbuild'
+
+class Superbuild:
+    def __init__(self, root_context, targets):
+        self.context = root_context
+        self.directory = pjoin(root_context.build_folder, superbuild_folder_name)
+
+        self.targets = [t for t in targets if isinstance(t, CrabsysTarget)]
+
+        # CMake target names must be unique within the project
+        used_names = set()
+        for target in self.targets:
+            cmake_name = re.sub('[^A-Za-z0-9_.+-]', '_', target.name)
+
+            suffix = 1
+            while cmake_name in used_names:
+                suffix += 1
+                cmake_name = "%s_%d" % (re.sub('[^A-Za-z0-9_.+-]', '_', target.name), suffix)
+
+            used_names.add(cmake_name)
+            target.cmake_name = cmake_name
+
+        # Targets sharing a precompiled header reuse the one of the first of
+        # them (dependencies first) with sources to build it
+        owners = {}
+        for target in self.targets:
+            key = target.sharedPrecompiledHeaderKey()
+            if key is None or not (target.sources or target.sources_lists):
+                continue
+
+            if key in owners:
+                target.precompiled_header_reuse = owners[key].cmake_name
+            else:
+                owners[key] = target
+                target.precompiled_header_reuse = None
+
+    def externalDependencies(self):
+        """Targets outside the superbuild that its targets depend on, which
+        must be built before it."""
+        dependencies = []
+        for target in self.targets:
+            for dep in target.dependencies + target.build_dependencies:
+                if not isinstance(dep, CrabsysTarget) and dep not in dependencies:
+                    dependencies.append(dep)
+
+        for dep in dependencies:
+            pending = list(dep.dependencies + dep.build_dependencies)
+            while pending:
+                target = pending.pop()
+                if isinstance(target, CrabsysTarget):
+                    raise Exception("Superbuild: %s depends on crabsys target %s, but crabsys targets depend on it" %
+                                    (dep.name, target.name))
+                pending += target.dependencies + target.build_dependencies
+
+        return dependencies
+
+    def configure(self):
+        members = [t for t in self.targets if t.superbuild_member]
+        if not members:
+            return
+
+        with traceSpan("CMakeLists.txt", "template", { "target": superbuild_folder_name }):
+            cmake_lists = render_template(superbuild_cmake_lists_template, {
+                'project_name': self.context.project_name,
+                'targets': [ { 'source_directory': target.build_folder,
+                               'binary_directory': pjoin('targets', target.cmake_name) }
+                             for target in members ]
+            })
+
+        changed = self.generateCMakeListsFile(cmake_lists)
+        for target in members:
+            changed = changed or target.cmake_lists_changed
+
+        output_variables = dict((target.cmake_name, target.locationVariable()) for target in members)
+
+        output_values = run_cmake(self.directory, reconfigure=changed, output_variables=output_variables)
+
+        for target in members:
+            target.cmake_lists_changed = False
+
+            # Targets loaded from the build graph cache already have theirs
+            if target.cmake_name in output_values:
+                target.target_files += [ location for location in output_values[target.cmake_name].split(";")
+                                         if location not in target.target_files ]
+
+    def generateCMakeListsFile(self, content):
+        """Writes the top level CMakeLists.txt file, returning whether it
+        changed."""
+        cmake_lists_file_path = pjoin(self.directory, 'CMakeLists.txt')
+
+        if os.path.isfile(cmake_lists_file_path) and get_file_content(cmake_lists_file_path) == content:
+            return False
+
+        mkdir_p(self.directory)
+
+        with open(cmake_lists_file_path, 'w') as cmake_file:
+            cmake_file.write(content)
+
+        return True
+
+    def build(self):
+        if not [t for t in self.targets if t.superbuild_member]:
+            return
+
+        parallel = all(t.parallel_build for t in self.targets)
+
+        BuildStep(cmake_build_step_info(self.directory, parallel), self.context).run()
+##############################################################################
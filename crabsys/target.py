@@ -3,15 +3,19 @@
 import time
 import os
 import sys
+import json
+import shutil
+import hashlib
 from os.path import join as pjoin
 
-# External dependencies
-import pystache
-
 # Internal dependencies
 from build_step import parseListOfBuildSteps, BuildStep
 from utils import *
 from config import crabsys_config
+from artifact_cache import artifact_key, storeArtifacts, restoreArtifacts
+from tracing import traceSpan
+from file_index import translate_glob, matches_any
+from build_state import currentBuildState
 
 
 
@@ -30,12 +34,60 @@ def createTarget(target_info, context):
 
 
 ##############################################################################
+# Settings and environment variables (fingerprint_environment_variables) that
+# change how targets are built, part of their input fingerprints
+fingerprint_config_keys = [ "flags", "compile_flags", "link_flags", "generator",
+                            "compiler_launcher", "unity_build" ]
+
+toolchain_identity_cache = []
+
+def toolchainIdentity():
+    """Paths and versions of the C and C++ compilers builds pick up, which
+    differ from one host to another."""
+    if not toolchain_identity_cache:
+        identity = {}
+        for (variable, default_compiler) in [ ("CC", "cc"), ("CXX", "c++") ]:
+            command = os.environ.get(variable, default_compiler).split()
+            compiler = find_executable(command[0]) if command else None
+
+            version = None
+            if compiler:
+                try:
+                    version = system_command([compiler, '--version'])[1].strip()
+                except OSError:
+                    pass
+
+            identity[variable] = [compiler, version]
+
+        toolchain_identity_cache.append(identity)
+
+    return toolchain_identity_cache[0]
+
+def fileHash(path):
+    state = currentBuildState()
+    if state:
+        return state.fileHash(path)
+    if os.path.isfile(path):
+        return file_sha256(path)
+    return None
+
 class BaseTarget(object):
+    # Whether outputs of this kind of target can be shared through the
+    # artifact cache
+    cacheable_artifacts = False
+
+    # Whether outputs rewritten by a build with the same content get their
+    # previous modification time back, so whatever compares times with them
+    # (like the make of dependents) doesn't take them as changed. Not for
+    # outputs of make itself, which would then be older than their inputs.
+    keeps_unchanged_outputs_time = True
+
     def __init__(self, target_info, context):
         self.context = context
         self.info = target_info
         self.platform_info = {}
 
+        self.resolved = False
         self.processed = False
 
         self.name = None
@@ -44,12 +96,22 @@ class BaseTarget(object):
         self.includes = []
         self.target_files = []
 
+        # Files (besides the dependencies' outputs) the target is built
+        # from, declared so changing them rebuilds it
+        self.inputs = []
+
         self.build_steps = []
         self.pre_build_steps = []
         self.post_build_steps = []
 
         self.built = False
 
+        self.dependencies = []
+        self.build_dependencies = []
+
+        # Memoized by allDependencies()
+        self.all_dependencies = None
+
         self.dependencies_infos = []
         self.build_dependencies_infos = []
 
@@ -72,7 +134,12 @@ class BaseTarget(object):
             self.type = target_info.get("type")
 
         self.includes += [pjoin(self.context.current_dir, i) for i in target_info.get("includes", [])]
-        self.target_files += processListOfFiles(target_info.get("target_files", []), self.context.current_dir)
+        self.target_files += processListOfFiles(target_info.get("target_files", []),
+                                                self.context.current_dir,
+                                                self.context.file_index)
+        self.inputs += processListOfFiles(target_info.get("inputs", []),
+                                          self.context.current_dir,
+                                          self.context.file_index)
 
         self.pre_build_steps += parseListOfBuildSteps(target_info, self.context, "pre_build_steps")
         self.build_steps += parseListOfBuildSteps(target_info, self.context, "build_steps")
@@ -86,101 +153,237 @@ class BaseTarget(object):
         for step in steps:
             step.run()
 
-    def process(self):
-        start_time = time.time()
-        print ("| "*self.context.level) + "-> Processing # %s #" % (self.name)
+    def resolveDependencies(self):
+        if self.resolved:
+            return
 
         self.dependencies = [
-            self.context.getContext( parent_context=self.context,
-                                     info=dependency )
-                .getTarget(dependency["name"])
+            self.findDependencyTarget(
+                self.context.getContext( parent_context=self.context,
+                                         info=dependency ),
+                dependency )
 
             for dependency in self.dependencies_infos
         ]
 
         self.build_dependencies = [
-            self.context.getContext( parent_context=self.context,
-                                     info=dependency)
-                .getTarget(dependency["name"])
+            self.findDependencyTarget(
+                self.context.getContext( parent_context=self.context,
+                                         info=dependency ),
+                dependency )
 
             for dependency in self.build_dependencies_infos
         ]
 
-        for dependency in self.dependencies:
-            dependency.process()
+        self.resolved = True
 
-        for dependency in self.build_dependencies:
-            dependency.process()
-            dependency.build()
+    def findDependencyTarget(self, context, dependency):
+        target = context.getTarget(dependency["name"])
 
-        self.runBuildSteps(self.pre_build_steps)
+        if target is None:
+            raise Exception("Dependency '%s' of target '%s' not found at: %s" %
+                (dependency["name"], self.name, context.current_dir))
 
-        self.build_folder = pjoin(self.context.build_folder, "__target_"+self.name)
+        return target
 
-        if not self.processed:
-            self._process()
-            self.processed = True
+    def process(self):
+        start_time = time.time()
+        log(("| "*self.context.level) + "-> Processing # %s #" % (self.name))
 
-        print ("| "*self.context.level) + "-> Done - %f seconds" % (time.time()-start_time)
+        with traceSpan(self.name, "process", { "directory": self.context.current_dir }):
+            self.runBuildSteps(self.pre_build_steps)
 
+            self.build_folder = pjoin(self.context.build_folder, "__target_"+self.name)
 
-    def shouldBuild(self):
-        for dep in self.dependencies:
-            if dep.built:
-                #print "Because dependency was just built"
-                return True
+            if not self.processed:
+                self._process()
+                self.processed = True
 
-        for target_file in self.target_files:
-            target_file_path = pjoin(self.context.current_dir, target_file)
+        log(("| "*self.context.level) + "-> Done - %f seconds" % (time.time()-start_time))
 
-            if os.path.isfile(target_file_path):
-                file_last_modification = os.stat(target_file_path).st_mtime
-                crab_file_last_modification = os.stat(self.context.getOriginalCrabFilePath()).st_mtime
 
-                if crab_file_last_modification > file_last_modification:
-                    #print "Because of the file modification dates"
-                    #print "Original crab file modification time: ", crab_file_last_modification
-                    #print "Target file modification time (%s): %d" % ( target_file_path, file_last_modification )
-                    return True
-            else:
+    def shouldBuild(self):
+        for target_file in self.target_files:
+            if not os.path.isfile(pjoin(self.context.current_dir, target_file)):
                 return True
 
-        return False
+        state = currentBuildState()
+        if state is None:
+            return True
+
+        return state.fingerprint(self.stateKey()) != self.inputFingerprint()
+
+    def stateKey(self):
+        return "%s:%s" % (self.context.current_dir, self.name)
+
+    def inputFingerprint(self):
+        """Hash of everything the target is built from: its description,
+        build steps, the exact sources of its archive or repository, the
+        settings and environment variables compilers pick up, the outputs of
+        its dependencies and its declared inputs."""
+        def steps(build_steps):
+            return [ [step.command, step.directory, step.params, step.compiler_launcher]
+                     for step in build_steps ]
+
+        return hashlib.sha256(json.dumps({
+            "kind": type(self).__name__,
+            "info": self.info,
+            "steps": [ steps(self.pre_build_steps), steps(self.build_steps), steps(self.post_build_steps) ],
+            "source": self.context.getSourceIdentity(),
+            "settings": self.buildSettings(),
+            "dependencies": [ dep.outputHash() for dep in self.dependencies + self.build_dependencies ],
+            "inputs": [ [path, fileHash(path)] for path in sorted(self.inputs) ]
+        }, sort_keys=True)).hexdigest()
+
+    def buildSettings(self):
+        """The settings and environment variables compilers pick up."""
+        return {
+            "config": dict((key, crabsys_config.get(key)) for key in fingerprint_config_keys),
+            "environment": dict((name, os.environ.get(name)) for name in fingerprint_environment_variables)
+        }
 
     def build(self):
         start_time = time.time()
-        print ("| "*self.context.level) + "-> Building # %s #" % (self.name)
+        log(("| "*self.context.level) + "-> Building # %s #" % (self.name))
+
+        with traceSpan(self.name, "build", { "directory": self.context.current_dir }) as span:
+            if self.shouldBuild():
+                # Taken before building, so inputs changing meanwhile aren't
+                # taken as built
+                fingerprint = self.inputFingerprint()
+                output_stamps = self.outputStamps()
+
+                key = self.artifactKey()
+
+                if key and restoreArtifacts(key, self.context.current_dir):
+                    log(("| "*self.context.level) + "-> Restored from artifact cache")
+                    span["restored"] = True
+                else:
+                    self.runBuildSteps(self.build_steps)
+
+                    if key:
+                        storeArtifacts(key, self.context.current_dir,
+                                       self.relativePaths(self.target_files),
+                                       self.relativePaths(self.includes))
+
+                self.keepUnchangedOutputsTime(output_stamps)
+
+                if currentBuildState():
+                    currentBuildState().record(self.stateKey(), fingerprint)
 
-        for dependency in self.dependencies:
-            dependency.build()
+                self.built = True
 
-        if self.shouldBuild():
-            self.runBuildSteps(self.build_steps)
-            self.built = True
+            span["built"] = self.built
 
-        self.runBuildSteps(self.post_build_steps)
-        self.postBuild()
+            self.runBuildSteps(self.post_build_steps)
+            self.postBuild()
 
-        print ("| "*self.context.level) + "-> Done - %f seconds" % (time.time()-start_time)
+        log(("| "*self.context.level) + "-> Done - %f seconds" % (time.time()-start_time))
 
     def postBuild(self):
         pass
 
+    def outputStamps(self):
+        """Content hash and times of the existing outputs."""
+        if not self.keeps_unchanged_outputs_time:
+            return {}
+
+        stamps = {}
+        for target_file in self.target_files:
+            target_file_hash = fileHash(target_file)
+            if target_file_hash:
+                stat = os.stat(target_file)
+                stamps[target_file] = (target_file_hash, stat.st_atime, stat.st_mtime)
+
+        return stamps
+
+    def keepUnchangedOutputsTime(self, output_stamps):
+        for (target_file, (target_file_hash, atime, mtime)) in output_stamps.items():
+            if not os.path.isfile(target_file) or os.stat(target_file).st_mtime == mtime:
+                continue
+
+            if fileHash(target_file) == target_file_hash:
+                os.utime(target_file, (atime, mtime))
+
+    def relativePaths(self, paths):
+        return [os.path.relpath(p, self.context.current_dir) for p in paths]
+
+    def artifactKey(self):
+        """Identifies this target's outputs in the artifact cache (None when
+        they can't be cached): the exact sources, everything declared about
+        the target, the settings, environment and compilers it's built with
+        and the outputs of its dependencies."""
+        if not self.cacheable_artifacts or len(self.target_files) == 0:
+            return None
+
+        source_identity = self.context.getSourceIdentity()
+        if source_identity is None:
+            return None
+
+        # Only outputs living in the dependency's own folder can be restored
+        for path in self.relativePaths(self.target_files + self.includes):
+            if path.startswith(os.pardir):
+                return None
+
+        return artifact_key({
+            "source": source_identity,
+            "info": self.info,
+            "settings": self.buildSettings(),
+            "toolchain": toolchainIdentity(),
+            "dependencies": [ dep.artifactKey() or dep.outputHash()
+                              for dep in self.dependencies ]
+        })
+
+    def outputHash(self):
+        digest = hashlib.sha256()
+
+        for target_file in self.target_files:
+            target_file_hash = fileHash(target_file)
+            if target_file_hash:
+                digest.update(target_file_hash)
+            else:
+                digest.update("missing:" + target_file)
+
+        return digest.hexdigest()
+
+    def allDependencies(self):
+        """Every target this one depends on, directly or not, once and after
+        all the targets it depends on itself."""
+        if self.all_dependencies is None:
+            all_dependencies = []
+            seen = set()
+
+            # Backwards, so that once reversed dependencies come in the order
+            # they were declared in whenever possible
+            for dep in reversed(self.dependencies):
+                for target in dep.allDependencies() + [dep]:
+                    if target not in seen:
+                        seen.add(target)
+                        all_dependencies.append(target)
+
+            self.all_dependencies = all_dependencies
+
+        return self.all_dependencies
+
     def getAllDependenciesIncludesAndBinaries(self):
+        """Include folders and binaries of all dependencies, without
+        duplicates. Every library comes before those it depends on, as
+        static libraries must be linked."""
         includes = []
         binaries = []
-        for dep in self.dependencies:
-            (dep_includes, dep_binaries) = dep.getAllDependenciesIncludesAndBinaries()
-            includes += [pjoin(dep.context.current_dir, i) for i in dep.includes]+dep_includes
-            binaries += dep.target_files+dep_binaries
+        for dep in reversed(self.allDependencies()):
+            includes += [pjoin(dep.context.current_dir, i) for i in dep.includes]
+            binaries += dep.target_files
 
-        return (includes, binaries)
+        return (unique_list(includes), unique_list(binaries))
 ##############################################################################
 
 
 
 ##############################################################################
 class AutoconfTarget(BaseTarget):
+    cacheable_artifacts = True
+
     def __init__(self, target_info, context):
         super(AutoconfTarget, self).__init__(target_info, context)
 
@@ -190,33 +393,49 @@ class AutoconfTarget(BaseTarget):
             BuildStep({
                 "command": "./configure",
                 "directory": target_info.get("configure_directory", autoconf_directory),
-                "params": target_info.get("configure_params", [])
+                "params": target_info.get("configure_params", []),
+                "compiler_launcher": True
             }, self.context),
             BuildStep({
                 "command": "make",
                 "directory": target_info.get("make_directory", autoconf_directory),
-                "params": target_info.get("make_params", [])
+                "params": target_info.get("make_params", []),
+                "compiler_launcher": True
             }, self.context)
         ]
 
     def _process(self):
         pass
-
-    def postBuild(self):
-        for target_file in self.target_files:
-            with open(target_file, 'a'):
-                os.utime(target_file, None)
 ##############################################################################
 
 
 
 ##############################################################################
+# Unity builds merge sources of these extensions, by language
+unity_build_languages = {
+    ".c": "c",
+    ".cpp": "cpp",
+    ".cc": "cpp",
+    ".cxx": "cpp",
+    ".c++": "cpp"
+}
+
+unity_build_default_batch_size = 16
+
 class CrabsysTarget(BaseTarget):
+    keeps_unchanged_outputs_time = False
+
     def __init__(self, target_info, context):
         super(CrabsysTarget, self).__init__(target_info, context)
 
         self.parallel_build = True
 
+        # Static libraries are archived in the build folder and copied where
+        # dependents link them only when their content changed, so that
+        # rebuilding one the same doesn't relink every dependent: (archived,
+        # published) paths
+        self.published_outputs = []
+
         # Flags initialization
         def joinedOrDefault(name, dict1, dict2, defaults):
             l = asList(dict1.get(name, []))+asList(dict2.get(name, []))
@@ -235,8 +454,12 @@ class CrabsysTarget(BaseTarget):
         self.sources_lists = self.info.get("sources_lists", [])
         self.sources_lists += self.platform_info.get("sources_lists", [])
 
-        self.sources = processListOfFiles(self.info.get("sources", []), self.context.current_dir)
-        self.sources += processListOfFiles(self.platform_info.get("sources", []), self.context.current_dir)
+        self.sources = processListOfFiles(self.info.get("sources", []),
+                                          self.context.current_dir,
+                                          self.context.file_index)
+        self.sources += processListOfFiles(self.platform_info.get("sources", []),
+                                           self.context.current_dir,
+                                           self.context.file_index)
 
         # Dynamic libs info initialization
         self.dynamic_libs_destination_path = self.info.get(
@@ -246,6 +469,27 @@ class CrabsysTarget(BaseTarget):
         )
         self.linux_rpath = pjoin( "$ORIGIN", self.dynamic_libs_destination_path )
 
+        # In superbuild mode, the name of the target in the single generated
+        # CMake project (which must be unique), whether the target is part of
+        # it and whether its CMakeLists.txt changed since the last configure
+        self.cmake_name = self.name
+        self.superbuild_member = False
+        self.cmake_lists_changed = False
+
+        self.unity_build = self.unityBuildOptions()
+
+        # "precompiled_header": a header (or a list of them), or
+        # {"header": ..., "shared": true} to reuse the one of another target
+        # of the same context with the same headers, flags and includes
+        # (superbuild only, as targets must be in the same CMake project)
+        self.precompiled_header = self.info.get("precompiled_header",
+                                                self.platform_info.get("precompiled_header"))
+        if self.precompiled_header and not isinstance(self.precompiled_header, dict):
+            self.precompiled_header = { "header": self.precompiled_header }
+
+        # The CMake name of the target whose precompiled header is reused
+        self.precompiled_header_reuse = None
+
 
     def _process(self):
         self.processAsCrabsysBuild()
@@ -265,6 +509,14 @@ class CrabsysTarget(BaseTarget):
 
                 self.sources_list_index[index] = int(list_id)
 
+        sources = self.sources
+        sources_lists = self.sources_lists
+        if self.unity_build:
+            sources = self.unitySources(self.sources + [
+                source for index in self.sources_lists
+                       for source in self.context.sources_lists[int(index)].get("sources", []) ])
+            sources_lists = []
+
         (dep_includes, dep_binaries) = self.getAllDependenciesIncludesAndBinaries()
 
         dynamic_libraries = []
@@ -285,51 +537,173 @@ class CrabsysTarget(BaseTarget):
                         "lib_destination_path": pjoin(libs_dest_path, lib_basename),
                     })
 
-        self.generateCMakeListsFile(pystache.render(crabsys_build_cmake_lists_template,
-            {
-                'project_name': self.name,
-                'name': self.name,
-                'sources_lists_definitions': self.context.sources_lists,
-                'dependencies_includes': dep_includes,
-                'dependencies_binaries': dep_binaries,
-                'sources': self.sources,
-                'includes': self.includes,
-                'executable': self.type == 'executable',
-                'library': self.type == 'library',
-                'sources_lists': self.sources_lists,
-                'target_path': pjoin(self.context.current_dir, targets_relative_path),
-                'linux_rpath': self.linux_rpath,
-                'compile_flags': ' '.join(self.compile_flags+self.flags),
-                'link_flags': ' '.join(self.link_flags+self.flags),
-                'cmake_output_variables': cmake_output_variables,
-                'dynamic_libraries_destination_path': libs_dest_path,
-                'dynamic_libraries': dynamic_libraries
-            }
-        ))
+        precompiled_header = None
+        if self.precompiled_header:
+            precompiled_header = { "headers": self.precompiledHeaders(),
+                                   "reuse_from": self.precompiled_header_reuse }
+
+        superbuild = crabsys_config["superbuild"]
+
+        # Within the superbuild, crabsys dependencies are linked as CMake
+        # targets rather than by path
+        superbuild_dependencies = []
+        location_variable = cmake_output_variables["location"]
+        if superbuild:
+            superbuild_dependencies = [ dep.cmake_name for dep in self.dependencies
+                                        if isinstance(dep, CrabsysTarget) and dep.superbuild_member ]
+            location_variable = self.locationVariable()
+
+        with traceSpan("CMakeLists.txt", "template", { "target": self.name }):
+            cmake_lists = render_template(crabsys_build_cmake_lists_template,
+                {
+                    'project_name': self.name,
+                    'name': self.name,
+                    'cmake_name': self.cmake_name,
+                    'superbuild': superbuild,
+                    'superbuild_dependencies': superbuild_dependencies,
+                    'precompiled_header': precompiled_header,
+                    'location_variable': location_variable,
+                    'sources_lists_definitions': self.context.sources_lists,
+                    'dependencies_includes': dep_includes,
+                    'dependencies_binaries': dep_binaries,
+                    'sources': sources,
+                    'includes': self.includes,
+                    'executable': self.type == 'executable',
+                    'library': self.type == 'library',
+                    'sources_lists': sources_lists,
+                    'target_path': pjoin(self.context.current_dir, targets_relative_path),
+                    'library_path': self.libraryPath(),
+                    'linux_rpath': self.linux_rpath,
+                    'compile_flags': ' '.join(self.compile_flags+self.flags),
+                    'link_flags': ' '.join(self.link_flags+self.flags),
+                    'cmake_output_variables': cmake_output_variables,
+                    'dynamic_libraries_destination_path': libs_dest_path,
+                    'dynamic_libraries': dynamic_libraries
+                }
+            )
+
+        changed = self.generateCMakeListsFile(cmake_lists)
+
+        if superbuild:
+            # Configured and built along with every other target
+            self.superbuild_member = True
+            self.cmake_lists_changed = changed
+            return
 
-        output_values = run_cmake(self.build_folder)
+        output_values = run_cmake(self.build_folder, reconfigure=changed)
 
         self.processCMakeOutputValues(output_values)
 
-        cpu_count = multiprocessing.cpu_count()
-        if not self.parallel_build:
-            cpu_count = 1
-
-        self.build_steps += [BuildStep({
-                'command': 'make',
-                'directory': self.build_folder,
-                'params': ['-j' + str(cpu_count)]
-            }, self.context)]
+        self.build_steps += [BuildStep(cmake_build_step_info(self.build_folder, self.parallel_build),
+                                       self.context)]
+
+    def libraryPath(self):
+        # Within the superbuild, dependents link the CMake target itself
+        if crabsys_config["superbuild"]:
+            return pjoin(self.context.current_dir, targets_relative_path)
+        return pjoin(self.build_folder, 'output')
+
+    def precompiledHeaders(self):
+        # System headers (<...>) are left as they are
+        return [ header if header.startswith('<') else pjoin(self.context.current_dir, header)
+                 for header in asList(self.precompiled_header["header"]) ]
+
+    def sharedPrecompiledHeaderKey(self):
+        """What targets sharing a precompiled header must have in common, or
+        None if the target doesn't share its own."""
+        if not self.precompiled_header or not self.precompiled_header.get("shared"):
+            return None
+
+        return ( self.context.current_dir,
+                 tuple(self.precompiledHeaders()),
+                 tuple(self.compile_flags + self.flags),
+                 tuple(self.includes) )
+
+    def unityBuildOptions(self):
+        """The unity build options of the target (its own "unity_build",
+        over the global one), or None when it's not built as a unity build."""
+        options = crabsys_config.get("unity_build") or {}
+
+        target_options = self.info.get("unity_build", self.platform_info.get("unity_build"))
+        if target_options is False:
+            return None
+        if target_options is True:
+            target_options = {}
+        if target_options is not None:
+            options = dict(options, **target_options)
+            options.setdefault("batch_size", unity_build_default_batch_size)
+
+        if not options.get("batch_size"):
+            return None
+
+        return options
+
+    def unitySources(self, sources):
+        """Returns the sources to compile instead of sources: batches of up to
+        batch_size C or C++ files of the same folder, each merged in one
+        unity file, plus whatever can't be merged."""
+        excludes = [translate_glob(pattern) for pattern in asList(self.unity_build.get("exclude", []))]
+        batch_size = int(self.unity_build["batch_size"])
+
+        merged = {}
+        unity_sources = []
+        for source in sources:
+            language = unity_build_languages.get(os.path.splitext(source)[1].lower())
+
+            if language is None or matches_any(os.path.relpath(source, self.context.current_dir), excludes):
+                unity_sources.append(source)
+            else:
+                key = (language, os.path.dirname(source))
+                merged.setdefault(key, []).append(source)
+
+        # Batches only depend on the files of their own folder, so adding or
+        # removing a file doesn't reshuffle the whole target
+        unity_folder = pjoin(self.build_folder, 'unity')
+        unity_files = []
+        for (language, folder) in sorted(merged):
+            batch_sources = sorted(merged[(language, folder)])
+
+            for start in range(0, len(batch_sources), batch_size):
+                batch = batch_sources[start:start+batch_size]
+                if len(batch) == 1:
+                    unity_sources += batch
+                    continue
+
+                # Folders like a_b and a/b read the same once sanitized,
+                # the hash keeps their unity files apart
+                relative_folder = os.path.relpath(folder, self.context.current_dir)
+                name = "unity_%s_%s_%d.%s" % (
+                    re.sub('[^A-Za-z0-9_]', '_', relative_folder),
+                    hashlib.sha1(relative_folder).hexdigest()[:8],
+                    start / batch_size, language)
+                content = ''.join('#include "%s"\n' % (source) for source in batch)
+
+                unity_files.append(self.writeUnityFile(pjoin(unity_folder, name), content))
+
+        # Unity files of batches that are gone would otherwise linger
+        if os.path.isdir(unity_folder):
+            for name in os.listdir(unity_folder):
+                if pjoin(unity_folder, name) not in unity_files:
+                    os.remove(pjoin(unity_folder, name))
+
+        return unity_files + unity_sources
+
+    def writeUnityFile(self, path, content):
+        # Unchanged unity files are left untouched, not to be recompiled
+        if not os.path.isfile(path) or get_file_content(path) != content:
+            mkdir_p(os.path.dirname(path))
+            with open(path, 'w') as unity_file:
+                unity_file.write(content)
+
+        return path
 
     def generateCMakeListsFile(self, content):
+        """Writes the CMakeLists.txt file, returning whether it changed."""
         cmake_lists_file_path = pjoin(self.build_folder, 'CMakeLists.txt')
 
         if os.path.isfile(cmake_lists_file_path):
             if get_file_content(cmake_lists_file_path) == content:
-                return
-            if ( self.context.getOriginalCrabFilePath() is not None and
-                 os.stat(cmake_lists_file_path).st_mtime > os.stat(self.context.getOriginalCrabFilePath()).st_mtime ):
-                return
+                return False
 
         # Make sure the 'build' folder exists
         if not os.path.exists(self.build_folder):
@@ -340,20 +714,40 @@ class CrabsysTarget(BaseTarget):
         cmake_file.write(content)
         cmake_file.close()
 
+        return True
+
     def processCMakeOutputValues(self, output_values):
         if "includes" in output_values:
             self.includes += [pjoin(self.context.current_dir, i) for i in output_values["includes"].split(";")]
 
         if "location" in output_values:
-            self.target_files += output_values["location"].split(";")
+            for location in output_values["location"].split(";"):
+                if self.type == 'library' and not is_dynamic_lib(location):
+                    published_location = pjoin(self.context.current_dir, targets_relative_path,
+                                               os.path.basename(location))
+                    self.published_outputs.append((location, published_location))
+                    location = published_location
+
+                self.target_files.append(location)
+
+    def keepUnchangedOutputsTime(self, output_stamps):
+        # Make's own outputs keep their times, copies are only replaced
+        for (location, published_location) in self.published_outputs:
+            if not os.path.isfile(location):
+                continue
+            if os.path.isfile(published_location) and fileHash(published_location) == fileHash(location):
+                continue
+
+            mkdir_p(os.path.dirname(published_location))
+            temporary_location = published_location + '.tmp'
+            shutil.copy2(location, temporary_location)
+            os.rename(temporary_location, published_location)
+
+    def locationVariable(self):
+        return cmake_output_variables["location"] + "_" + self.cmake_name
 
     def shouldBuild(self):
         return True
-
-    def postBuild(self):
-        for target_file in self.target_files:
-            with open(target_file, 'a'):
-                os.utime(target_file, None)
 ##############################################################################
 
 
@@ -370,14 +764,12 @@ class CMakeTarget(BaseTarget):
         self.processAsCMakeBuild()
 
     def generateCMakeListsFile(self, content):
+        """Writes the CMakeLists.txt file, returning whether it changed."""
         cmake_lists_file_path = pjoin(self.build_folder, 'CMakeLists.txt')
 
         if os.path.isfile(cmake_lists_file_path):
             if get_file_content(cmake_lists_file_path) == content:
-                return
-            if ( self.context.getOriginalCrabFilePath() is not None and
-                 os.stat(cmake_lists_file_path).st_mtime > os.stat(self.context.getOriginalCrabFilePath()).st_mtime ):
-                return
+                return False
 
         # Make sure the 'build' folder exists
         if not os.path.exists(self.build_folder):
@@ -388,6 +780,8 @@ class CMakeTarget(BaseTarget):
         cmake_file.write(content)
         cmake_file.close()
 
+        return True
+
     def processCMakeOutputValues(self, output_values):
         if "includes" in output_values:
             self.includes += [pjoin(self.context.current_dir, i) for i in output_values["includes"].split(";")]
@@ -400,7 +794,7 @@ class CMakeTarget(BaseTarget):
         if self.cmake_search_path != "":
             search_path = pjoin(self.context.current_dir, self.cmake_search_path)
 
-        self.generateCMakeListsFile(cmake_build_cmake_lists_template.format(
+        changed = self.generateCMakeListsFile(get_template(cmake_build_cmake_lists_template).format(
             project_name = self.name,
             name = self.name,
             upper_name = self.name.upper(),
@@ -408,7 +802,7 @@ class CMakeTarget(BaseTarget):
             cmake_output_variables=cmake_output_variables
         ))
 
-        output_values = run_cmake(self.build_folder)
+        output_values = run_cmake(self.build_folder, reconfigure=changed)
 
         self.processCMakeOutputValues(output_values)
 
@@ -420,15 +814,12 @@ class CMakeTarget(BaseTarget):
 
 ##############################################################################
 class CustomBuildTarget(BaseTarget):
+    cacheable_artifacts = True
+
     def __init__(self, target_info, context):
         super(CustomBuildTarget, self).__init__(target_info, context)
 
     def _process(self):
         pass
-
-    def postBuild(self):
-        for target_file in self.target_files:
-            with open(target_file, 'a'):
-                os.utime(target_file, None)
 ##############################################################################
 
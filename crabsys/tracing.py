@@ -0,0 +1,101 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+
+
+##############################################################################
+# Build timing trace
+#
+# When enabled, spans (a name, a category, a start and a duration, plus any
+# details worth keeping) are recorded for every phase of a run: contexts
+# creation, crab files parsing, globbing, templates rendering, dependencies
+# fetching, target phases, build steps and every command spawned. They are
+# written in the Chrome trace event format, to be opened in chrome://tracing
+# or https://ui.perfetto.dev, one row per worker thread.
+##############################################################################
+trace_events = None
+trace_lock = threading.Lock()
+trace_start = None
+
+thread_ids = {}
+
+
+def startTrace():
+    global trace_events, trace_start
+
+    trace_events = []
+    trace_start = time.time()
+    thread_ids.clear()
+
+def stopTrace():
+    global trace_events
+
+    trace_events = None
+
+def traceEnabled():
+    return trace_events is not None
+
+
+def threadId():
+    """Small, stable id of the current thread (registering its name the
+    first time it's seen). Must be called with trace_lock held."""
+    thread = threading.current_thread()
+
+    if thread.ident not in thread_ids:
+        thread_ids[thread.ident] = len(thread_ids)
+        trace_events.append({
+            "name": "thread_name",
+            "ph": "M",
+            "pid": os.getpid(),
+            "tid": thread_ids[thread.ident],
+            "args": { "name": thread.name }
+        })
+
+    return thread_ids[thread.ident]
+
+
+def addSpan(name, category, start, end, args=None):
+    if trace_events is None:
+        return
+
+    with trace_lock:
+        trace_events.append({
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": int((start - trace_start) * 1000000),
+            "dur": int((end - start) * 1000000),
+            "pid": os.getpid(),
+            "tid": threadId(),
+            "args": args or {}
+        })
+
+
+@contextmanager
+def traceSpan(name, category, args=None):
+    """Records the time spent in the with block. The block gets the span's
+    args dictionary, to add details known only once it's done."""
+    if trace_events is None:
+        yield {}
+        return
+
+    args = dict(args or {})
+    start = time.time()
+    try:
+        yield args
+    finally:
+        addSpan(name, category, start, time.time(), args)
+
+
+def traceEvents():
+    with trace_lock:
+        return list(trace_events or [])
+
+
+def saveTrace(path):
+    with open(path, 'w') as trace_file:
+        json.dump({ "traceEvents": traceEvents(), "displayTimeUnit": "ms" }, trace_file)
+##############################################################################
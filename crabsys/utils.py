@@ -1,18 +1,26 @@
 
 import os
+import json
+import shutil
+import hashlib
 import subprocess
-import tarfile
 import errno
 import os.path
-import glob
 import re
-import multiprocessing
-import urllib
+import sys
+import time
+import threading
 from urlparse import urlparse
+from distutils.spawn import find_executable
 
 from sys import stderr
 from os.path import join as pjoin
 
+from constants import *
+from config import crabsys_config
+from jobserver import jobSlot
+from compiler_cache import compilerLauncherCMakeArguments
+from tracing import traceSpan
 
 
 
@@ -26,11 +34,11 @@ def badpath(path, base):
 
 def badlink(info, base):
     # Links are interpreted relative to the directory containing the link
-    tip = resolved(pjoin(base, dirname(info.name)))
+    tip = resolved(pjoin(base, os.path.dirname(info.name)))
     return badpath(info.linkname, base=tip)
 
-def safemembers(members):
-    base = resolved(".")
+def safemembers(members, base="."):
+    base = resolved(base)
 
     for finfo in members:
         if badpath(finfo.name, base):
@@ -44,23 +52,11 @@ def safemembers(members):
 ##############################################################################
 
 
-def retrieve_archive(archive_url, file_name, directory):
+def get_archive_file_path(archive_url, file_name, directory):
     if not file_name:
         file_name = os.path.basename(urlparse(archive_url).path)
 
-    archive_file_path = pjoin(directory, file_name)
-    extracted_dir = pjoin(directory, archive_file_path+"_extracted")
-
-    if not os.path.isfile(archive_file_path):
-        mkdir_p(directory)
-        urllib.urlretrieve (archive_url, archive_file_path)
-
-        if not os.path.isdir(extracted_dir):
-            archive = tarfile.open(archive_file_path)
-            archive.extractall(path=extracted_dir, members=safemembers(archive))
-
-    return extracted_dir
-
+    return pjoin(directory, file_name)
 
 def encapsulate(value):
     if value is None:
@@ -73,13 +69,20 @@ def encapsulate(value):
 
 asList = encapsulate
 
-def processListOfFiles(files_list, prefix_path, allowGlobs=False):
+def processListOfFiles(files_list, prefix_path, file_index=None):
+    if file_index is None:
+        from file_index import FileIndex
+        file_index = FileIndex()
+
     return_list = []
 
     for file_path in asList(files_list):
         if type(file_path)==type({}):
             if 'glob' in file_path:
-                glob_sources = glob.glob(pjoin(prefix_path, file_path['glob']))
+                pattern = pjoin(prefix_path, file_path['glob'])
+                with traceSpan(pattern, "glob") as span:
+                    glob_sources = file_index.glob(pattern, asList(file_path.get('exclude')))
+                    span["matches"] = len(glob_sources)
 
                 return_list += glob_sources
         else:
@@ -88,6 +91,26 @@ def processListOfFiles(files_list, prefix_path, allowGlobs=False):
     return return_list
 
 
+def unique_list(items):
+    """items without duplicates, in the order they first appear."""
+    seen = set()
+    unique_items = []
+    for item in items:
+        if item not in seen:
+            seen.add(item)
+            unique_items.append(item)
+    return unique_items
+
+
+def file_sha256(file_path):
+    digest = hashlib.sha256()
+
+    with open(file_path, 'rb') as file_handle:
+        for chunk in iter(lambda: file_handle.read(1024*1024), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
 def get_file_content(file_path):
     file_handle = open(file_path, 'r')
     content = file_handle.read()
@@ -111,18 +134,98 @@ def mkdir_p(path):
             pass
         else: raise
 
-def system_command(params=None, directory=None):
-    process = subprocess.Popen(params,
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE,
-                               cwd=directory,
-                               shell=False)
+##############################################################################
+# Running commands are tracked so a failed parallel build can stop them
+running_commands = set()
+running_commands_lock = threading.Lock()
+commands_cancelled = False
+
+def cancel_running_commands():
+    global commands_cancelled
+
+    with running_commands_lock:
+        commands_cancelled = True
+
+        for process in running_commands:
+            try:
+                process.terminate()
+            except OSError:
+                pass
+
+def reset_cancelled_commands():
+    global commands_cancelled
+
+    with running_commands_lock:
+        commands_cancelled = False
+
+def read_stream(stream, chunks):
+    chunks.append(stream.read())
+    stream.close()
+
+def system_command(params=None, directory=None, env=None):
+    with traceSpan(os.path.basename(params[0]), "command",
+                   { "argv": params, "cwd": directory }) as span:
+        with running_commands_lock:
+            if commands_cancelled:
+                raise Exception("Build cancelled")
+
+            spawn_start = time.time()
+            process = subprocess.Popen(params,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE,
+                                       cwd=directory,
+                                       env=env,
+                                       shell=False)
+
+            running_commands.add(process)
+            span["spawn_time"] = time.time() - spawn_start
+
+        # The process is reaped with wait4 (instead of communicate) to get
+        # its resource usage
+        try:
+            stdout = []
+            stderr = []
+            readers = [ threading.Thread(target=read_stream, args=(process.stdout, stdout)),
+                        threading.Thread(target=read_stream, args=(process.stderr, stderr)) ]
+            for reader in readers:
+                reader.start()
+            for reader in readers:
+                reader.join()
+
+            (pid, status, usage) = wait4_retry(process.pid)
+        finally:
+            with running_commands_lock:
+                running_commands.discard(process)
+
+        if os.WIFSIGNALED(status):
+            process.returncode = -os.WTERMSIG(status)
+        else:
+            process.returncode = os.WEXITSTATUS(status)
 
-    stdout, stderr = process.communicate()
+        span["exit_code"] = process.returncode
+        span["cpu_time"] = usage.ru_utime + usage.ru_stime
 
-    retcode = process.poll()
+    return (process.returncode, stdout[0], stderr[0])
 
-    return (retcode, stdout, stderr)
+def wait4_retry(pid):
+    while True:
+        try:
+            return os.wait4(pid, 0)
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+##############################################################################
+
+
+##############################################################################
+output_lock = threading.Lock()
+
+def log(message):
+    # Keeps lines printed by concurrent targets from interleaving
+    with output_lock:
+        print message
+        sys.stdout.flush()
+##############################################################################
 
 
 
@@ -135,22 +238,102 @@ cmake_output_variables = {
     "includes": "__crabsys_target_includes"
 }
 
-def run_cmake(directory=None):
-    (retcode, stdout, stderr) = system_command(['cmake', '.'], directory)
+cmake_output_values_file_name = 'crabsys_output_values.json'
 
-    if retcode != 0:
-        print stderr
+cmake_generators = {
+    "make": "Unix Makefiles",
+    "ninja": "Ninja"
+}
+
+resolved_generator = []
+
+def cmake_generator():
+    """The generator set in the configuration, "auto" meaning ninja when
+    it's on the PATH and make otherwise."""
+    if not resolved_generator:
+        generator = crabsys_config.get("generator", "auto")
+
+        if generator == "auto":
+            generator = "ninja" if find_executable("ninja") else "make"
+
+        if generator not in cmake_generators:
+            raise Exception("Unsupported generator: %s (use one of: auto, %s)" %
+                            (generator, ', '.join(sorted(cmake_generators))))
+
+        resolved_generator.append(generator)
+
+    return resolved_generator[0]
+
+def cmake_cache_generator(directory):
+    """The generator a configured folder was configured with, if any."""
+    cmake_cache_path = pjoin(directory, 'CMakeCache.txt')
+    if not os.path.isfile(cmake_cache_path):
         return None
 
+    for line in get_file_content(cmake_cache_path).split('\n'):
+        if line.startswith('CMAKE_GENERATOR:INTERNAL='):
+            return line[len('CMAKE_GENERATOR:INTERNAL='):].strip()
+
+    return None
+
+def cmake_build_step_info(directory, parallel=True):
+    """The build step running the generated build system in directory. Its
+    job limit is only set when it runs (see BuildStep), as the step outlives
+    the run through the graph cache."""
+    return {
+        'command': cmake_generator(),
+        'directory': directory,
+        'params': [],
+        'parallel': parallel
+    }
+
+def run_cmake(directory=None, reconfigure=True, output_variables=cmake_output_variables):
+    """Configures directory with cmake, returning the output_variables values
+    it printed. Raises when cmake fails."""
+    generator = cmake_generators[cmake_generator()]
+
+    # CMake refuses to switch the generator of a configured folder
+    configured_generator = cmake_cache_generator(directory)
+    if configured_generator is not None and configured_generator != generator:
+        os.remove(pjoin(directory, 'CMakeCache.txt'))
+        shutil.rmtree(pjoin(directory, 'CMakeFiles'), ignore_errors=True)
+        reconfigure = True
+
+    arguments = ['-G', generator] + compilerLauncherCMakeArguments()
+
+    # The values scraped from cmake's output are kept next to the CMakeLists.txt,
+    # along with the arguments cmake was run with, so an unchanged, already
+    # configured folder doesn't need cmake at all
+    output_values_path = pjoin(directory, cmake_output_values_file_name)
+
+    if ( not reconfigure and
+         os.path.isfile(pjoin(directory, 'CMakeCache.txt')) and
+         os.path.isfile(output_values_path) ):
+        cached = json.loads(get_file_content(output_values_path))
+        if cached.get("arguments") == arguments:
+            return cached["values"]
+
+    if os.path.isfile(output_values_path):
+        os.remove(output_values_path)
+
+    with jobSlot():
+        (retcode, stdout, stderr) = system_command(['cmake'] + arguments + ['.'], directory)
+
+    if retcode != 0:
+        log(stderr)
+        raise Exception("CMake configuration failed in %s" % (directory))
+
     output_values = {}
     for line in stderr.split('\n'):
-        for (key,variable) in cmake_output_variables.iteritems():
+        for (key,variable) in output_variables.iteritems():
             if line.startswith(variable+'='):
                 value = line[len(variable+'='):]
                 output_values[key] = value
 
-    return output_values
+    with open(output_values_path, 'w') as output_values_file:
+        json.dump({ "arguments": arguments, "values": output_values }, output_values_file)
 
+    return output_values
 
 
 
@@ -160,49 +343,148 @@ def run_cmake(directory=None):
 def git_command(params=None, directory=None):
     return system_command(['git'] + params, directory)
 
-def git_clone(url, directory=None):
-    (retcode, stdout, stderr) = git_command(params=['clone', url], directory=directory)
+def git_clone(url, destination, params=None):
+    (retcode, stdout, stderr) = git_command(params=['clone', '--quiet'] + (params or []) + [url, destination])
     if retcode != 0:
         raise Exception('Error cloning repository: ' + url + '\n' + stderr)
 
+def git_init(url, destination, reference=None):
+    (retcode, stdout, stderr) = git_command(params=['init', '--quiet', destination])
+    if retcode == 0:
+        (retcode, stdout, stderr) = git_command(params=['remote', 'add', 'origin', url], directory=destination)
+    if retcode != 0:
+        raise Exception('Error initializing repository: ' + destination + '\n' + stderr)
+
+    # Same as 'git clone --reference'
+    if reference:
+        alternates_path = pjoin(destination, '.git', 'objects', 'info', 'alternates')
+        mkdir_p(os.path.dirname(alternates_path))
+        with open(alternates_path, 'w') as alternates:
+            alternates.write(pjoin(os.path.abspath(reference), 'objects') + '\n')
+
 def git_checkout(branch_or_commit, directory=None):
-    (retcode, stdout, stderr) = git_command(params=['checkout', branch_or_commit], directory=directory)
+    (retcode, stdout, stderr) = git_command(params=['checkout', '--quiet', branch_or_commit], directory=directory)
+    if retcode != 0:
+        raise Exception('Error checkouting repository: ' + directory + '\n' + stderr)
+
+def git_fetch(params, directory=None):
+    (retcode, stdout, stderr) = git_command(params=['fetch', '--quiet'] + params, directory=directory)
     if retcode != 0:
-        raise Exception('Error checkouting repository: ' + url + '\n' + stderr)
+        raise Exception('Error fetching repository: ' + directory + '\n' + stderr)
 
-def git_status(directory=None):
-    (retcode, stdout, stderr) = git_command(params=['status'], directory=directory)
+def git_has_commit(commit, directory=None):
+    (retcode, stdout, stderr) = git_command(params=['cat-file', '-e', commit + '^{commit}'], directory=directory)
+    return retcode == 0
+
+def git_head_commit(directory=None):
+    (retcode, stdout, stderr) = git_command(params=['rev-parse', '--verify', 'HEAD'], directory=directory)
     if retcode != 0:
-        raise Exception('Error getting repository status: ' + directory + '\n' + stderr)
+        raise Exception('Error getting repository revision: ' + directory + '\n' + stderr)
+    return stdout.strip()
 
 def git_pull(directory=None):
     (retcode, stdout, stderr) = git_command(params=['pull'], directory=directory)
     if retcode != 0:
         raise Exception('Error running git pull: ' + directory + '\n' + stderr)
 
+def git_update(branch, directory=None):
+    (retcode, stdout, stderr) = git_command(params=['symbolic-ref', '-q', '--short', 'HEAD'], directory=directory)
+
+    if retcode == 0 and (branch is None or stdout.strip() == branch):
+        git_pull(directory=directory)
+    else:
+        # Checkouts of a single commit (e.g. locked ones) aren't on any
+        # branch, and others may be on a branch crab.json doesn't ask for
+        # anymore
+        git_fetch(['origin', branch or 'HEAD'], directory)
+        git_checkout('FETCH_HEAD', directory=directory)
+
+
+def git_mirror(url, mirrors_directory):
+    """Returns the path of a local bare mirror of url (creating it if needed)
+    whose objects are shared by every checkout of that repository.
+
+    Checkouts use these objects in place, so mirrors never drop any: they're
+    fetched without pruning, and their gc never prunes unreachable objects."""
+    mirror_path = pjoin(mirrors_directory, re.sub(r'[^A-Za-z0-9._-]', '_', url) + '.git')
+
+    if not os.path.isdir(mirror_path):
+        mkdir_p(mirrors_directory)
+
+        temporary_path = "%s.tmp-%d" % (mirror_path, os.getpid())
+        git_clone(url, temporary_path, ['--mirror'])
+
+        (retcode, stdout, stderr) = git_command(params=['config', 'gc.pruneExpire', 'never'],
+                                                directory=temporary_path)
+        if retcode != 0:
+            shutil.rmtree(temporary_path, ignore_errors=True)
+            raise Exception('Error configuring repository mirror: ' + url + '\n' + stderr)
+        try:
+            os.rename(temporary_path, mirror_path)
+        except OSError:
+            # Another process created it in the meantime
+            shutil.rmtree(temporary_path, ignore_errors=True)
+
+    return mirror_path
+
+
+def git_checkout_commit(commit, directory):
+    if not git_has_commit(commit, directory):
+        try:
+            git_fetch(['--depth', '1', 'origin', commit], directory)
+        except Exception:
+            # Not every server allows fetching commits by hash
+            git_fetch(['origin'], directory)
+
+    git_checkout(commit, directory=directory)
+
+
+def git_clone_pinned(url, destination, branch, commit, mirror_path=None):
+    reference_params = []
+    if mirror_path:
+        reference_params = ['--reference-if-able', mirror_path]
+
+    if commit:
+        # A single commit can't be cloned, but it can be fetched on its own
+        git_init(url, destination, mirror_path)
+        git_checkout_commit(commit, destination)
+    elif branch:
+        git_clone(url, destination, reference_params + ['--depth', '1', '--branch', branch])
+    else:
+        git_clone(url, destination, reference_params + ['--filter=blob:none'])
+
 
-def clone_repo(url, branch, commit, destination_path, force_update=False):
+def clone_repo(url, branch, commit, destination_path, force_update=False, mirrors_directory=None):
     repo_name = extract_repository_name_from_url(url)
 
     dependency_absolute_path = pjoin(destination_path, repo_name)
 
     if os.path.exists(dependency_absolute_path):
         if os.path.isdir(dependency_absolute_path):
-            git_status(directory=dependency_absolute_path)
-            if force_update:
-                git_pull(directory=dependency_absolute_path)
+            # Cheap sanity check, a full 'git status' would stat the whole tree
+            head_commit = git_head_commit(directory=dependency_absolute_path)
+
+            # Pinned (or locked) checkouts are only moved when the pinned
+            # commit changed
+            if commit:
+                if not head_commit.startswith(commit):
+                    git_checkout_commit(commit, dependency_absolute_path)
+            elif force_update:
+                git_update(branch, directory=dependency_absolute_path)
         else:
             raise Exception('Repository path exists but is not' +\
                             ' a directory: ' + dependency_absolute_path)
     else:
         mkdir_p(os.path.abspath(destination_path))
 
-        git_clone(url, directory=destination_path)
+        mirror_path = None
+        if mirrors_directory:
+            mirror_path = git_mirror(url, mirrors_directory)
+
+            if commit and not git_has_commit(commit, mirror_path):
+                git_fetch(['--no-prune', 'origin'], mirror_path)
 
-        if branch:
-            git_checkout(branch, directory=dependency_absolute_path)
-        elif commit:
-            git_checkout(commit, directory=dependency_absolute_path)
+        git_clone_pinned(url, dependency_absolute_path, branch, commit, mirror_path)
 
     return dependency_absolute_path
 ##############################################################################
@@ -210,25 +492,15 @@ def clone_repo(url, branch, commit, destination_path, force_update=False):
 
 
 ##############################################################################
-# Useful variables/constants
-##############################################################################
-build_folder_relative_path = pjoin('build', '.build')
-targets_relative_path = 'build'
-libraries_folder_relative_path = 'libs'
-
-resources_dir = pjoin(os.path.dirname(os.path.realpath(__file__)), 'resources')
-templates_dir = pjoin(resources_dir, 'templates')
-
-build_types = {
-    "crab": "crabsys"
-}
+# Templates are read, and pystache imported, only once something is rendered
+templates = {}
 
-cmake_build_cmake_lists_template = get_file_content(pjoin(templates_dir, "CMakeBuild_CMakeLists.txt"))
-crabsys_build_cmake_lists_template = get_file_content(pjoin(templates_dir, "CrabsysBuild_CMakeLists.txt"))
+def get_template(template_name):
+    if template_name not in templates:
+        templates[template_name] = get_file_content(pjoin(templates_dir, template_name))
+    return templates[template_name]
 
-platform_names = {
-    "linux": "linux2",
-    "linux2": "linux2",
-}
+def render_template(template_name, values):
+    import pystache
+    return pystache.render(get_template(template_name), values)
 ##############################################################################
-
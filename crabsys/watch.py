@@ -0,0 +1,449 @@
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+from os.path import join as pjoin
+from config import crabsys_config
+from utils import log, build_folder_relative_path
+from target import CrabsysTarget, CMakeTarget
+from scheduler import buildTargets
+from lockfile import loadLockfile
+from build_state import loadBuildState
+from graph_cache import loadRootContext, saveGraphCache, allContexts
+from fetch import resetFetched
+import context as context_module
+
+
+
+##############################################################################
+# Watch mode
+#
+# Builds once, then keeps the processed graph in memory and watches what it
+# was made from: sources and the folders they're in, include folders, crab
+# files and the outputs of prebuilt (cmake) dependencies. Each batch of
+# changes (events are debounced) maps to the targets using the changed files,
+# which are built again along with everything depending on them, without
+# processing any other target.
+#
+# Files added to or removed from globbed folders, crab file changes, and
+# anything the watcher may have missed reload the graph instead (through the
+# build graph cache, so only what changed is processed again).
+#
+# Uses inotify when available, polling the watched folders otherwise.
+##############################################################################
+default_watch_config = {
+    "debounce": 0.2,
+    "polling": False,
+    "polling_interval": 1.0
+}
+
+def watchConfig(key):
+    return crabsys_config.get("watch", {}).get(key, default_watch_config[key])
+##############################################################################
+
+
+
+##############################################################################
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+IN_ISDIR       = 0x40000000
+
+inotify_watch_mask = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+                      IN_CREATE | IN_DELETE | IN_ONLYDIR)
+
+inotify_event_header = struct.Struct("iIII")
+
+
+class InotifyWatcher:
+    """Reports changes in a set of folders (not recursively) as (kind, path)
+    events, kind being "modified", "created" or "deleted" ("overflow" with a
+    None path when some were lost)."""
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        if not hasattr(self.libc, "inotify_init"):
+            raise OSError(errno.ENOSYS, "inotify not available")
+
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+        self.directories = {}
+
+    def watch(self, directories):
+        for directory in set(directories) - set(self.directories.values()):
+            # Unicode strings would be passed as wide character strings
+            wd = self.libc.inotify_add_watch(self.fd, directory.encode(sys.getfilesystemencoding()),
+                                             inotify_watch_mask)
+            if wd < 0:
+                error = ctypes.get_errno()
+                # Folders created later are picked up on reload
+                if error in (errno.ENOENT, errno.ENOTDIR):
+                    continue
+                raise OSError(error, "%s: %s" % (os.strerror(error), directory))
+
+            self.directories[wd] = directory
+
+        for (wd, directory) in self.directories.items():
+            if directory not in directories:
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.directories[wd]
+
+    def events(self, timeout=None):
+        """Waits up to timeout seconds (forever when None) for events."""
+        readable = select.select([self.fd], [], [], timeout)[0]
+        if not readable:
+            return []
+
+        buffer = os.read(self.fd, 64*1024)
+
+        events = []
+        offset = 0
+        while offset < len(buffer):
+            (wd, mask, cookie, length) = inotify_event_header.unpack_from(buffer, offset)
+            name = buffer[offset+inotify_event_header.size:offset+inotify_event_header.size+length].rstrip('\0')
+            offset += inotify_event_header.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                events.append(("overflow", None))
+                continue
+
+            if mask & IN_IGNORED:
+                self.directories.pop(wd, None)
+                continue
+
+            if wd not in self.directories or mask & IN_ISDIR and not mask & (IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO):
+                continue
+
+            path = pjoin(self.directories[wd], name)
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                events.append(("created", path))
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                events.append(("deleted", path))
+            else:
+                events.append(("modified", path))
+
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """Same as InotifyWatcher, comparing listings and modification times of
+    the folders every polling interval."""
+    def __init__(self):
+        self.snapshots = {}
+
+    def snapshot(self, directory):
+        files = {}
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return files
+
+        for name in names:
+            try:
+                stat = os.stat(pjoin(directory, name))
+            except OSError:
+                continue
+            files[name] = (stat.st_mtime, stat.st_size)
+
+        return files
+
+    def watch(self, directories):
+        self.snapshots = dict((directory, self.snapshots.get(directory) or self.snapshot(directory))
+                              for directory in directories)
+
+    def events(self, timeout=None):
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        while True:
+            events = []
+            for (directory, files) in self.snapshots.items():
+                current = self.snapshot(directory)
+
+                for (name, signature) in current.iteritems():
+                    if name not in files:
+                        events.append(("created", pjoin(directory, name)))
+                    elif files[name] != signature:
+                        events.append(("modified", pjoin(directory, name)))
+
+                for name in files:
+                    if name not in current:
+                        events.append(("deleted", pjoin(directory, name)))
+
+                self.snapshots[directory] = current
+
+            if events:
+                return events
+
+            if deadline is None:
+                time.sleep(watchConfig("polling_interval"))
+            elif time.time() >= deadline:
+                return []
+            else:
+                time.sleep(min(watchConfig("polling_interval"), deadline - time.time()))
+
+    def close(self):
+        pass
+
+
+def createWatcher():
+    if not watchConfig("polling") and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher()
+        except (OSError, AttributeError) as e:
+            print "Warning: inotify unavailable (%s), polling for changes" % (e)
+
+    return PollingWatcher()
+##############################################################################
+
+
+
+##############################################################################
+class WatchedGraph:
+    """What a processed graph was made from, and which targets each file
+    affects."""
+    def __init__(self, root_context, targets):
+        self.targets = targets
+
+        self.dependents = dict((target, []) for target in targets)
+        for target in targets:
+            for dep in target.dependencies + target.build_dependencies:
+                self.dependents[dep].append(target)
+
+        # Exact files and folders (whose files all count, like private
+        # headers next to sources) each target is built from
+        self.files = {}
+        self.folders = {}
+        self.include_folders = {}
+
+        self.crab_files = set()
+        self.globbed_folders = set()
+        self.build_folders = set()
+        self.outputs = set()
+
+        for context in allContexts(root_context):
+            self.build_folders.add(context.build_folder)
+            self.globbed_folders.update(context.file_index.visited)
+            if context.build_type == "crabsys":
+                self.crab_files.add(context.crab_file_path)
+
+        for target in targets:
+            for path in self.targetFiles(target):
+                self.files.setdefault(path, set()).add(target)
+                self.folders.setdefault(os.path.dirname(path), set()).add(target)
+
+            for include in target.includes:
+                self.include_folders.setdefault(os.path.abspath(include), set()).add(target)
+
+            # Outputs of prebuilt dependencies are inputs of their dependents,
+            # outputs of anything built here are not
+            if isinstance(target, CMakeTarget):
+                for path in target.target_files:
+                    self.files.setdefault(os.path.abspath(path), set()).update(self.dependents[target])
+            else:
+                self.outputs.update(os.path.abspath(path) for path in target.target_files)
+
+    def targetFiles(self, target):
+        files = list(target.inputs)
+
+        if isinstance(target, CrabsysTarget):
+            files += target.sources
+            for index in target.sources_lists:
+                files += [ pjoin(target.context.current_dir, source)
+                           for source in target.context.sources_lists[int(index)].get("sources", []) ]
+
+        return [os.path.abspath(path) for path in files]
+
+    def directories(self):
+        directories = set(self.folders) | self.globbed_folders
+        directories.update(os.path.dirname(path) for path in self.crab_files)
+        directories.update(os.path.dirname(path) for path in self.files)
+
+        for include in self.include_folders:
+            for (directory, subdirectories, files) in os.walk(include):
+                subdirectories[:] = [ subdirectory for subdirectory in subdirectories
+                                      if not subdirectory.startswith('.') and
+                                         not self.ignored(pjoin(directory, subdirectory)) ]
+                directories.add(directory)
+
+        return set(directory for directory in directories
+                   if os.path.isdir(directory) and not self.ignored(directory))
+
+    def ignored(self, path):
+        for build_folder in self.build_folders:
+            if path == build_folder or path.startswith(build_folder + os.sep):
+                return True
+        return path in self.outputs
+
+    def affectedTargets(self, events):
+        """Returns the targets affected by events, or None when the graph
+        itself may have changed."""
+        affected = set()
+
+        for (kind, path) in events:
+            if kind == "overflow" or path in self.crab_files:
+                return None
+
+            if self.ignored(path):
+                continue
+
+            if kind != "modified" and os.path.dirname(path) in self.globbed_folders:
+                # Editors saving through a temporary file replace known files,
+                # short lived temporary files leave no trace
+                known = path in self.files
+                exists = os.path.exists(path)
+                if known != exists and not os.path.basename(path).startswith('.'):
+                    return None
+
+            affected.update(self.files.get(path, ()))
+            affected.update(self.folders.get(os.path.dirname(path), ()))
+
+            for (include, targets) in self.include_folders.iteritems():
+                if path.startswith(include + os.sep):
+                    affected.update(targets)
+
+        return affected
+
+    def withDependents(self, targets):
+        dirty = set()
+        pending = list(targets)
+
+        while pending:
+            target = pending.pop()
+            if target not in dirty:
+                dirty.add(target)
+                pending += self.dependents[target]
+
+        return dirty
+##############################################################################
+
+
+
+##############################################################################
+def waitForChanges(watcher):
+    """Blocks until something changes, then collects events until none came
+    for the debounce interval."""
+    events = watcher.events()
+
+    while True:
+        more = watcher.events(watchConfig("debounce"))
+        if not more:
+            return events
+        events += more
+
+
+def buildGraph(path, lockfile, locked, root_context=None, dirty=None):
+    """Builds the dirty targets of root_context, or the whole graph of path
+    (reloaded, through the build graph cache) when not given one. Returns
+    the root context and its targets, or (None, None) when the build
+    failed."""
+    start_time = time.time()
+
+    try:
+        if root_context is None:
+            context_module.context_cache.clear()
+            resetFetched()
+            root_context = loadRootContext(path)
+
+        for context in allContexts(root_context):
+            for target in context.targets:
+                target.built = False
+
+        targets = buildTargets(root_context.targets, only=dirty)
+    except Exception as e:
+        log("Build failed: %s" % (e))
+        return (None, None)
+
+    if not locked:
+        lockfile.save()
+
+    saveGraphCache(root_context)
+
+    log("Built in %f seconds" % (time.time() - start_time))
+    return (root_context, targets)
+
+
+def projectDirectories(path):
+    """Every folder of the project at path, for when there's no graph to
+    tell which ones matter."""
+    directories = []
+    for (directory, subdirectories, files) in os.walk(path):
+        subdirectories[:] = [ subdirectory for subdirectory in subdirectories
+                              if not subdirectory.startswith('.') and
+                                 pjoin(directory, subdirectory) != pjoin(path, build_folder_relative_path) ]
+        directories.append(directory)
+
+    return directories
+
+
+def watch(path, locked):
+    lockfile = loadLockfile(path)
+    build_state = loadBuildState(path)
+
+    watcher = createWatcher()
+    graph = None
+
+    try:
+        (root_context, targets) = buildGraph(path, lockfile, locked)
+
+        while True:
+            build_state.save()
+
+            directories = None
+            if root_context is not None:
+                graph = WatchedGraph(root_context, targets)
+                directories = graph.directories()
+            elif graph is None:
+                directories = projectDirectories(path)
+
+            if directories is not None:
+                try:
+                    watcher.watch(directories)
+                except OSError as e:
+                    # Most likely out of inotify watches
+                    print "Warning: unable to watch for changes (%s), polling instead" % (e)
+                    watcher.close()
+                    watcher = PollingWatcher()
+                    watcher.watch(directories)
+
+            log("Watching for changes... (Ctrl+C to stop)")
+
+            affected = set()
+            while not (affected is None or affected):
+                events = waitForChanges(watcher)
+
+                # Anything may fix a failed build
+                affected = None
+                if root_context is not None:
+                    affected = graph.affectedTargets(events)
+
+            if affected is None:
+                log("Project changed, reloading")
+                (root_context, targets) = buildGraph(path, lockfile, locked)
+            else:
+                dirty = graph.withDependents(affected)
+                log("Rebuilding %s" % (', '.join(sorted(target.name for target in dirty))))
+                (root_context, targets) = buildGraph(path, lockfile, locked, root_context, dirty)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        build_state.save()
+        watcher.close()
+##############################################################################
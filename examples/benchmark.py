@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import os.path
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import subprocess
+
+
+##############################################################################
+# Crabsys overhead benchmark
+#
+# Generates a synthetic workspace (many libraries, each with many sources in
+# nested folders, depending on each other as 'path' dependencies in layers
+# where every library depends on two of the next layer, so the graph is full
+# of diamonds) and builds it in a few scenarios, timing each crabsys phase
+# from the build trace.
+#
+# Nothing needs the network. Results can be saved as JSON to compare runs.
+##############################################################################
+CRAB_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), "../crabsys/crabsys.py"))
+
+SCENARIOS = [
+    # Name, whether the build graph cache is dropped first, source touched
+    ("cold build", True, None),
+    ("no-op rebuild", False, None),
+    ("no-op rebuild without graph cache", True, None),
+    ("one file touched rebuild", False, "leaf"),
+]
+
+PHASES = [
+    # Name, trace event categories (or category:name) summed up
+    ("config", ["config"]),
+    ("graph", ["graph:root context", "graph:resolve dependencies"]),
+    ("parsing", ["parse"]),
+    ("globbing", ["glob"]),
+    ("rendering", ["template"]),
+    ("commands", ["command"]),
+]
+##############################################################################
+
+
+
+##############################################################################
+def writeFile(path, content):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    with open(path, 'w') as output_file:
+        output_file.write(content)
+
+def libraryName(layer, index):
+    return "lib_%d_%d" % (layer, index)
+
+def generateWorkspace(workspace, layers, width, files, nesting):
+    """Creates 'layers' layers of 'width' libraries each (plus the main
+    executable), every library with 'files' sources spread over 'nesting'
+    levels of folders."""
+    if os.path.exists(workspace):
+        shutil.rmtree(workspace)
+
+    for layer in range(layers):
+        for index in range(width):
+            name = libraryName(layer, index)
+            library_path = os.path.join(workspace, "libs", name)
+
+            dependencies = []
+            if layer+1 < layers:
+                dependencies = [ { "path": "../" + libraryName(layer+1, dependency_index),
+                                   "name": libraryName(layer+1, dependency_index) }
+                                 for dependency_index in sorted(set([index, (index+1) % width])) ]
+
+            writeFile(os.path.join(library_path, "crab.json"), json.dumps({
+                "project_name": name,
+                "targets": [{
+                    "name": name,
+                    "type": "library",
+                    "sources": [ { "glob": "src/**/*.cpp" } ],
+                    "includes": [ "include" ],
+                    "dependencies": dependencies
+                }]
+            }, indent=4))
+
+            writeFile(os.path.join(library_path, "include", name + ".h"),
+                      "int %s();\n" % (name))
+
+            calls = ''.join("    value += %s();\n" % (dependency["name"]) for dependency in dependencies)
+            includes = ''.join('#include "%s.h"\n' % (dependency["name"]) for dependency in dependencies)
+            writeFile(os.path.join(library_path, "src", name + ".cpp"),
+                      '#include "%s.h"\n%s\nint %s() {\n    int value = %d;\n%s    return value;\n}\n' %
+                      (name, includes, name, layer, calls))
+
+            for file_index in range(files-1):
+                folder = os.path.join(*(["src"] + ["level%d" % (level) for level in range(file_index % (nesting+1))]))
+                writeFile(os.path.join(library_path, folder, "file%d.cpp" % (file_index)),
+                          "int %s_file%d() { return %d; }\n" % (name, file_index, file_index))
+
+    writeFile(os.path.join(workspace, "crab.json"), json.dumps({
+        "project_name": "benchmark",
+        "targets": [{
+            "name": "benchmark.run",
+            "type": "executable",
+            "sources": [ "main.cpp" ],
+            "dependencies": [ { "path": "libs/" + libraryName(0, index), "name": libraryName(0, index) }
+                              for index in range(width) ]
+        }]
+    }, indent=4))
+
+    writeFile(os.path.join(workspace, "main.cpp"),
+              ''.join('#include "%s.h"\n' % (libraryName(0, index)) for index in range(width)) +
+              "\nint main() {\n    return (%s) == 0;\n}\n" %
+              (' + '.join("%s()" % (libraryName(0, index)) for index in range(width))))
+##############################################################################
+
+
+
+##############################################################################
+def phaseTimes(trace_file_path):
+    with open(trace_file_path) as trace_file:
+        events = [ event for event in json.load(trace_file)["traceEvents"] if event.get("ph") == "X" ]
+
+    times = {}
+    for (phase, categories) in PHASES:
+        duration = 0
+        for event in events:
+            if event["cat"] in categories or "%s:%s" % (event["cat"], event["name"]) in categories:
+                duration += event["dur"]
+        times[phase] = duration / 1000000.0
+
+    return times
+
+def runScenario(workspace, name, drop_graph_cache, touched, layers, jobs):
+    if drop_graph_cache:
+        graph_cache_path = os.path.join(workspace, "build", ".build", "graph.cache")
+        if os.path.exists(graph_cache_path):
+            os.remove(graph_cache_path)
+
+    if touched == "leaf":
+        leaf_name = libraryName(layers-1, 0)
+        os.utime(os.path.join(workspace, "libs", leaf_name, "src", leaf_name + ".cpp"), None)
+
+    trace_file_path = os.path.join(workspace, "trace.json")
+
+    command = [sys.executable, CRAB_PATH, "--trace", trace_file_path]
+    if jobs:
+        command += ["-j", str(jobs)]
+
+    start_time = time.time()
+    p = subprocess.Popen(command, cwd=workspace, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    p_output = p.communicate()[0]
+    elapsed_time = time.time() - start_time
+
+    if p.returncode != 0:
+        print "Error running crabsys at: ", workspace
+        print p_output
+        exit(4)
+
+    result = { "scenario": name, "wall_time": elapsed_time }
+    result.update(phaseTimes(trace_file_path))
+    return result
+
+def printResults(results):
+    columns = ["wall_time"] + [phase for (phase, categories) in PHASES]
+
+    print "%-36s" % ("") + ''.join("%12s" % (column) for column in columns)
+    for result in results:
+        print "%-36s" % (result["scenario"]) + ''.join("%12.3f" % (result[column]) for column in columns)
+##############################################################################
+
+
+
+##############################################################################
+def main():
+    parser = argparse.ArgumentParser(description='CRABsys overhead benchmark')
+    parser.add_argument('--workspace', metavar='PATH', action='store', dest='workspace', default='/tmp/crabsys-benchmark',
+                        help="Where the synthetic projects are generated (deleted first)")
+    parser.add_argument('--layers', metavar='N', type=int, action='store', dest='layers', default=10,
+                        help="Depth of the dependency graph")
+    parser.add_argument('--width', metavar='N', type=int, action='store', dest='width', default=10,
+                        help="Libraries per layer")
+    parser.add_argument('--files', metavar='N', type=int, action='store', dest='files', default=20,
+                        help="Source files per library")
+    parser.add_argument('--nesting', metavar='N', type=int, action='store', dest='nesting', default=3,
+                        help="Depth of the folders sources are spread over")
+    parser.add_argument('-j', '--jobs', metavar='N', type=int, action='store', dest='jobs', default=None,
+                        help="Jobs passed to crabsys")
+    parser.add_argument('--output', metavar='FILE', action='store', dest='output', default=None,
+                        help="Save the results as JSON")
+
+    args = parser.parse_args()
+
+    workspace = os.path.abspath(args.workspace)
+    generateWorkspace(workspace, args.layers, args.width, args.files, args.nesting)
+
+    print "%d libraries, %d source files" % (args.layers*args.width, args.layers*args.width*args.files + 1)
+
+    results = [ runScenario(workspace, name, drop_graph_cache, touched, args.layers, args.jobs)
+                for (name, drop_graph_cache, touched) in SCENARIOS ]
+
+    printResults(results)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump({
+                "parameters": {
+                    "layers": args.layers,
+                    "width": args.width,
+                    "files": args.files,
+                    "nesting": args.nesting,
+                    "jobs": args.jobs
+                },
+                "python": platform.python_version(),
+                "results": results
+            }, output_file, indent=4, sort_keys=True, separators=(',', ': '))
+            output_file.write('\n')
+##############################################################################
+
+
+##############################################################################
+if __name__ == "__main__":
+    main()
+##############################################################################
@@ -3,10 +3,19 @@
 
 import os
 import os.path
+import re
+import json
+import sys
 import subprocess
 import time
 import shutil
+import hashlib
+import tarfile
+import tempfile
+import signal
 import argparse
+import threading
+import BaseHTTPServer
 
 
 ##############################################################################
@@ -103,10 +112,935 @@ CRAB rulez!!
 
 REPLAY_MAX_TIME = 1.0
 CRAB_PATH = os.path.abspath("../crabsys/crabsys.py")
+CRABSYS_MODULES_PATH = os.path.dirname(CRAB_PATH)
+
+# crab --version, best of STARTUP_RUNS
+STARTUP_MAX_TIME = 0.3
+STARTUP_RUNS = 5
+
+# Only needed once something gets built
+STARTUP_UNNEEDED_MODULES = ["utils", "config", "context", "target", "pystache", "multiprocessing", "urllib2"]
 ##############################################################################
 
 
 ##############################################################################
+def testStartup():
+    elapsed_times = []
+    for run in range(STARTUP_RUNS):
+        start_time = time.time()
+        subprocess.check_output(["python", CRAB_PATH, "--version"])
+        elapsed_times.append(time.time() - start_time)
+
+    if min(elapsed_times) > STARTUP_MAX_TIME:
+        print "Startup took too long: %lf" % (min(elapsed_times))
+        exit(5)
+
+    # Asking for the status (without a daemon running) goes through argument
+    # parsing and the daemon client
+    output = subprocess.check_output(["python", "-c",
+        "import sys; sys.path.insert(0, %r); sys.argv = ['crab', 'status']; import crabsys; crabsys.main(); "
+        "print ' '.join(m for m in %r if m in sys.modules)" % (os.path.dirname(CRAB_PATH), STARTUP_UNNEEDED_MODULES)])
+
+    imported_modules = output.splitlines()[-1]
+    if imported_modules:
+        print "Modules imported at startup: %s" % (imported_modules)
+        exit(6)
+
+def testScheduler():
+    """Tasks run after their dependencies, and a failing task cancels the
+    others, including the commands they're running."""
+    sys.path.insert(0, CRABSYS_MODULES_PATH)
+    from scheduler import Scheduler
+    from utils import system_command, reset_cancelled_commands
+
+    def check(condition, message):
+        if not condition:
+            print "Scheduler: %s" % (message)
+            exit(15)
+
+    order = []
+    order_lock = threading.Lock()
+
+    def record(name):
+        def function():
+            time.sleep(0.05)
+            with order_lock:
+                order.append(name)
+        return function
+
+    # A diamond, and an independent chain
+    scheduler = Scheduler(4)
+    a = scheduler.addTask("a", record("a"))
+    b = scheduler.addTask("b", record("b"), [a])
+    c = scheduler.addTask("c", record("c"), [a])
+    scheduler.addTask("d", record("d"), [b, c])
+    e = scheduler.addTask("e", record("e"))
+    scheduler.addTask("f", record("f"), [e])
+    scheduler.run()
+
+    check(sorted(order) == list("abcdef"), "unexpected tasks run: %s" % (order))
+    for (task, dependencies) in [("b", "a"), ("c", "a"), ("d", "bc"), ("f", "e")]:
+        for dependency in dependencies:
+            check(order.index(dependency) < order.index(task),
+                  "%s ran before its dependency %s: %s" % (task, dependency, order))
+
+    # The failure stops the long command running on another worker, and
+    # nothing depending on the failed task runs
+    del order[:]
+
+    def fail():
+        time.sleep(0.5)
+        raise Exception("expected failure")
+
+    scheduler = Scheduler(4)
+    failing = scheduler.addTask("fail", fail)
+    scheduler.addTask("sleep", lambda: system_command(["sleep", "30"]))
+    scheduler.addTask("dependent", record("dependent"), [failing])
+
+    start_time = time.time()
+    try:
+        scheduler.run()
+        check(False, "failure not raised")
+    except Exception as e:
+        check(str(e) == "expected failure", "unexpected error: %s" % (e))
+
+    check(time.time() - start_time < 10, "running command not cancelled")
+    check(order == [], "dependent of a failed task ran: %s" % (order))
+
+    # Later tests run commands in this process
+    reset_cancelled_commands()
+
+JOBSERVER_MAKEFILE = """
+JOBS := 1 2 3 4 5 6
+all: $(JOBS)
+$(JOBS):
+	@echo + >> $(LOG); sleep 0.2; echo - >> $(LOG)
+.PHONY: all $(JOBS)
+"""
+
+def testJobserver():
+    """Concurrent makes share the tokens of the jobserver: together, they
+    never run more jobs than it allows."""
+    sys.path.insert(0, CRABSYS_MODULES_PATH)
+    from jobserver import startJobserver, stopJobserver, jobSlot, jobserverEnvironment
+    from utils import system_command
+
+    def check(condition, message):
+        if not condition:
+            print "Jobserver: %s" % (message)
+            exit(16)
+
+    work_dir = tempfile.mkdtemp()
+    log_path = os.path.join(work_dir, "jobs.log")
+    writeProject(work_dir, { "Makefile": JOBSERVER_MAKEFILE })
+
+    results = []
+
+    def make():
+        with jobSlot():
+            results.append(system_command(["make", "LOG=" + log_path], work_dir, jobserverEnvironment()))
+
+    startJobserver(3)
+    try:
+        makes = [ threading.Thread(target=make) for i in range(2) ]
+        for thread in makes:
+            thread.start()
+        for thread in makes:
+            thread.join()
+    finally:
+        stopJobserver()
+
+    try:
+        check([result[0] for result in results] == [0, 0], "make failed: %s" % (results))
+
+        running = 0
+        most_running = 0
+        with open(log_path) as log_file:
+            for line in log_file:
+                running += 1 if line.strip() == "+" else -1
+                most_running = max(most_running, running)
+
+        check(most_running <= 3, "%d jobs ran at once, with 3 tokens" % (most_running))
+        check(most_running > 1, "jobs never ran in parallel")
+    finally:
+        shutil.rmtree(work_dir)
+
+class ArchiveRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the files of directory, supporting 'Range: bytes=N-' requests
+    and recording the Range header of every request."""
+    directory = None
+    ranges = []
+
+    def do_GET(self):
+        path = os.path.join(self.directory, self.path.lstrip('/'))
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+
+        with open(path, 'rb') as served_file:
+            data = served_file.read()
+
+        requested_range = self.headers.getheader('Range')
+        ArchiveRequestHandler.ranges.append(requested_range)
+
+        start = 0
+        if requested_range:
+            start = int(re.match(r'bytes=(\d+)-', requested_range).group(1))
+            if start >= len(data):
+                self.send_error(416)
+                return
+            self.send_response(206)
+        else:
+            self.send_response(200)
+
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+    def log_message(self, format, *args):
+        pass
+
+def testFetch():
+    sys.path.insert(0, CRABSYS_MODULES_PATH)
+    from fetch import retrieve_archive, ChecksumMismatch
+
+    def check(condition, message):
+        if not condition:
+            print "Archive fetching: %s" % (message)
+            exit(7)
+
+    work_dir = tempfile.mkdtemp()
+    served_dir = os.path.join(work_dir, "served")
+    os.mkdir(served_dir)
+
+    # Random content doesn't compress, so half the archive is half of it
+    content = os.urandom(256*1024)
+    content_path = os.path.join(work_dir, "content.bin")
+    with open(content_path, 'wb') as content_file:
+        content_file.write(content)
+
+    archive_path = os.path.join(served_dir, "fixture.tar.gz")
+    with tarfile.open(archive_path, "w:gz") as archive:
+        archive.add(content_path, "fixture/content.bin")
+
+    with open(archive_path, 'rb') as archive_file:
+        archive_data = archive_file.read()
+    archive_sha256 = hashlib.sha256(archive_data).hexdigest()
+
+    with open(os.path.join(served_dir, "truncated.tar.gz"), 'wb') as truncated_file:
+        truncated_file.write(archive_data[:len(archive_data)/2])
+
+    ArchiveRequestHandler.directory = served_dir
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), ArchiveRequestHandler)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    url = "http://127.0.0.1:%d/" % (server.server_address[1])
+
+    def extracted_content(extracted_dir):
+        with open(os.path.join(extracted_dir, "fixture", "content.bin"), 'rb') as extracted_file:
+            return extracted_file.read()
+
+    try:
+        # Extracted while downloading, then renamed in place
+        libs_dir = os.path.join(work_dir, "download")
+        extracted_dir = retrieve_archive(url + "fixture.tar.gz", None, libs_dir, archive_sha256)
+        check(extracted_content(extracted_dir) == content, "unexpected extracted content")
+        check(sorted(os.listdir(libs_dir)) == ["fixture.tar.gz", "fixture.tar.gz_extracted"],
+              "unexpected files after download: %s" % (os.listdir(libs_dir)))
+
+        # Resumed from where an earlier download stopped
+        libs_dir = os.path.join(work_dir, "resume")
+        os.mkdir(libs_dir)
+        with open(os.path.join(libs_dir, "fixture.tar.gz.part"), 'wb') as partial_file:
+            partial_file.write(archive_data[:len(archive_data)/2])
+
+        del ArchiveRequestHandler.ranges[:]
+        extracted_dir = retrieve_archive(url + "fixture.tar.gz", None, libs_dir, archive_sha256)
+        check(ArchiveRequestHandler.ranges == ["bytes=%d-" % (len(archive_data)/2)],
+              "download not resumed, requested ranges: %s" % (ArchiveRequestHandler.ranges))
+        check(extracted_content(extracted_dir) == content, "unexpected extracted content after resuming")
+        check(sorted(os.listdir(libs_dir)) == ["fixture.tar.gz", "fixture.tar.gz_extracted"],
+              "unexpected files after resuming: %s" % (os.listdir(libs_dir)))
+
+        # A checksum mismatch leaves nothing behind
+        libs_dir = os.path.join(work_dir, "mismatch")
+        try:
+            retrieve_archive(url + "fixture.tar.gz", None, libs_dir, "0"*64)
+            check(False, "sha256 mismatch not detected")
+        except ChecksumMismatch:
+            pass
+        check(os.listdir(libs_dir) == [], "files left after a mismatch: %s" % (os.listdir(libs_dir)))
+
+        # An interrupted download never shows up as extracted, and is kept to
+        # be resumed
+        libs_dir = os.path.join(work_dir, "truncated")
+        try:
+            retrieve_archive(url + "truncated.tar.gz", None, libs_dir)
+            check(False, "truncated archive not detected")
+        except Exception:
+            pass
+        check(os.listdir(libs_dir) == ["truncated.tar.gz.part"],
+              "unexpected files after an interrupted download: %s" % (os.listdir(libs_dir)))
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(work_dir)
+
+def testCacheServer():
+    """Blobs stored through the HTTP backend come back from the cache
+    server as they were, whatever the path prefix of the backend url."""
+    sys.path.insert(0, CRABSYS_MODULES_PATH)
+    from StringIO import StringIO
+    from cache_backends import HttpBackend
+    from cache_server import CacheServer, CacheRequestHandler
+
+    class QuietRequestHandler(CacheRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+    def check(condition, message):
+        if not condition:
+            print "Cache server: %s" % (message)
+            exit(14)
+
+    work_dir = tempfile.mkdtemp()
+    server = CacheServer(('127.0.0.1', 0), work_dir)
+    server.RequestHandlerClass = QuietRequestHandler
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    try:
+        for prefix in ["", "crabsys/cache/"]:
+            backend = HttpBackend("http://127.0.0.1:%d/%s" % (server.server_address[1], prefix))
+
+            blob = os.urandom(200*1024)
+            digest = hashlib.sha256(blob).hexdigest()
+            key = hashlib.sha256(prefix).hexdigest()
+
+            check(backend.fetch(key, StringIO()) is None, "unknown key found")
+
+            backend.store(key, StringIO(blob), digest, len(blob))
+            fetched = StringIO()
+            check(backend.fetch(key, fetched) == digest, "unexpected digest")
+            check(fetched.getvalue() == blob, "unexpected blob content")
+
+            try:
+                backend.store(key, StringIO(blob), "0"*64, len(blob))
+                check(False, "blob not matching its digest accepted")
+            except Exception:
+                pass
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(work_dir)
+
+# (pattern, paths it matches, paths it doesn't)
+GLOB_TRANSLATIONS = [
+    ("*.cpp", ["a.cpp"], ["src/a.cpp", "a.h"]),
+    ("**/*.cpp", ["a.cpp", "src/a.cpp", "src/net/a.cpp"], ["a.h", "src/a.h"]),
+    ("src/**", ["src/a.cpp", "src/net/a.cpp"], ["a.cpp", "srcs/a.cpp"]),
+    ("src/**/*.cpp", ["src/a.cpp", "src/net/io/a.cpp"], ["a.cpp", "lib/src/a.cpp"]),
+    ("test_?.c", ["test_1.c"], ["test_12.c", "test_/.c"]),
+    ("[!a]*.c", ["b.c"], ["a.c"]),
+    ("a+b.c", ["a+b.c"], ["aab.c"])
+]
+
+def testGlobs():
+    sys.path.insert(0, CRABSYS_MODULES_PATH)
+    from file_index import FileIndex, translate_glob
+
+    def check(condition, message):
+        if not condition:
+            print "Globs: %s" % (message)
+            exit(8)
+
+    for (pattern, matching, not_matching) in GLOB_TRANSLATIONS:
+        regex = translate_glob(pattern)
+        for path in matching:
+            check(regex.match(path), "%s doesn't match %s" % (pattern, path))
+        for path in not_matching:
+            check(not regex.match(path), "%s matches %s" % (pattern, path))
+
+    # Exclude patterns without folders apply to file names
+    check(FileIndex().excluded("src/net/a_test.cpp", [translate_glob("*_test.cpp")]),
+          "*_test.cpp doesn't exclude src/net/a_test.cpp")
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        for path in ["a.cpp", "a.h", "net/b.cpp", "net/io/c.cpp", "net/io/c_test.cpp",
+                     "gen/d.cpp", ".hidden/e.cpp"]:
+            path = os.path.join(work_dir, "src", path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+
+        sources = FileIndex().glob(os.path.join(work_dir, "src", "**", "*.cpp"), ["*_test.cpp", "gen/**"])
+        expected_sources = [os.path.join(work_dir, "src", path) for path in ["a.cpp", "net/b.cpp", "net/io/c.cpp"]]
+        check(sources == expected_sources, "unexpected matches of src/**/*.cpp: %s" % (sources))
+    finally:
+        shutil.rmtree(work_dir)
+
+def writeProject(directory, files):
+    """Writes files (relative path: content) under directory."""
+    for (path, content) in files.items():
+        path = os.path.join(directory, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as project_file:
+            project_file.write(content)
+
+def runCrab(directory, params=[], env=None):
+    p = subprocess.Popen(["python", CRAB_PATH] + params, cwd=directory, env=env,
+                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    return (p.communicate()[0], p.returncode)
+
+def tracedCrab(directory, params=[]):
+    """Runs crab with a trace, returning its output, return code and trace
+    events."""
+    trace_path = os.path.join(tempfile.mkdtemp(), "trace.json")
+    try:
+        (output, returncode) = runCrab(directory, params + ["--trace", trace_path])
+
+        events = []
+        if os.path.isfile(trace_path):
+            with open(trace_path) as trace_file:
+                events = json.load(trace_file)["traceEvents"]
+    finally:
+        shutil.rmtree(os.path.dirname(trace_path))
+
+    return (output, returncode, events)
+
+def spanNames(events, category):
+    return [event["name"] for event in events if event.get("cat") == category]
+
+def git(directory, params):
+    subprocess.check_call(["git", "-c", "user.name=crabsys", "-c", "user.email=crabsys@localhost"] + params,
+                          cwd=directory)
+
+def createRepository(directory):
+    """Commits everything in directory to a new repository, on branch main."""
+    for params in [["init", "-q"], ["add", "."], ["commit", "-q", "-m", "initial"], ["branch", "-M", "main"]]:
+        git(directory, params)
+
+def libraryProject(name, dependencies):
+    """A library whose function calls those of its dependencies (paths of
+    sibling projects)."""
+    calls = ''.join("int %s(); " % (dep) for dep in dependencies)
+    return {
+        name + "/crab.json": json.dumps({
+            "project_name": name,
+            "targets": [{
+                "name": name,
+                "type": "library",
+                "sources": [name + ".cpp"],
+                "dependencies": [ { "path": "../" + dep, "name": dep } for dep in dependencies ]
+            }]
+        }),
+        name + "/" + name + ".cpp": "%sint %s() { return 1%s; }\n" % (
+            calls, name, ''.join(" + %s()" % (dep) for dep in dependencies))
+    }
+
+def testLinkOrder():
+    """app depends on a and b, both depending on c, which depends on d: every
+    library must be linked once, before the ones it depends on."""
+    def check(condition, message):
+        if not condition:
+            print "Link order: %s" % (message)
+            exit(9)
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        files = {
+            "app/crab.json": json.dumps({
+                "project_name": "app",
+                "targets": [{
+                    "name": "app",
+                    "type": "executable",
+                    "sources": ["main.cpp"],
+                    "dependencies": [ { "path": "../a", "name": "a" }, { "path": "../b", "name": "b" } ]
+                }]
+            }),
+            "app/main.cpp": "#include <cstdio>\nint a(); int b();\nint main() { printf(\"%d\\n\", a() + b()); }\n"
+        }
+        files.update(libraryProject("a", ["c"]))
+        files.update(libraryProject("b", ["c"]))
+        files.update(libraryProject("c", ["d"]))
+        files.update(libraryProject("d", []))
+        writeProject(work_dir, files)
+
+        app_dir = os.path.join(work_dir, "app")
+        (output, returncode) = runCrab(app_dir)
+        check(returncode == 0, "build failed:\n" + output)
+
+        with open(os.path.join(app_dir, "build", ".build", "__target_app", "CMakeLists.txt")) as cmake_lists:
+            libraries = [ os.path.basename(line.split()[-1].rstrip(')'))
+                          for line in cmake_lists if line.startswith("LIST(APPEND __CRABSYS_LIBS ") ]
+
+        check(sorted(libraries) == ["liba.a", "libb.a", "libc.a", "libd.a"],
+              "unexpected libraries: %s" % (libraries))
+        for (library, dependency) in [("liba.a", "libc.a"), ("libb.a", "libc.a"), ("libc.a", "libd.a")]:
+            check(libraries.index(library) < libraries.index(dependency),
+                  "%s linked after %s: %s" % (library, dependency, libraries))
+
+        output = subprocess.check_output([os.path.join(app_dir, "build", "app")])
+        check(output == "6\n", "unexpected output: %s" % (output))
+    finally:
+        shutil.rmtree(work_dir)
+
+def testDependencyConflict():
+    """app depends on a and b, both requiring the same repository: once with
+    the same settings (shared), then with different ones (an error)."""
+    def check(condition, message):
+        if not condition:
+            print "Dependency identity: %s" % (message)
+            exit(10)
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        files = {
+            "app/crab.json": json.dumps({
+                "project_name": "app",
+                "targets": [{
+                    "name": "app",
+                    "type": "executable",
+                    "sources": ["main.cpp"],
+                    "dependencies": [ { "path": "../a", "name": "a" }, { "path": "../b", "name": "b" } ]
+                }]
+            }),
+            "app/main.cpp": "int a(); int b();\nint main() { return a() + b() - 6; }\n",
+            "shared/crab.json": json.dumps({
+                "project_name": "shared",
+                "targets": [{ "name": "shared", "type": "library", "sources": ["shared.cpp"] }]
+            }),
+            "shared/shared.cpp": "int shared() { return 2; }\n"
+        }
+        for name in ["a", "b"]:
+            files[name + "/" + name + ".cpp"] = "int shared(); int %s() { return 1 + shared(); }\n" % (name)
+        writeProject(work_dir, files)
+
+        repository_dir = os.path.join(work_dir, "shared")
+        createRepository(repository_dir)
+
+        def writeLibrary(name, repository_info):
+            writeProject(work_dir, { name + "/crab.json": json.dumps({
+                "project_name": name,
+                "targets": [{
+                    "name": name,
+                    "type": "library",
+                    "sources": [name + ".cpp"],
+                    "dependencies": [ dict({ "repository": "file://" + repository_dir, "name": "shared" },
+                                           **repository_info) ]
+                }]
+            }) })
+
+        app_dir = os.path.join(work_dir, "app")
+
+        # Same settings, one checkout
+        writeLibrary("a", { "branch": "main" })
+        writeLibrary("b", { "branch": "main" })
+        (output, returncode) = runCrab(app_dir)
+        check(returncode == 0, "build failed:\n" + output)
+
+        checkouts = [ name for name in ["a", "b"] if os.path.isdir(os.path.join(work_dir, name, "libs", "shared")) ]
+        check(len(checkouts) == 1, "repository checked out by %s" % (checkouts or "none"))
+        check(subprocess.call([os.path.join(app_dir, "build", "app")]) == 0, "unexpected app result")
+
+        # Different settings
+        writeLibrary("b", {})
+        (output, returncode) = runCrab(app_dir)
+        check(returncode != 0 and "Dependency conflict" in output,
+              "conflicting requirements not reported:\n" + output)
+    finally:
+        shutil.rmtree(work_dir)
+
+def customProject(name, command, dependencies=[]):
+    """crab.json of a custom target running command (through sh) to make
+    out.txt."""
+    return json.dumps({
+        "project_name": name,
+        "targets": [{
+            "name": name,
+            "build_type": "custom",
+            "build_steps": [ { "command": "sh", "params": ["-c", command] } ],
+            "target_files": ["out.txt"],
+            "dependencies": dependencies
+        }]
+    })
+
+def testArtifactCache():
+    """Outputs restored from the artifact cache and then rebuilt in place
+    must leave the cached entry alone."""
+    def check(condition, message):
+        if not condition:
+            print "Artifact cache: %s" % (message)
+            exit(11)
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        cache_dir = os.path.join(work_dir, "cache")
+        repository_dir = os.path.join(work_dir, "dep")
+
+        files = { "dep/crab.json": customProject("dep", "printf v1 > out.txt") }
+        for workspace in ["ws1", "ws2"]:
+            files[workspace + "/crab.json"] = customProject(workspace, "printf done > out.txt",
+                [ { "repository": "file://" + repository_dir, "name": "dep" } ])
+            files[workspace + "/crabsys.config.json"] = json.dumps({ "artifact_cache_directory": cache_dir })
+        writeProject(work_dir, files)
+        createRepository(repository_dir)
+
+        for workspace in ["ws1", "ws2"]:
+            (output, returncode) = runCrab(os.path.join(work_dir, workspace))
+            check(returncode == 0, "build failed:\n" + output)
+        check("Restored from artifact cache" in output, "dependency not restored:\n" + output)
+
+        # Another build description, rewriting the restored output in place
+        writeProject(work_dir, { "ws2/libs/dep/crab.json": customProject("dep", "printf v2 > out.txt") })
+        (output, returncode) = runCrab(os.path.join(work_dir, "ws2"))
+        check(returncode == 0, "build failed:\n" + output)
+
+        def content(path):
+            with open(path) as content_file:
+                return content_file.read()
+
+        check(content(os.path.join(work_dir, "ws2", "libs", "dep", "out.txt")) == "v2", "dependency not rebuilt")
+
+        cached_outputs = sorted(content(os.path.join(directory, "out.txt"))
+                                for (directory, directories, file_names) in os.walk(cache_dir)
+                                if "out.txt" in file_names)
+        check(cached_outputs == ["v1", "v2"], "unexpected cached outputs: %s" % (cached_outputs))
+    finally:
+        shutil.rmtree(work_dir)
+
+def testLockfile():
+    """crab.lock entries only stand for the branch crab.json asked for when
+    they were written."""
+    def check(condition, message):
+        if not condition:
+            print "Lockfile: %s" % (message)
+            exit(12)
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        repository_dir = os.path.join(work_dir, "dep")
+        app_dir = os.path.join(work_dir, "app")
+
+        writeProject(work_dir, { "dep/crab.json": customProject("dep", "printf main > out.txt") })
+        createRepository(repository_dir)
+        git(repository_dir, ["checkout", "-q", "-b", "dev"])
+        writeProject(work_dir, { "dep/crab.json": customProject("dep", "printf dev > out.txt") })
+        git(repository_dir, ["commit", "-q", "-a", "-m", "dev"])
+
+        def build(branch, params=[]):
+            writeProject(work_dir, { "app/crab.json": customProject("app", "printf done > out.txt",
+                [ { "repository": "file://" + repository_dir, "name": "dep", "branch": branch } ]) })
+            return runCrab(app_dir, params)
+
+        def built_branch():
+            with open(os.path.join(app_dir, "libs", "dep", "out.txt")) as output_file:
+                return output_file.read()
+
+        for branch in ["main", "dev"]:
+            (output, returncode) = build(branch)
+            check(returncode == 0, "build failed:\n" + output)
+            check(built_branch() == branch, "built %s instead of %s" % (built_branch(), branch))
+
+        with open(os.path.join(app_dir, "crab.lock")) as lock_file:
+            entry = json.load(lock_file)["dependencies"][os.path.join("libs", "dep")]
+        check(entry.get("pin") == { "branch": "dev" }, "unexpected lock entry: %s" % (entry))
+
+        (output, returncode) = build("main", ["--locked"])
+        check(returncode != 0 and "changed in crab.json" in output,
+              "stale lock entry accepted in locked mode:\n" + output)
+
+        # Locked builds use existing checkouts, and never clone
+        (output, returncode) = build("dev", ["--locked"])
+        check(returncode == 0 and built_branch() == "dev", "locked build failed:\n" + output)
+
+        shutil.rmtree(os.path.join(app_dir, "libs", "dep"))
+        (output, returncode) = build("dev", ["--locked"])
+        check(returncode != 0 and "isn't checked out" in output,
+              "missing checkout cloned in locked mode:\n" + output)
+    finally:
+        shutil.rmtree(work_dir)
+
+def testDaemon():
+    """Builds go through the daemon of the workspace, unless the client's
+    build environment differs from the daemon's."""
+    def check(condition, message):
+        if not condition:
+            print "Build daemon: %s" % (message)
+            exit(13)
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        writeProject(work_dir, { "crab.json": customProject("app", "printf done > out.txt") })
+
+        (output, returncode) = runCrab(work_dir, ["daemon"])
+        check(returncode == 0, "daemon not started:\n" + output)
+        try:
+            (output, returncode) = runCrab(work_dir)
+            check(returncode == 0 and "not using the build daemon" not in output,
+                  "build not served by the daemon:\n" + output)
+
+            environment = dict(os.environ)
+            environment["CFLAGS"] = environment.get("CFLAGS", "") + " -DCRABSYS_TEST"
+            (output, returncode) = runCrab(work_dir, [], environment)
+            check(returncode == 0 and "started with another environment" in output,
+                  "build with another environment served by the daemon:\n" + output)
+        finally:
+            runCrab(work_dir, ["daemon-stop"])
+    finally:
+        shutil.rmtree(work_dir)
+
+def globbedProject(sources):
+    return json.dumps({
+        "project_name": "app",
+        "targets": [{ "name": "app", "type": "executable", "sources": sources }]
+    })
+
+def testGraphCache():
+    """The processed build graph is reused until a globbed folder or a crab
+    file changes."""
+    def check(condition, message):
+        if not condition:
+            print "Build graph cache: %s" % (message)
+            exit(17)
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        writeProject(work_dir, {
+            "crab.json": globbedProject([{ "glob": "src/*.cpp" }]),
+            "src/main.cpp": "int main() { return 0; }\n"
+        })
+
+        def build():
+            (output, returncode, events) = tracedCrab(work_dir)
+            check(returncode == 0, "build failed:\n" + output)
+            return "root context" not in spanNames(events, "graph")
+
+        check(not build(), "cache used before any build")
+        check(build(), "cache not used by an unchanged workspace")
+
+        writeProject(work_dir, { "src/other.cpp": "int other() { return 0; }\n" })
+        check(not build(), "cache used after adding a file to a globbed folder")
+        check(build(), "cache not used after being written again")
+
+        writeProject(work_dir, {
+            "crab.json": globbedProject([{ "glob": "src/*.cpp", "exclude": ["src/*_test.cpp"] }])
+        })
+        check(not build(), "cache used after changing crab.json")
+        check(build(), "cache not used after being written again")
+    finally:
+        shutil.rmtree(work_dir)
+
+def testCMakeSkipped():
+    """Targets processed again don't run cmake for a folder whose
+    CMakeLists.txt didn't change."""
+    def check(condition, message):
+        if not condition:
+            print "CMake configuration: %s" % (message)
+            exit(18)
+
+    def appProject(sources, indent=None):
+        return {
+            "app/crab.json": json.dumps({
+                "project_name": "app",
+                "targets": [{
+                    "name": "app",
+                    "type": "executable",
+                    "sources": sources,
+                    "dependencies": [ { "path": "../lib", "name": "lib" } ]
+                }]
+            }, indent=indent),
+            "app/main.cpp": "int lib();\nint main() { return lib() - 1; }\n",
+            "app/other.cpp": "int other() { return 0; }\n"
+        }
+
+    work_dir = tempfile.mkdtemp()
+    app_dir = os.path.join(work_dir, "app")
+    try:
+        files = appProject(["main.cpp"])
+        files.update(libraryProject("lib", []))
+        writeProject(work_dir, files)
+
+        def cmakeRuns():
+            (output, returncode, events) = tracedCrab(app_dir)
+            check(returncode == 0, "build failed:\n" + output)
+            return spanNames(events, "command").count("cmake")
+
+        check(cmakeRuns() == 2, "cmake not run for both targets")
+
+        # Only reformatted: processed again, to the same CMakeLists.txt
+        writeProject(work_dir, appProject(["main.cpp"], 4))
+        check(cmakeRuns() == 0, "cmake run for unchanged folders")
+
+        writeProject(work_dir, appProject(["main.cpp", "other.cpp"]))
+        check(cmakeRuns() == 1, "cmake not run (only) for the changed target")
+    finally:
+        shutil.rmtree(work_dir)
+
+def testFingerprints():
+    """Custom targets whose input fingerprint didn't change aren't built
+    again."""
+    def check(condition, message):
+        if not condition:
+            print "Fingerprints: %s" % (message)
+            exit(19)
+
+    work_dir = tempfile.mkdtemp()
+    app_dir = os.path.join(work_dir, "app")
+    try:
+        def project(name, dependencies):
+            return json.dumps({
+                "project_name": name,
+                "targets": [{
+                    "name": name,
+                    "build_type": "custom",
+                    "build_steps": [ { "command": "cp", "params": ["input.txt", "out.txt"] } ],
+                    "target_files": ["out.txt"],
+                    "inputs": ["input.txt"],
+                    "dependencies": [ { "path": "../" + dep, "name": dep } for dep in dependencies ]
+                }]
+            })
+
+        writeProject(work_dir, {
+            "app/crab.json": project("app", ["lib"]),
+            "app/input.txt": "app",
+            "lib/crab.json": project("lib", []),
+            "lib/input.txt": "lib"
+        })
+
+        def builtTargets():
+            (output, returncode, events) = tracedCrab(app_dir)
+            check(returncode == 0, "build failed:\n" + output)
+            return sorted(event["name"] for event in events
+                          if event.get("cat") == "build" and event["args"].get("built"))
+
+        check(builtTargets() == ["app", "lib"], "targets not built at first")
+        check(builtTargets() == [], "unchanged targets built again")
+
+        writeProject(work_dir, { "app/input.txt": "app 2" })
+        check(builtTargets() == ["app"], "not only the target with a changed input built again")
+
+        # Dependents of a target rebuilt differently are built again
+        writeProject(work_dir, { "lib/input.txt": "lib 2" })
+        check(builtTargets() == ["app", "lib"], "dependent of a changed target not built again")
+    finally:
+        shutil.rmtree(work_dir)
+
+def testSuperbuild():
+    """With "superbuild", all crabsys targets are configured by one cmake
+    and built by one make (or ninja) run."""
+    def check(condition, message):
+        if not condition:
+            print "Superbuild: %s" % (message)
+            exit(20)
+
+    work_dir = tempfile.mkdtemp()
+    app_dir = os.path.join(work_dir, "app")
+    try:
+        files = {
+            "app/crab.json": json.dumps({
+                "project_name": "app",
+                "targets": [{
+                    "name": "app",
+                    "type": "executable",
+                    "sources": ["main.cpp"],
+                    "dependencies": [ { "path": "../a", "name": "a" }, { "path": "../b", "name": "b" } ]
+                }]
+            }),
+            "app/main.cpp": "#include <cstdio>\nint a(); int b();\nint main() { printf(\"%d\\n\", a() + b()); }\n",
+            "app/crabsys.config.json": json.dumps({ "superbuild": True })
+        }
+        files.update(libraryProject("a", ["c"]))
+        files.update(libraryProject("b", ["c"]))
+        files.update(libraryProject("c", []))
+        writeProject(work_dir, files)
+
+        def build():
+            (output, returncode, events) = tracedCrab(app_dir)
+            check(returncode == 0, "build failed:\n" + output)
+            return spanNames(events, "command")
+
+        commands = build()
+        check(commands.count("cmake") == 1, "cmake run %d times" % (commands.count("cmake")))
+        check(len([command for command in commands if command in ["make", "ninja"]]) == 1,
+              "not built by a single run: %s" % (commands))
+
+        output = subprocess.check_output([os.path.join(app_dir, "build", "app")])
+        check(output == "4\n", "unexpected output: %s" % (output))
+
+        # A dependency's change reaches the executable
+        writeProject(work_dir, { "c/c.cpp": "int c() { return 2; }\n" })
+        build()
+        output = subprocess.check_output([os.path.join(app_dir, "build", "app")])
+        check(output == "6\n", "unexpected output after changing a dependency: %s" % (output))
+    finally:
+        shutil.rmtree(work_dir)
+
+def testWatch():
+    """Watch mode rebuilds the targets using changed files and their
+    dependents, and reloads the graph when a crab file changes."""
+    def check(condition, message):
+        if not condition:
+            print "Watch: %s" % (message)
+            exit(21)
+
+    work_dir = tempfile.mkdtemp()
+    app_dir = os.path.join(work_dir, "app")
+
+    files = libraryProject("app", ["lib"])
+    files.update(libraryProject("lib", []))
+    writeProject(work_dir, files)
+
+    process = subprocess.Popen(["python", CRAB_PATH, "watch"], cwd=app_dir,
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    lines = []
+
+    def read():
+        for line in iter(process.stdout.readline, ''):
+            lines.append(line.rstrip('\n'))
+
+    reader = threading.Thread(target=read)
+    reader.daemon = True
+    reader.start()
+
+    def waitFor(line, count):
+        """Waits for the count-th line starting with line, returning the
+        lines printed since the previous one."""
+        deadline = time.time() + 120
+        while time.time() < deadline:
+            matches = [index for (index, printed) in enumerate(lines) if printed.startswith(line)]
+            if len(matches) >= count:
+                return lines[matches[count-2] if count > 1 else 0:matches[count-1]]
+            time.sleep(0.1)
+        check(False, "'%s' not printed:\n%s" % (line, '\n'.join(lines)))
+
+    try:
+        waitFor("Watching for changes", 1)
+
+        writeProject(work_dir, { "app/app.cpp": "int lib(); int app() { return 2 + lib(); }\n" })
+        printed = waitFor("Watching for changes", 2)
+        check("Rebuilding app" in printed, "unexpected rebuild:\n" + '\n'.join(printed))
+
+        writeProject(work_dir, { "lib/lib.cpp": "int lib() { return 2; }\n" })
+        printed = waitFor("Watching for changes", 3)
+        check("Rebuilding app, lib" in printed, "unexpected rebuild:\n" + '\n'.join(printed))
+
+        files = libraryProject("lib", [])
+        writeProject(work_dir, { "lib/crab.json": json.dumps(json.loads(files["lib/crab.json"]), indent=4) })
+        printed = waitFor("Watching for changes", 4)
+        check("Project changed, reloading" in printed, "graph not reloaded:\n" + '\n'.join(printed))
+        check(not [line for line in lines if line.startswith("Build failed")],
+              "build failed:\n" + '\n'.join(lines))
+    finally:
+        process.send_signal(signal.SIGINT)
+        process.wait()
+        shutil.rmtree(work_dir)
+
 def testExamples(examples, keep, print_output):
     for e in examples:
         testExample(e, keep, print_output)
@@ -185,6 +1119,22 @@ def main():
 
     #print args
 
+    testStartup()
+    testScheduler()
+    testJobserver()
+    testFetch()
+    testCacheServer()
+    testGlobs()
+    testLinkOrder()
+    testDependencyConflict()
+    testArtifactCache()
+    testLockfile()
+    testDaemon()
+    testGraphCache()
+    testCMakeSkipped()
+    testFingerprints()
+    testSuperbuild()
+    testWatch()
     testExamples(examples, keep=args.keep, print_output=args.print_output)
 ##############################################################################
 